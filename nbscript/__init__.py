@@ -2,5 +2,7 @@ from .nbscript import (
     argv,
     is_active,
     output_filename,
+    params,
     )
+from .state import load_state
 from ._version import __version__
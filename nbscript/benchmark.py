@@ -0,0 +1,242 @@
+"""Benchmarks of the overhead of nbscript and snotebook.
+
+Run with `python -m nbscript.benchmark -o results.json`, and compare
+the JSON of different commits.  Everything runs on generated
+notebooks in a temporary directory:
+
+* startup: `nbscript --help` and `snotebook --help` in a new
+  interpreter, minus the startup of the interpreter itself
+* argparse: `nbscript(..., _return_names=True)` and snotebook with a
+  mocked `execute_sbatch`, for notebooks of different sizes
+* kernel_start: starting a kernel and waiting until it is ready
+* cell: time per cell (from sending it to the kernel to the reply), for
+  trivial cells and cells with large outputs
+* export: converting an executed notebook, for each format
+* scan: finding the #SBATCH lines of a notebook with large outputs,
+  with the streaming scanner and with nbformat
+
+Each result is the median of `repeat` runs.
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FORMATS = ['notebook', 'markdown', 'html', 'asciidoc']
+BENCHMARKS = ['startup', 'argparse', 'kernel_start', 'cell', 'export', 'scan']
+
+
+def make_notebook(fname, n_cells, output_size=0, sbatch=True):
+    """Write a synthetic notebook.
+
+    Each cell prints `output_size` characters (0: the cell is `pass`).
+    The first cell has #SBATCH lines.  Outputs are also stored in the
+    file, as if it had been executed before.
+    """
+    import nbformat
+    from nbformat.v4 import new_code_cell, new_notebook, new_output
+    cells = [ ]
+    for i in range(n_cells):
+        if output_size:
+            source = "print('%%d ' %% %d * %d)"%(i, output_size // (len(str(i)) + 1))
+            outputs = [new_output('stream', text='x' * output_size)]
+        else:
+            source = 'pass'
+            outputs = [ ]
+        cells.append(new_code_cell(source, outputs=outputs))
+    if sbatch and cells:
+        cells[0].source = '#SBATCH --mem=1G\n#SBATCH -c 2\n' + cells[0].source
+    nb = new_notebook(cells=cells)
+    nb.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3',
+                                 'language': 'python'}
+    nbformat.write(nb, fname)
+    return fname
+
+
+def timeit(func, repeat):
+    times = [ ]
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class _CellTimer(object):
+    """Execution listener which times each cell"""
+    def __init__(self):
+        self.times = [ ]
+        self._start = None
+
+    def cell_start(self, ep, cell, index):
+        self._start = time.perf_counter()
+
+    def cell_end(self, ep, cell, index):
+        self.times.append(time.perf_counter() - self._start)
+
+
+class Benchmark(object):
+    def __init__(self, repeat=3, sizes=(10, 100), output_size=100000):
+        self.repeat = repeat
+        self.sizes = sizes
+        self.output_size = output_size
+        self.results = [ ]
+
+    def record(self, name, times, **params):
+        result = {'name': name, 'params': params,
+                  'seconds': statistics.median(times), 'all': times}
+        self.results.append(result)
+        sys.stderr.write('%-20s %-40s %.4fs\n'%(
+            name, ' '.join('%s=%s'%x for x in sorted(params.items())), result['seconds']))
+        return result['seconds']
+
+    def startup(self):
+        def python(*args):
+            return lambda: subprocess.check_call([sys.executable] + list(args),
+                                                 stdout=subprocess.DEVNULL)
+        base = statistics.median(timeit(python('-c', 'pass'), self.repeat))
+        for command in ('nbscript', 'snotebook'):
+            code = 'import sys; from nbscript.%s import %s; sys.exit(%s(["--help"]))'%(
+                command, command, command)
+            times = timeit(python('-c', code), self.repeat)
+            self.record('startup', [t - base for t in times], command=command)
+
+    def argparse(self):
+        from . import nbscript, snotebook
+        old = snotebook.execute_sbatch
+        snotebook.execute_sbatch = lambda cmd_submit, stdin, env, cmd_nbscript: 0
+        logging.disable(logging.INFO)
+        try:
+            for n in self.sizes:
+                fname = make_notebook('args%d.ipynb'%n, n, output_size=self.output_size)
+                self.record('argparse', timeit(
+                    lambda: nbscript.nbscript(['--save', fname, 'a'], _return_names=True),
+                    self.repeat), command='nbscript', cells=n)
+                self.record('argparse', timeit(
+                    lambda: snotebook.snotebook([fname, 'a']),
+                    self.repeat), command='snotebook', cells=n,
+                    file_size=os.stat(fname).st_size)
+        finally:
+            snotebook.execute_sbatch = old
+            logging.disable(logging.NOTSET)
+
+    def kernel_start(self):
+        from jupyter_client.manager import start_new_kernel
+        def start():
+            km, kc = start_new_kernel(kernel_name='python3')
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+        self.record('kernel_start', timeit(start, self.repeat))
+
+    def _execute(self, fname, listeners=()):
+        from . import execute
+        nb = execute.read(fname)
+        return execute.execute(nb, fname, listeners=listeners)
+
+    def cell(self):
+        n = max(self.sizes)
+        for kind, output_size in (('trivial', 0), ('output', self.output_size)):
+            fname = make_notebook('%s%d.ipynb'%(kind, n), n, output_size=output_size)
+            times = [ ]
+            for _ in range(self.repeat):
+                timer = _CellTimer()
+                self._execute(fname, listeners=[timer])
+                times.extend(timer.times[1:])   # the first one warms up
+            self.record('cell', times, kind=kind, output_size=output_size)
+
+    def export(self):
+        from . import execute
+        for n in self.sizes:
+            fname = make_notebook('export%d.ipynb'%n, n, output_size=self.output_size)
+            nb, resources = self._execute(fname)
+            for to_format in FORMATS:
+                self.record('export', timeit(
+                    lambda: execute.convert(nb, to_format, 'out', fname, resources=resources),
+                    self.repeat), format=to_format, cells=n)
+
+    def scan(self):
+        import nbformat
+        from nbformat.v4 import new_code_cell, new_notebook, new_output
+        from .scan import first_code_cell_source
+        image = base64.b64encode(os.urandom(self.output_size * 30)).decode()
+        big = new_output('display_data', data={'image/png': image, 'text/plain': 'x'})
+        for where, first_outputs in (('last', [ ]), ('first', [big] * 3)):
+            cells = [new_code_cell('#SBATCH --mem=1G\npass', outputs=first_outputs)]
+            cells += [new_code_cell('plot()', outputs=[big]) for _ in range(5)]
+            fname = 'scan-%s.ipynb'%where
+            nbformat.write(new_notebook(cells=cells), fname)
+            size = os.stat(fname).st_size
+            self.record('scan', timeit(lambda: first_code_cell_source(fname),
+                                       self.repeat), method='scan', outputs=where,
+                        file_size=size)
+            self.record('scan', timeit(lambda: nbformat.read(fname, as_version=4),
+                                       self.repeat), method='nbformat', outputs=where,
+                        file_size=size)
+
+    def run(self, only=None):
+        for name in BENCHMARKS:
+            if only and name not in only:
+                continue
+            getattr(self, name)()
+        return self.results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=sys.argv[1:]):
+    from . import __version__
+    parser = argparse.ArgumentParser(prog='python -m nbscript.benchmark',
+                                     description="Benchmark nbscript's own overhead.")
+    parser.add_argument("--output", "-o", help="Write results to this JSON file")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each benchmark (default %(default)s)")
+    parser.add_argument("--sizes", default='10,100',
+                        help="Numbers of cells of the notebooks (default %(default)s)")
+    parser.add_argument("--output-size", type=int, default=100000,
+                        help="Characters printed by output-heavy cells (default %(default)s)")
+    parser.add_argument("--only", action='append',
+                        choices=BENCHMARKS,
+                        help="Only run these benchmarks")
+    args = parser.parse_args(argv)
+
+    bench = Benchmark(repeat=args.repeat, output_size=args.output_size,
+                      sizes=[int(x) for x in args.sizes.split(',')])
+    tmpdir = tempfile.mkdtemp(prefix='nbscript-bench')
+    old_cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        results = bench.run(only=args.only)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(tmpdir)
+    data = {'version': __version__,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+            'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=1)
+    return data
+
+
+if __name__ == "__main__":
+    main()
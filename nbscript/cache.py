@@ -0,0 +1,171 @@
+"""Cell-level result cache.
+
+With `nbscript --cache`, each code cell gets a key: the hash of its
+source, of the keys of all cells before it, and of the notebook's argv.
+When a cell has run without errors, its outputs and the global
+variables it defines (see `nbscript.names`) are stored in the cache
+directory under that key.  The next time the same key comes up, the
+outputs are copied in and the variables are loaded into the kernel
+instead of executing the cell.  Variables are stored with dill.
+Objects which the cell may change in place (ones it calls methods on
+or passes to functions, also through the functions it calls) are
+stored too, like the variables it assigns.
+
+Cells tagged `nbscript-no-cache` are never cached.  If any cell is
+tagged `nbscript-cache`, only the tagged cells are cached.  Cells
+whose names can't be analyzed (cell magics, `import *`) aren't cached.
+
+The cache directory is limited in size: after storing, the least
+recently used entries are removed until it is below the limit.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+
+from nbformat import from_dict
+
+from . import names
+from .checkpoint import atomic_write
+
+LOG = logging.getLogger('nbscript.cache')
+
+TAG_CACHE = 'nbscript-cache'
+TAG_NO_CACHE = 'nbscript-no-cache'
+
+SAVE_VARS_CODE = ("__import__('dill').dump(dict((k, v) for k, v in globals().items() "
+                  "if k in %r), open(%r, 'wb'))")
+LOAD_VARS_CODE = "globals().update(__import__('dill').load(open(%r, 'rb')))"
+
+
+def default_cache_dir():
+    """$XDG_CACHE_HOME/nbscript, or ~/.cache/nbscript"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'nbscript')
+
+
+def file_hash(fname):
+    """sha256 of a file's contents, for including it in the keys"""
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cell_keys(nb, argv):
+    """Cache key for each cell (None for non-code cells)"""
+    keys = [ ]
+    chain = hashlib.sha256(json.dumps(argv).encode()).hexdigest()
+    for cell in nb.cells:
+        if cell.cell_type != 'code':
+            keys.append(None)
+            continue
+        chain = hashlib.sha256((chain + '\0' + cell.source).encode('utf-8')).hexdigest()
+        keys.append(chain)
+    return keys
+
+
+def evict(cache_dir, max_bytes):
+    """Remove least recently used entries until the cache is below max_bytes"""
+    entries = { }
+    for fname in os.listdir(cache_dir):
+        if fname.startswith('.'):
+            continue   # temporary files
+        key = fname.split('.', 1)[0]
+        try:
+            st = os.stat(os.path.join(cache_dir, fname))
+        except OSError:
+            continue   # removed by someone else
+        size, mtime = entries.get(key, (0, 0))
+        entries[key] = (size + st.st_size, max(mtime, st.st_mtime))
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda x: x[1][1]):
+        if total <= max_bytes:
+            break
+        for ext in ('.json', '.vars'):
+            try:
+                os.unlink(os.path.join(cache_dir, key + ext))
+            except OSError:
+                pass
+        total -= size
+        LOG.debug('evicted cache entry %s', key)
+
+
+class CellCache(object):
+    """Execution listener which implements the cache"""
+    def __init__(self, argv, cache_dir=None, max_bytes=2**30):
+        self.argv = argv
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.keys = [ ]
+        self.vars = { }     # cell index -> names to store
+        self._hit = set()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _fname(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def prepare(self, nb):
+        self.keys = cell_keys(nb, self.argv)
+        tagged_only = any(TAG_CACHE in cell.metadata.get('tags', [ ]) for cell in nb.cells)
+        functions = { }
+        modules = set()
+        for index, cell in enumerate(nb.cells):
+            if cell.cell_type != 'code':
+                continue
+            info = names.analyze(cell.source)
+            if info is None:
+                continue
+            functions.update(info.functions)
+            modules |= info.modules
+            tags = cell.metadata.get('tags', [ ])
+            if TAG_NO_CACHE in tags or (tagged_only and TAG_CACHE not in tags):
+                continue
+            # Also the objects the cell may change in place, like `x` in
+            # `x.append(1)` or `f(x)`: a hit has to restore them too.
+            _, writes = names.effects(info, functions, modules)
+            self.vars[index] = sorted(writes)
+
+    def skip_cell(self, ep, cell, index):
+        if index not in self.vars:
+            return False
+        key = self.keys[index]
+        if not os.path.exists(self._fname(key, '.json')):
+            return False
+        if self.vars[index] and not os.path.exists(self._fname(key, '.vars')):
+            return False
+        with io.open(self._fname(key, '.json'), encoding='utf-8') as f:
+            entry = json.load(f)
+        if self.vars[index]:
+            ep.run_code(LOAD_VARS_CODE%self._fname(key, '.vars'))
+        cell.outputs = [from_dict(out) for out in entry['outputs']]
+        cell.execution_count = entry.get('execution_count')
+        for ext in ('.json', '.vars'):
+            if os.path.exists(self._fname(key, ext)):
+                os.utime(self._fname(key, ext), None)
+        self._hit.add(index)
+        LOG.debug('cache hit for cell %d', index)
+        return True
+
+    def cell_end(self, ep, cell, index):
+        if index not in self.vars or index in self._hit:
+            return
+        if any(out.output_type == 'error' for out in cell.outputs):
+            return
+        key = self.keys[index]
+        if self.vars[index]:
+            try:
+                ep.run_code(SAVE_VARS_CODE%(self.vars[index], self._fname(key, '.vars')))
+            except RuntimeError as e:
+                LOG.debug('not caching cell %d: %s', index, e)
+                if os.path.exists(self._fname(key, '.vars')):
+                    os.unlink(self._fname(key, '.vars'))
+                return
+        entry = {'outputs': cell.outputs, 'execution_count': cell.execution_count}
+        # The .json file is written last, it marks the entry as complete.
+        atomic_write(self._fname(key, '.json'), json.dumps(entry, ensure_ascii=False))
+        evict(self.cache_dir, self.max_bytes)
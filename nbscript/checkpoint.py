@@ -0,0 +1,156 @@
+"""Incremental checkpointing of the executed notebook.
+
+While a notebook runs, the notebook with the outputs so far is written
+every so often, so that a job which is killed (time limit, out of
+memory) still leaves its output behind.  The file is written to a
+temporary file and renamed, so it is always a complete notebook.
+
+Only cells which have changed since the last checkpoint are serialized
+again, the JSON of the other cells is cached.
+"""
+
+import copy
+import io
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from nbformat import from_dict
+from nbformat.v4.rwbase import split_lines, strip_transient
+
+LOG = logging.getLogger('nbscript.checkpoint')
+
+def checkpoint_fname(output_fname, to_format):
+    """Where to checkpoint: the output file itself if it is a notebook"""
+    if to_format in ('ipynb', 'notebook'):
+        return output_fname
+    return os.path.splitext(output_fname)[0] + '.checkpoint.ipynb'
+
+
+def _dumps(obj):
+    # The same format as nbformat.writes()
+    return json.dumps(obj, sort_keys=True, indent=1, ensure_ascii=False,
+                      separators=(',', ': '))
+
+
+def _dumps_cell(cell):
+    """One cell as JSON, indented to go into the cells list"""
+    cell = split_lines(from_dict({'cells': [copy.deepcopy(cell)]})).cells[0]
+    cell.get('metadata', { }).pop('trusted', None)
+    return '\n'.join('  ' + line for line in _dumps(cell).split('\n'))
+
+
+def atomic_write(fname, text):
+    """Write text (or bytes) to fname by writing a temporary file and renaming it.
+
+    A new file gets the usual permissions (0666 minus the umask, applied
+    by open()), an existing one keeps its permissions.
+    """
+    dirname = os.path.dirname(fname) or '.'
+    tmp = os.path.join(dirname, '.%s.%s.tmp'%(os.path.basename(fname), uuid.uuid4().hex[:12]))
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        if isinstance(text, bytes):
+            f = io.open(fd, 'wb')
+        else:
+            f = io.open(fd, 'w', encoding='utf-8')
+        with f:
+            f.write(text)
+        if os.path.exists(fname):
+            shutil.copymode(fname, tmp)
+        os.rename(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Checkpointer(object):
+    """Execution listener which writes checkpoints of the notebook.
+
+    A checkpoint is written when `interval` seconds have passed since
+    the last one (checked when a cell ends or makes output), or after
+    every `every_cells` executed cells.
+
+    If `state` is true, checkpoints made at the end of a cell also save
+    the kernel state with dill (see `nbscript.resume`), so that the run
+    can be resumed with `nbscript --resume`.
+    """
+    def __init__(self, fname, interval=None, every_cells=None, state=False):
+        self.fname = fname
+        self.interval = interval
+        self.every_cells = every_cells
+        self.state = state
+        self._cache = { }   # cell index -> serialized cell
+        self._dirty = set()
+        self._last = time.time()
+        self._cells = 0
+
+    def cell_start(self, ep, cell, index):
+        self._dirty.add(index)
+
+    def cell_skipped(self, ep, cell, index):
+        self._dirty.add(index)
+
+    def cell_output(self, ep, out, index):
+        self._dirty.add(index)
+        if self.interval is not None and time.time() - self._last >= self.interval:
+            self.write(ep.nb)
+
+    def cell_end(self, ep, cell, index):
+        self._dirty.add(index)
+        self._cells += 1
+        if ((self.interval is not None and time.time() - self._last >= self.interval)
+                or (self.every_cells and self._cells >= self.every_cells)):
+            if self.state:
+                self.save_state(ep, index + 1)
+            self.write(ep.nb)
+
+    def save_state(self, ep, n_cells):
+        """Save the kernel state, covering the first n_cells cells"""
+        from . import resume
+        fname = resume.state_fname(self.fname)
+        try:
+            ep.run_code(resume.SAVE_STATE_CODE%os.path.abspath(fname))
+        except RuntimeError as e:
+            LOG.warning("Could not save kernel state, not trying again: %s", e)
+            self.state = False
+            ep.nb.metadata.get('nbscript', { }).pop('state', None)
+            return
+        meta = ep.nb.metadata.setdefault('nbscript', { })
+        meta['state'] = os.path.basename(fname)
+        meta['state_cells'] = n_cells
+
+    def serialize(self, nb):
+        """The notebook as JSON text, reusing the JSON of unchanged cells"""
+        cells = [ ]
+        for index, cell in enumerate(nb.cells):
+            if index in self._dirty or index not in self._cache:
+                self._cache[index] = _dumps_cell(cell)
+            cells.append(self._cache[index])
+        self._dirty.clear()
+        top = from_dict(copy.deepcopy(
+            dict((k, v) for k, v in nb.items() if k != 'cells')))
+        top['cells'] = [ ]
+        text = _dumps(strip_transient(top))
+        if cells:
+            text = text.replace('"cells": []',
+                                '"cells": [\n' + ',\n'.join(cells) + '\n ]', 1)
+        return text + '\n'
+
+    def write(self, nb):
+        """Write a checkpoint now"""
+        start = time.time()
+        atomic_write(self.fname, self.serialize(nb))
+        self._last = time.time()
+        self._cells = 0
+        LOG.debug('checkpoint written to %s in %.3fs', self.fname, self._last - start)
+
+    def remove(self):
+        """Remove the checkpoint file and its state"""
+        from . import resume
+        for fname in (self.fname, resume.state_fname(self.fname)):
+            if os.path.exists(fname):
+                os.unlink(fname)
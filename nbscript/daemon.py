@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""Warm kernel pool daemon.
+
+`nbscript-daemon` keeps a pool of already started (and optionally
+pre-imported) kernels and listens on a Unix socket.  `nbscript --daemon`
+sends it the notebook, output options and environment (NB_ARGV and so
+on), the daemon runs it in a fresh kernel from the pool, and the pool is
+refilled in the background.  Each kernel is used for only one notebook.
+
+Protocol: the client sends one JSON object on one line, the daemon
+replies with one JSON object on one line and closes the connection.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+LOG = logging.getLogger('nbscript.daemon')
+
+
+def default_socket():
+    """Socket path: $NBSCRIPT_DAEMON_SOCKET, else in the runtime dir"""
+    if os.environ.get('NBSCRIPT_DAEMON_SOCKET'):
+        return os.environ['NBSCRIPT_DAEMON_SOCKET']
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(rundir, 'nbscript-daemon-%d.sock'%os.getuid())
+
+
+def run_code(kc, code):
+    """Run code silently in a kernel, raise RuntimeError if it fails"""
+    reply = kc.execute_interactive(code, store_history=False,
+                                   output_hook=lambda msg: None)
+    content = reply['content']
+    if content['status'] != 'ok':
+        raise RuntimeError("Kernel code failed: %s: %s"%(content.get('ename'),
+                                                         content.get('evalue')))
+
+
+def setup_code(env, cwd):
+    """Code to make a pre-started kernel look like it was started by nbscript.
+
+    The environment is what `nbscript()` would pass to the kernel.  If
+    the nbscript module was already imported by the preload code, its
+    `argv` and `params` are read again.
+    """
+    return (
+        "def _nbscript_setup():\n"
+        "    import json, os, sys\n"
+        "    os.environ.update(json.loads(%r))\n"
+        "    os.chdir(%r)\n"
+        "    if 'nbscript.nbscript' in sys.modules:\n"
+        "        from nbscript import payload\n"
+        "        argv, params = payload.load_argv(), payload.lazy_params()\n"
+        "        for name in ('nbscript', 'nbscript.nbscript'):\n"
+        "            sys.modules[name].argv = argv\n"
+        "            sys.modules[name].params = params\n"
+        "_nbscript_setup()\n"
+        "del _nbscript_setup\n"
+        )%(json.dumps(env), cwd)
+
+
+class KernelPool(object):
+    """A pool of started kernels, refilled in a background thread"""
+    def __init__(self, size=2, kernel_name='python3', preload=None):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.preload = preload
+        self._kernels = queue.Queue()
+        self._wanted = queue.Queue()
+        for _ in range(size):
+            self._wanted.put(True)
+        self._thread = threading.Thread(target=self._refill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _start_kernel(self):
+        from jupyter_client import KernelManager
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel()
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=60)
+            if self.preload:
+                run_code(kc, self.preload)
+        except Exception:
+            km.shutdown_kernel(now=True)
+            raise
+        finally:
+            kc.stop_channels()
+        return km
+
+    def _refill(self):
+        while self._wanted.get():
+            try:
+                km = self._start_kernel()
+            except Exception:
+                LOG.exception("Starting pool kernel failed")
+                self._kernels.put(None)
+                continue
+            LOG.debug('pool kernel started')
+            self._kernels.put(km)
+
+    def get(self):
+        """Take a started kernel out of the pool and start a replacement"""
+        km = self._kernels.get()
+        self._wanted.put(True)
+        if km is None:
+            raise RuntimeError("Could not start a kernel, see daemon log")
+        return km
+
+    def shutdown(self):
+        """Stop refilling and shut down all idle kernels"""
+        self._wanted.put(False)
+        self._thread.join()
+        while True:
+            try:
+                km = self._kernels.get_nowait()
+            except queue.Empty:
+                break
+            if km is not None:
+                km.shutdown_kernel(now=True)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = None
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            reply = self.server.run_request(request)
+        except Exception as e:  # pylint: disable=broad-except
+            LOG.exception("Request failed: %s", request)
+            reply = {'returncode': 1, 'error': '%s: %s'%(type(e).__name__, e)}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class NbscriptDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server which runs notebooks in kernels from a KernelPool"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        self.socket_path = socket_path
+        self.pool = pool
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        os.chmod(socket_path, 0o600)
+
+    def run_request(self, request):
+        from . import execute
+        notebook = request['notebook']
+        nb = execute.read(notebook)
+        km = self.pool.get()
+        try:
+            kc = km.client()
+            kc.start_channels()
+            try:
+                run_code(kc, setup_code(request['env'], request['cwd']))
+            finally:
+                kc.stop_channels()
+            nb, resources = execute.execute(nb, notebook, km=km)
+        finally:
+            km.shutdown_kernel(now=True)
+        output_fname = request.get('output_fname')
+        reply = {'returncode': 0}
+        if output_fname is None:
+            reply['output'], _, _ = execute.convert(
+                nb, request['to_format'], None, notebook, resources=resources)
+        else:
+            execute.export(nb, request['to_format'], output_fname, notebook,
+                           resources=resources)
+        return reply
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.shutdown()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def submit(notebook, to_format, output_fname, env, socket_path=None):
+    """Run a notebook through the daemon (client side).  Returns an exit code.
+
+    Relative paths are made absolute, since the daemon has its own
+    working directory.
+    """
+    socket_path = socket_path or default_socket()
+    request = {
+        'notebook': os.path.abspath(notebook),
+        'to_format': to_format,
+        'output_fname': os.path.abspath(output_fname) if output_fname else None,
+        'cwd': os.path.dirname(os.path.abspath(notebook)),
+        'env': env,
+        }
+    LOG.debug('daemon request: %s', request)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (OSError, socket.error):
+        raise RuntimeError("No nbscript daemon listening on %s (start one with "
+                           "nbscript-daemon)"%socket_path)
+    try:
+        f = sock.makefile('rwb')
+        f.write(json.dumps(request).encode() + b'\n')
+        f.flush()
+        reply = json.loads(f.readline().decode())
+    finally:
+        sock.close()
+    if reply.get('output') is not None:
+        sys.stdout.write(reply['output'])
+        sys.stdout.flush()
+    if reply.get('error'):
+        LOG.error("nbscript daemon: %s", reply['error'])
+    return reply['returncode']
+
+
+def nbscript_daemon(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(usage="nbscript-daemon [options]")
+    parser.add_argument("--socket", default=None,
+                        help="Unix socket to listen on (default: %s)"%default_socket())
+    parser.add_argument("--pool-size", "-n", type=int, default=2,
+                        help="Number of kernels to keep started (default: %(default)s)")
+    parser.add_argument("--kernel", default='python3',
+                        help="Kernel name to start (default: %(default)s)")
+    parser.add_argument("--preload", default=None,
+                        help="Code to run in each kernel when it is started, "
+                             "for example 'import numpy, pandas'")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="Verbose")
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.lastResort.setLevel(logging.DEBUG)
+        LOG.setLevel(logging.DEBUG)
+    socket_path = args.socket or default_socket()
+    pool = KernelPool(size=args.pool_size, kernel_name=args.kernel,
+                      preload=args.preload)
+    server = NbscriptDaemon(socket_path, pool)
+    LOG.info("nbscript daemon listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    nbscript_daemon(argv=sys.argv[1:])
@@ -0,0 +1,139 @@
+"""Structured events of what nbscript and snotebook are doing.
+
+Events are dicts like::
+
+    {"event": "cell", "phase": "end", "t": 1234.5, "time": 1700000000.0,
+     "pid": 42, "index": 3, "duration": 0.25}
+
+`t` is a monotonic clock (for durations), `time` the wall clock.  Phases
+which take time (reading the notebook, kernel start, cells, export,
+writing) have a "start" and an "end" event, the end has the duration.
+If the event happens in a Slurm job, `slurm_job_id` is included.
+
+Events go to the registered callbacks::
+
+    import nbscript.events
+    nbscript.events.register(lambda event: print(event))
+
+`nbscript --events FILE`, `snotebook --events FILE` or the environment
+variable NBSCRIPT_EVENTS=FILE append them to a JSON-lines file.  The
+variable is inherited, so the jobs snotebook submits also write there.
+Events of the execution itself (kernel start, cells, export) come from
+`nbscript --inprocess` only: otherwise `jupyter nbconvert` runs in a
+subprocess, which is a single "nbconvert" span.
+When nothing is registered, emitting events costs almost nothing.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+ENV_VAR = 'NBSCRIPT_EVENTS'
+
+# A clock for durations (Python 2 has no monotonic clock).
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+_callbacks = [ ]
+_files = { }   # filename -> JsonlWriter
+
+
+def register(callback):
+    """Call callback(event) for each event"""
+    _callbacks.append(callback)
+
+
+def unregister(callback):
+    _callbacks.remove(callback)
+
+
+def emit(event, **fields):
+    """Send an event to all callbacks"""
+    if not _callbacks:
+        return
+    data = {'event': event, 't': clock(), 'time': time.time(),
+            'pid': os.getpid()}
+    if 'SLURM_JOB_ID' in os.environ:
+        data['slurm_job_id'] = os.environ['SLURM_JOB_ID']
+    data.update(fields)
+    for callback in list(_callbacks):
+        callback(data)
+
+
+@contextlib.contextmanager
+def span(event, **fields):
+    """Emit start and end events around a block"""
+    if not _callbacks:
+        yield
+        return
+    emit(event, phase='start', **fields)
+    start = clock()
+    try:
+        yield
+    except BaseException as e:
+        emit(event, phase='end', duration=clock() - start,
+             error=type(e).__name__, **fields)
+        raise
+    emit(event, phase='end', duration=clock() - start, **fields)
+
+
+class JsonlWriter(object):
+    """Callback which appends events to a JSON-lines file.
+
+    Each event is written with one write() to a file opened for
+    appending, so several processes can share the file.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self._fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = (json.dumps(event, default=str) + '\n').encode('utf-8')
+        with self._lock:
+            os.write(self._fd, line)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_file(fname):
+    """Write events to fname (once, even if called again)"""
+    fname = os.path.abspath(fname)
+    if fname not in _files:
+        _files[fname] = JsonlWriter(fname)
+        register(_files[fname])
+    return _files[fname]
+
+
+def close_file(fname):
+    writer = _files.pop(os.path.abspath(fname))
+    unregister(writer)
+    writer.close()
+
+
+def close_files():
+    for fname in list(_files):
+        close_file(fname)
+
+
+@contextlib.contextmanager
+def closing_files():
+    """Close the files opened during the block at its end"""
+    before = set(_files)
+    try:
+        yield
+    finally:
+        for fname in set(_files) - before:
+            close_file(fname)
+
+
+def setup(fname=None):
+    """Open the events file from an option or from $NBSCRIPT_EVENTS"""
+    fname = fname or os.environ.get(ENV_VAR)
+    if fname:
+        open_file(fname)
@@ -0,0 +1,416 @@
+"""In-process notebook execution.
+
+This does the same thing as `jupyter nbconvert --execute`, but inside
+the current Python interpreter: the notebook is read with nbformat,
+executed with nbconvert's ExecutePreprocessor (which drives a kernel
+client), and written with the exporter.  This avoids starting a second
+interpreter and the jupyter command line dispatch for every run.
+"""
+
+import logging
+import os
+import pickle
+import sys
+import traceback
+
+import nbformat
+import nbconvert
+from nbconvert.filters import strip_ansi
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbconvert.writers import FilesWriter, StdoutWriter
+from traitlets.config.loader import KVArgParseConfigLoader
+
+from . import events
+
+LOG = logging.getLogger('nbscript.execute')
+
+# Config of the nbconvert application, which isn't used in-process.
+APP_SECTIONS = ['NbConvertApp', 'FilesWriter', 'JupyterApp']
+
+
+class NbscriptExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor with the options nbscript always uses.
+
+    `kernel_env` is extra environment for the kernel.  Passing it to the
+    kernel launch (instead of setting os.environ) allows several
+    notebooks to be executed from different threads at once.
+
+    `listeners` are objects which are told about execution progress.
+    They may define any of these methods (`ep` is this preprocessor,
+    the notebook being executed is `ep.nb`):
+
+    - `prepare(nb)`: called by `execute()` before the kernel starts.
+
+    - `skip_cell(ep, cell, index)`: return True to not execute this
+      cell (the listener may fill in its outputs itself).  Skipped
+      cells get only a `cell_skipped(ep, cell, index)` call.
+    - `cell_start(ep, cell, index)`
+    - `cell_output(ep, out, index)`: an output was added to cell `index`
+    - `cell_end(ep, cell, index)`
+    - `finish(ep)`: after the last cell, before the kernel is shut down
+
+    `cell_start`, `cell_end` and `finish` may use `ep.run_code()`.
+    """
+    def __init__(self, kernel_env=None, listeners=(), **kwargs):
+        kwargs.setdefault('timeout', None)
+        kwargs.setdefault('allow_errors', True)
+        super(NbscriptExecutePreprocessor, self).__init__(**kwargs)
+        self.kernel_env = kernel_env
+        self.listeners = list(listeners)
+
+    def _notify(self, name, *args):
+        for listener in self.listeners:
+            method = getattr(listener, name, None)
+            if method is not None:
+                method(self, *args)
+
+    def _add_kernel_env(self, kwargs):
+        if self.kernel_env is not None and 'env' not in kwargs:
+            env = dict(os.environ)
+            env.update(self.kernel_env)
+            kwargs['env'] = env
+        return kwargs
+
+    # Both are needed, since the sync version doesn't call the async one
+    # through self.
+    def start_new_kernel(self, **kwargs):
+        with events.span('kernel_start'):
+            return super(NbscriptExecutePreprocessor, self).start_new_kernel(
+                **self._add_kernel_env(kwargs))
+
+    async def async_start_new_kernel(self, **kwargs):
+        with events.span('kernel_start'):
+            return await super(NbscriptExecutePreprocessor, self).async_start_new_kernel(
+                **self._add_kernel_env(kwargs))
+
+    def run_code(self, code):
+        """Run code silently in the kernel, between cells.
+
+        Raises RuntimeError if the code fails.
+        """
+        msg_id = self.kc.execute(code, silent=True, store_history=False)
+        reply = self.wait_for_reply(msg_id)
+        content = reply['content']
+        if content['status'] != 'ok':
+            raise RuntimeError("Kernel code failed: %s: %s"%(content.get('ename'),
+                                                             content.get('evalue')))
+        return reply
+
+    def preprocess_cell(self, cell, resources, index):
+        result = self._preprocess_cell(cell, resources, index)
+        if index == len(self.nb.cells) - 1:
+            self._notify('finish')
+        return result
+
+    def _preprocess_cell(self, cell, resources, index):
+        for listener in self.listeners:
+            skip_cell = getattr(listener, 'skip_cell', None)
+            if skip_cell is not None and skip_cell(self, cell, index):
+                self._notify('cell_skipped', cell, index)
+                events.emit('cell', phase='skipped', index=index)
+                return cell, resources
+        self._notify('cell_start', cell, index)
+        try:
+            with events.span('cell', index=index, cell_type=cell.cell_type):
+                return super(NbscriptExecutePreprocessor, self).preprocess_cell(
+                    cell, resources, index)
+        finally:
+            self._notify('cell_end', cell, index)
+
+    def output(self, outs, msg, display_id, cell_index):
+        out = super(NbscriptExecutePreprocessor, self).output(
+            outs, msg, display_id, cell_index)
+        if out is not None:
+            self._notify('cell_output', out, cell_index)
+        return out
+
+
+class StreamListener(object):
+    """Write each cell and its outputs to a stream as they are produced.
+
+    The format is like nbconvert's asciidoc output.  If `keep_outputs`
+    is false, outputs are dropped from the notebook after each cell is
+    done, so memory use doesn't grow with the output.
+    """
+    def __init__(self, stream=None, keep_outputs=True):
+        self.stream = stream if stream is not None else sys.stdout
+        self.keep_outputs = keep_outputs
+        self._count = 0
+        self._out_open = False
+
+    def _write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def cell_start(self, ep, cell, index):
+        self._out_open = False
+        if cell.cell_type == 'markdown':
+            self._write(cell.source + '\n\n\n')
+        if cell.cell_type != 'code' or not cell.source.strip():
+            return
+        self._count += 1
+        self._write('+*In[%d]:*+\n[source, ipython3]\n----\n%s\n----\n\n\n'%(
+            self._count, cell.source))
+
+    def cell_output(self, ep, out, index):
+        if not self._out_open:
+            self._write('+*Out[%d]:*+\n----\n'%self._count)
+            self._out_open = True
+        self._write(format_output(out))
+
+    def cell_end(self, ep, cell, index):
+        if self._out_open:
+            self._write('----\n\n\n')
+            self._out_open = False
+        if not self.keep_outputs and cell.cell_type == 'code':
+            cell.outputs = [ ]
+
+
+def format_output(out):
+    """Plain text form of one output, for streaming"""
+    if out.output_type == 'stream':
+        return out.text
+    if out.output_type == 'error':
+        return strip_ansi('\n'.join(out.traceback)) + '\n'
+    data = out.get('data', { })
+    if 'text/plain' in data:
+        text = data['text/plain']
+    else:
+        text = '<%s>'%', '.join(sorted(data))
+    if not text.endswith('\n'):
+        text += '\n'
+    return text
+
+
+def load_config(nbconvert_args):
+    """Turn extra command line args into a Config.
+
+    These are nbconvert's options: --Class.trait=value, and its flags
+    and aliases (like --allow-errors or --template NAME).  Options of
+    the nbconvert application itself (where and how to write) don't
+    apply, those raise ValueError.
+    """
+    from nbconvert.nbconvertapp import NbConvertApp
+    loader = KVArgParseConfigLoader(nbconvert_args, aliases=NbConvertApp.aliases,
+                                    flags=NbConvertApp.flags)
+    try:
+        config = loader.load_config()
+    except SystemExit:
+        raise ValueError("nbconvert options not understood: %s"%' '.join(nbconvert_args))
+    unsupported = sorted(set(config) & set(APP_SECTIONS))
+    if loader.extra_args or unsupported:
+        raise ValueError("nbconvert options %s only work when running `jupyter nbconvert` "
+                         "(not with --inprocess or the options which imply it)"%(
+                             ' '.join(loader.extra_args + unsupported)))
+    return config
+
+
+def read(notebook):
+    """Read a notebook (as version 4)"""
+    with events.span('read', notebook=notebook):
+        return nbformat.read(notebook, as_version=4)
+
+
+def execute(nb, notebook, config=None, km=None, env=None, listeners=(),
+            preprocessor_class=NbscriptExecutePreprocessor):
+    """Execute a notebook node in place.
+
+    The kernel is started in the directory of the notebook file, like
+    `nbconvert --execute` does, with `env` added to its environment.  If
+    `km` (an already started kernel manager) is given, use that kernel
+    instead and leave it running.
+    """
+    path = os.path.dirname(notebook) or '.'
+    resources = {'metadata': {'path': path}}
+    for listener in listeners:
+        prepare = getattr(listener, 'prepare', None)
+        if prepare is not None:
+            prepare(nb)
+    ep = preprocessor_class(config=config, kernel_env=env, listeners=listeners)
+    with events.span('execute', notebook=notebook, cells=len(nb.cells)):
+        nb, resources = ep.preprocess(nb, resources, km=km)
+    return nb, resources
+
+
+def convert(nb, to_format, output_fname, notebook, resources=None, config=None):
+    """Convert an executed notebook with the exporter for `to_format`.
+
+    Returns (output, resources, notebook_name), where notebook_name is
+    the output file name without the extension the writer adds.
+    """
+    exporter = nbconvert.exporters.get_exporter(to_format)(config=config)
+    basename = os.path.splitext(os.path.basename(notebook))[0]
+    if output_fname is not None:
+        notebook_name, ext = os.path.splitext(output_fname)
+        # nbconvert only strips the extension if it is the exporter's.
+        if ext != exporter.file_extension:
+            notebook_name = output_fname
+        output_files_dir = notebook_name + '_files'
+    else:
+        notebook_name = None
+        output_files_dir = basename + '_files'
+    resources = dict(resources or { })
+    resources['unique_key'] = basename
+    resources['output_files_dir'] = output_files_dir
+    with events.span('export', format=to_format):
+        output, resources = exporter.from_notebook_node(nb, resources=resources)
+    return output, resources, notebook_name
+
+
+def export(nb, to_format, output_fname, notebook, resources=None, config=None):
+    """Export an executed notebook to stdout or to a file.
+
+    If `output_fname` is None, write to stdout.  Otherwise the file is
+    named like `nbconvert --output-dir=. --output=output_fname` would.
+    """
+    output, resources, notebook_name = convert(
+        nb, to_format, output_fname, notebook, resources=resources,
+        config=config)
+    if output_fname is None:
+        sys.stdout.flush()
+        StdoutWriter(config=config).write(output, resources)
+        sys.stdout.flush()
+        return None
+    writer = FilesWriter(config=config, build_directory='.')
+    with events.span('write', format=to_format, output=output_fname):
+        return writer.write(output, resources, notebook_name=notebook_name)
+
+
+def _fork_exports(nb, exports, notebook, resources=None, config=None):
+    """Run each export in its own forked process, return the failed
+    output filenames"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pids = { }
+    for to_format, output_fname in exports:
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                export(nb, to_format, output_fname, notebook, resources=resources,
+                       config=config)
+                status = 0
+            except BaseException:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)  # pylint: disable=protected-access
+        pids[pid] = output_fname
+    failed = [ ]
+    for pid, output_fname in pids.items():
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            failed.append(output_fname)
+    return failed
+
+
+class ExportForker(object):
+    """A process which forks the exports of a run.
+
+    Forking a process with threads can deadlock the child (a lock held
+    by another thread stays locked), and once a kernel client has run,
+    zmq has its I/O threads.  So this process is forked when created,
+    before the kernel starts, and waits for the executed notebook
+    through a pipe.
+    """
+    def __init__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        job_r, self._job_w = os.pipe()
+        self._result_r, result_w = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                os.close(self._job_w)
+                os.close(self._result_r)
+                with os.fdopen(job_r, 'rb') as f:
+                    data = f.read()
+                if data:    # otherwise not used
+                    failed = _fork_exports(**pickle.loads(data))
+                    with os.fdopen(result_w, 'wb') as f:
+                        f.write(pickle.dumps(failed))
+                status = 0
+            except BaseException:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)  # pylint: disable=protected-access
+        os.close(job_r)
+        os.close(result_w)
+
+    def run(self, nb, exports, notebook, resources=None, config=None):
+        """Export in the forked process, return the failed output filenames"""
+        data = pickle.dumps(dict(nb=nb, exports=exports, notebook=notebook,
+                                 resources=resources, config=config))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with os.fdopen(self._job_w, 'wb') as f:
+            f.write(data)
+        self._job_w = None
+        with os.fdopen(self._result_r, 'rb') as f:
+            result = f.read()
+        self._result_r = None
+        self.close()
+        if not result:
+            return [output_fname for _, output_fname in exports]
+        return pickle.loads(result)
+
+    def close(self):
+        """Stop the process (if it wasn't used)"""
+        for fd in (self._job_w, self._result_r):
+            if fd is not None:
+                os.close(fd)
+        self._job_w = self._result_r = None
+        if self.pid is not None:
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+
+def export_all(nb, exports, notebook, resources=None, config=None, forker=None):
+    """Export to several (to_format, output_fname) at once.
+
+    With an ExportForker, each export runs in its own forked process,
+    which inherit the executed notebook.  Otherwise they run one by one.
+    """
+    if forker is None or len(exports) < 2:
+        for to_format, output_fname in exports:
+            export(nb, to_format, output_fname, notebook, resources=resources, config=config)
+        return
+    failed = forker.run(nb, exports, notebook, resources=resources, config=config)
+    if failed:
+        raise RuntimeError("Exporting failed: %s"%', '.join(failed))
+
+
+def run(notebook, to_format, output_fname, nbconvert_args=(), stream=False,
+        listeners=(), exports=()):
+    """Read, execute, and export a notebook.  Returns an exit code.
+
+    If `stream` is true, cells and outputs are printed to stdout while
+    running.  The notebook is then only exported if there is an
+    `output_fname`, otherwise outputs are not kept at all.  `listeners`
+    are passed to NbscriptExecutePreprocessor.  `exports` are other
+    (to_format, output_fname) to export the same execution to.
+    """
+    config = load_config(list(nbconvert_args))
+    nb = read(notebook)
+    LOG.debug('executing %s in-process', notebook)
+    listeners = list(listeners)
+    if stream:
+        listeners.append(StreamListener(keep_outputs=output_fname is not None))
+    forker = None
+    if exports and hasattr(os, 'fork') and not (stream and output_fname is None):
+        # Now, while there are no threads, see ExportForker.
+        forker = ExportForker()
+    try:
+        nb, resources = execute(nb, notebook, config=config, listeners=listeners)
+        if stream and output_fname is None:
+            return 0
+        export_all(nb, [(to_format, output_fname)] + list(exports), notebook,
+                   resources=resources, config=config, forker=forker)
+    finally:
+        if forker is not None:
+            forker.close()
+    return 0
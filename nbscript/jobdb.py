@@ -0,0 +1,321 @@
+"""Tracking of submitted snotebook jobs.
+
+When snotebook submits a job with sbatch, the job ID is saved in a
+small SQLite database (by default in ~/.local/share/nbscript/).
+`snotebook status` and `snotebook wait` then check all tracked jobs
+which haven't finished yet with a single `sacct` call, instead of one
+squeue/sacct call per job.  sacct isn't called more often than every
+`min_interval` seconds: the last time is saved in the database, so
+this holds also between several snotebook processes, which use the
+cached states in the meantime.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+
+LOG = logging.getLogger('nbscript.jobdb')
+
+# Job states after which the job won't change anymore.  All others
+# (PENDING, RUNNING, REQUEUED, ...) are considered active.  PREEMPTED
+# isn't final: a job with --requeue (snotebook --auto-resume) comes back.
+FINISHED_STATES = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY',
+                   'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE'}
+
+# State of a job which sacct hasn't reported yet.
+SUBMITTED = 'SUBMITTED'
+
+# At most this many job IDs per sacct command line.
+SACCT_MAX_JOBS = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    notebook TEXT,
+    output TEXT,
+    log TEXT,
+    cwd TEXT,
+    submitted REAL,
+    state TEXT,
+    exit_code TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS packed (
+    job_id TEXT,
+    notebook TEXT,
+    output TEXT,
+    log TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_db():
+    """$NBSCRIPT_JOBDB, or $XDG_DATA_HOME/nbscript/jobs.sqlite"""
+    if os.environ.get('NBSCRIPT_JOBDB'):
+        return os.environ['NBSCRIPT_JOBDB']
+    base = (os.environ.get('XDG_DATA_HOME')
+            or os.path.join(os.path.expanduser('~'), '.local', 'share'))
+    return os.path.join(base, 'nbscript', 'jobs.sqlite')
+
+
+def parse_job_id(sbatch_output):
+    """Job ID from the output of sbatch (normal or --parsable), or None"""
+    m = re.search(r'^Submitted batch job (\d+)', sbatch_output, re.M)
+    if m:
+        return m.group(1)
+    m = re.match(r'^(\d+)(;\S*)?\s*$', sbatch_output)
+    if m:
+        return m.group(1)
+    return None
+
+
+def is_finished(state):
+    return state is not None and state in FINISHED_STATES
+
+
+def _summarize(states):
+    """One (state, exit_code) for all lines of a job (array tasks)"""
+    active = [s for s in states if not is_finished(s[0])]
+    if active:
+        running = [s for s in active if s[0] == 'RUNNING']
+        return (running or active)[0]
+    failed = [s for s in states if s[0] != 'COMPLETED']
+    return (failed or states)[0]
+
+
+def query_sacct(job_ids, starttime=None):
+    """States of jobs from sacct, returns {job_id: (state, exit_code)}.
+
+    Jobs sacct doesn't know (yet) aren't included.  Raises
+    subprocess.CalledProcessError or OSError if sacct fails.  Array jobs are
+    summarized: running if any task is running, else pending if any
+    is, else failed if any task failed.
+    """
+    lines = { }
+    job_ids = list(job_ids)
+    for i in range(0, len(job_ids), SACCT_MAX_JOBS):
+        cmd = ['sacct', '--allocations', '--noheader', '--parsable2',
+               '--format=JobID,State,ExitCode',
+               '--jobs='+','.join(job_ids[i:i+SACCT_MAX_JOBS])]
+        if starttime is not None:
+            cmd.append('--starttime='+datetime.datetime.fromtimestamp(starttime)
+                       .strftime('%Y-%m-%dT%H:%M:%S'))
+        LOG.debug('running %s', cmd)
+        output = subprocess.check_output(cmd).decode('utf-8', 'replace')
+        for line in output.splitlines():
+            fields = line.split('|')
+            if len(fields) < 3:
+                continue
+            job_id = re.split(r'[_+.]', fields[0], 1)[0]
+            # "CANCELLED by 1234"
+            state = fields[1].split()[0] if fields[1].strip() else 'UNKNOWN'
+            lines.setdefault(job_id, [ ]).append((state, fields[2]))
+    return dict((job_id, _summarize(states)) for job_id, states in lines.items())
+
+
+class JobDB(object):
+    """The database of tracked jobs"""
+    def __init__(self, path=None):
+        self.path = path or default_db()
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, job_id, notebook=None, output=None, log=None, cwd=None):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, notebook, output, log, cwd, "
+                "submitted, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, notebook, output, log, cwd, time.time(), SUBMITTED, time.time()))
+
+    def add_packed(self, job_id, notebook=None, output=None, log=None):
+        """Another notebook of a packed job (snotebook --pack), whose
+        first notebook was added with add()"""
+        with self.conn:
+            self.conn.execute("INSERT INTO packed (job_id, notebook, output, log) "
+                              "VALUES (?, ?, ?, ?)", (job_id, notebook, output, log))
+
+    def packed(self, job_id):
+        """The other notebooks of a packed job (sqlite3.Row)"""
+        return self.conn.execute("SELECT * FROM packed WHERE job_id = ? ORDER BY rowid",
+                                 (job_id,)).fetchall()
+
+    def jobs(self, job_ids=None, active=False):
+        """Tracked jobs (sqlite3.Row), oldest first"""
+        rows = self.conn.execute("SELECT * FROM jobs ORDER BY submitted").fetchall()
+        if job_ids:
+            job_ids = set(job_ids)
+            rows = [row for row in rows if row['job_id'] in job_ids]
+        if active:
+            rows = [row for row in rows if not is_finished(row['state'])]
+        return rows
+
+    def forget(self, job_ids):
+        with self.conn:
+            for table in ('jobs', 'packed'):
+                self.conn.executemany("DELETE FROM %s WHERE job_id = ?"%table,
+                                      [(job_id,) for job_id in job_ids])
+
+    def refresh(self, min_interval=30):
+        """Update the states of active jobs with one sacct call.
+
+        Does nothing if the last call was less than min_interval seconds
+        ago.  Returns True if sacct was called successfully.  If it
+        fails, the stored states are kept and the next call tries again.
+        """
+        now = time.time()
+        # BEGIN IMMEDIATE: only one process checks and updates last_poll.
+        self.conn.isolation_level = None
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'last_poll'").fetchone()
+            if row is not None and now - float(row[0]) < min_interval:
+                self.conn.execute("ROLLBACK")
+                return False
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_poll', ?)", (repr(now),))
+            self.conn.execute("COMMIT")
+        finally:
+            self.conn.isolation_level = ''
+        active = self.jobs(active=True)
+        if not active:
+            return True
+        try:
+            states = query_sacct([row['job_id'] for row in active],
+                                 starttime=min(row['submitted'] for row in active) - 86400)
+        except (subprocess.CalledProcessError, OSError) as e:
+            LOG.warning("Checking job states with sacct failed: %s", e)
+            # The poll didn't happen, don't make others wait for it.
+            with self.conn:
+                if row is None:
+                    self.conn.execute("DELETE FROM meta WHERE key = 'last_poll'")
+                else:
+                    self.conn.execute("UPDATE meta SET value = ? WHERE key = 'last_poll' "
+                                      "AND value = ?", (row[0], repr(now)))
+            return False
+        with self.conn:
+            for job_id, (state, exit_code) in states.items():
+                self.conn.execute("UPDATE jobs SET state = ?, exit_code = ?, updated = ? "
+                                  "WHERE job_id = ?", (state, exit_code, now, job_id))
+        return True
+
+
+def record_submission(sbatch_output, cmd_submit, cmd_nbscript, db=None):
+    """Save the job sbatch just submitted in the job database
+
+    `cmd_nbscript` is the nbscript command the job runs, or a list of
+    them for a packed job.
+    """
+    from . import nbscript
+    job_id = parse_job_id(sbatch_output)
+    if job_id is None:
+        LOG.warning("Could not find the job ID in sbatch output: %r", sbatch_output)
+        return None
+    log = None
+    for arg in cmd_submit:
+        if arg.startswith('--output='):
+            log = os.path.abspath(arg.split('=', 1)[1])
+    pack = isinstance(cmd_nbscript[0], list)
+    db = db or JobDB()
+    for i, cmd in enumerate(cmd_nbscript if pack else [cmd_nbscript]):
+        names = nbscript.nbscript(cmd[1:], _return_names=True)
+        output = names['output_fname_before_timestamp'] or names['output_fname']
+        output = os.path.abspath(output) if output else None
+        notebook = os.path.abspath(names['args'].notebook)
+        if pack:
+            # Each notebook of a pack has its own log, see snotebook.pack_job.
+            log = output + '.log'
+        if i == 0:
+            db.add(job_id, notebook=notebook, output=output, log=log, cwd=os.getcwd())
+        else:
+            db.add_packed(job_id, notebook=notebook, output=output, log=log)
+    LOG.debug('tracking job %s in %s', job_id, db.path)
+    return job_id
+
+
+def print_jobs(db, rows, stream=None):
+    """Print jobs, with a line for each notebook of packed jobs"""
+    stream = stream or sys.stdout
+    stream.write('%-12s %-14s %-6s %s\n'%('JOBID', 'STATE', 'EXIT', 'NOTEBOOK'))
+    for row in rows:
+        for notebook in [row['notebook']] + [p['notebook'] for p in db.packed(row['job_id'])]:
+            stream.write('%-12s %-14s %-6s %s\n'%(row['job_id'], row['state'],
+                                                  row['exit_code'] or '', notebook))
+
+
+def main(argv):
+    """`snotebook status` and `snotebook wait`"""
+    parser = argparse.ArgumentParser(prog='snotebook',
+                                     description="Check the state of submitted jobs.")
+    parser.add_argument("command", choices=['status', 'wait'],
+                        help="status: print the states of jobs.  wait: wait "
+                             "until they have finished, return nonzero if any "
+                             "didn't complete successfully.")
+    parser.add_argument("job_ids", nargs='*', metavar="JOBID",
+                        help="Only these jobs (default all tracked jobs).")
+    parser.add_argument("--active", action='store_true',
+                        help="status: only jobs which haven't finished.")
+    parser.add_argument("--forget-finished", action='store_true',
+                        help="status: stop tracking the finished jobs after printing them.")
+    parser.add_argument("--interval", type=float, default=60,
+                        help="Minimum seconds between sacct calls (default %(default)s).")
+    parser.add_argument("--missing-timeout", type=float, default=600, metavar="SECONDS",
+                        help="wait: stop waiting for jobs which sacct still hasn't "
+                             "reported this long after they were submitted "
+                             "(default %(default)s).")
+    parser.add_argument("--db", help="Job database (default %s)"%default_db())
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="Verbose.")
+    if hasattr(parser, 'parse_intermixed_args'):
+        args = parser.parse_intermixed_args(argv)
+    else:
+        # Python < 3.7: job IDs after options are left over.
+        args, rest = parser.parse_known_args(argv)
+        if any(arg.startswith('-') for arg in rest):
+            parser.error("unrecognized arguments: %s"%' '.join(rest))
+        args.job_ids += rest
+    if args.verbose:
+        LOG.setLevel(logging.DEBUG)
+
+    db = JobDB(args.db)
+    if args.job_ids:
+        unknown = set(args.job_ids) - set(row['job_id'] for row in db.jobs(args.job_ids))
+        if unknown:
+            LOG.error("Jobs not tracked: %s", ' '.join(sorted(unknown)))
+            return 2
+    if args.command == 'status':
+        db.refresh(min_interval=args.interval)
+        rows = db.jobs(args.job_ids, active=args.active)
+        print_jobs(db, rows)
+        if args.forget_finished:
+            db.forget([row['job_id'] for row in rows if is_finished(row['state'])])
+        return 0
+    while True:
+        db.refresh(min_interval=args.interval)
+        active = db.jobs(args.job_ids, active=True)
+        missing = [row['job_id'] for row in active if row['state'] == SUBMITTED
+                   and time.time() - row['submitted'] > args.missing_timeout]
+        if len(missing) == len(active):
+            if missing:
+                LOG.warning("sacct doesn't know jobs %s, not waiting for them",
+                            ' '.join(missing))
+            break
+        time.sleep(args.interval)
+    rows = db.jobs(args.job_ids)
+    print_jobs(db, rows)
+    return 0 if all(row['state'] == 'COMPLETED' for row in rows) else 1
@@ -0,0 +1,268 @@
+"""Static analysis of the names code cells define and use.
+
+This is only an approximation: it sees assignments, imports, function
+and class definitions, and in-place changes like `x[0] = 1` or
+`x.a += 1` (which count as defining `x`).  Objects which a method is
+called on or which are passed to a function (`x.append(1)`, `f(x)`)
+may be changed in place too, so `analyze()` counts them as mutated.
+Changes to other objects the code reaches (aliases, objects inside
+containers, other modules) aren't seen.
+
+Names which functions (and methods of classes) read or assign with
+`global` when they are called are kept separately, so that a cell
+calling a function can be counted as using them.
+"""
+
+import ast
+import collections
+import re
+
+# IPython line magics and shell escapes, which aren't Python syntax.
+_MAGIC_RE = re.compile(r'^(\s*)[%!].*$', re.M)
+
+
+def parse(source):
+    """Parse cell source, or return None if it isn't (almost) Python.
+
+    Line magics and `!` shell commands are replaced with `pass`.  Cells
+    with cell magics (`%%`) can't be analyzed.
+    """
+    if source.lstrip().startswith('%%'):
+        return None
+    try:
+        return ast.parse(_MAGIC_RE.sub(r'\1pass', source))
+    except SyntaxError:
+        return None
+
+
+class _Defined(ast.NodeVisitor):
+    def __init__(self):
+        self.names = set()
+
+    def _base(self, target):
+        while isinstance(target, (ast.Subscript, ast.Attribute)):
+            target = target.value
+        if isinstance(target, ast.Name):
+            self.names.add(target.id)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, (ast.Store, ast.Del)):
+            self.names.add(node.id)
+
+    def visit_Assign(self, node):
+        for target in node.targets:
+            self._base(target)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self._base(node.target)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        # The body is another scope.
+        self.names.add(node.name)
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.names.add((alias.asname or alias.name).split('.')[0])
+    visit_ImportFrom = visit_Import
+
+    def visit_Lambda(self, node):
+        pass
+    # Comprehension variables are local to the comprehension.
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_Lambda
+
+
+def defined_names(source):
+    """Set of global names a cell (re)defines, or None if unknown.
+
+    `from x import *` also makes the result unknown.
+    """
+    tree = parse(source)
+    if tree is None:
+        return None
+    visitor = _Defined()
+    visitor.visit(tree)
+    if '*' in visitor.names:
+        return None
+    return visitor.names
+
+
+# defined: names the cell (re)defines.  used: global names it reads
+# before assigning them.  referenced: all global names it reads.
+# functions: {name: (reads, writes)} of the functions and classes it
+# defines, for when they are called (writes are the globals they
+# assign or mutate).  mutated: names of objects it may change in place
+# through calls.  modules: names it binds with import.
+CellNames = collections.namedtuple('CellNames',
+                                   'defined used referenced functions mutated modules')
+
+
+def _arg_names(args):
+    names = [a.arg for a in args.args + args.kwonlyargs + getattr(args, 'posonlyargs', [ ])]
+    names += [a.arg for a in (args.vararg, args.kwarg) if a is not None]
+    return set(names)
+
+
+def _function_names(node, body):
+    """(free names read, global names written) of a function"""
+    reads = _Reads()
+    for stmt in body:
+        reads.visit(stmt)
+    declared = set()
+    stores = set()
+    for sub in ast.walk(node):
+        if isinstance(sub, ast.Global):
+            declared.update(sub.names)
+        elif isinstance(sub, ast.Name) and isinstance(sub.ctx, (ast.Store, ast.Del)):
+            stores.add(sub.id)
+    local = _arg_names(node.args) | (stores - declared)
+    for inner_reads, inner_writes in reads.functions.values():
+        reads.reads |= inner_reads
+        declared |= inner_writes
+    return reads.reads - local, declared | (reads.mutated - local)
+
+
+class _Reads(ast.NodeVisitor):
+    """Names a statement reads when it runs, and its functions"""
+    def __init__(self):
+        self.reads = set()
+        self.functions = { }
+        self.mutated = set()
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+
+    def _mutate(self, node):
+        while isinstance(node, (ast.Subscript, ast.Attribute, ast.Starred)):
+            node = node.value
+        if isinstance(node, ast.Name):
+            self.mutated.add(node.id)
+
+    def visit_Call(self, node):
+        # The object a method is called on and the arguments may be
+        # changed in place.
+        if isinstance(node.func, ast.Attribute):
+            self._mutate(node.func.value)
+        for arg in node.args + [k.value for k in node.keywords]:
+            self._mutate(arg)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        target = node.target
+        while isinstance(target, (ast.Subscript, ast.Attribute)):
+            target = target.value
+        if isinstance(target, ast.Name):
+            self.reads.add(target.id)
+        self.generic_visit(node)
+
+    def _defaults(self, node):
+        for default in node.args.defaults + [d for d in node.args.kw_defaults if d is not None]:
+            self.visit(default)
+
+    def visit_FunctionDef(self, node):
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self._defaults(node)
+        self.functions[node.name] = _function_names(node, node.body)
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        # Usually called right away, count it as read now.
+        self._defaults(node)
+        reads, _ = _function_names(node, [ast.Expr(node.body)])
+        self.reads |= reads
+
+    def visit_ClassDef(self, node):
+        for child in node.decorator_list + node.bases + [k.value for k in node.keywords]:
+            self.visit(child)
+        body = _Reads()
+        for stmt in node.body:
+            body.visit(stmt)
+        self.reads |= body.reads
+        self.mutated |= body.mutated
+        reads, writes = set(), set()
+        for method_reads, method_writes in body.functions.values():
+            reads |= method_reads
+            writes |= method_writes
+        self.functions[node.name] = (reads, writes)
+
+    def _comprehension(self, node, parts):
+        targets = set()
+        body = _Reads()
+        for gen in node.generators:
+            for sub in ast.walk(gen.target):
+                if isinstance(sub, ast.Name):
+                    targets.add(sub.id)
+            body.visit(gen.iter)
+            for cond in gen.ifs:
+                body.visit(cond)
+        for part in parts:
+            body.visit(part)
+        self.reads |= body.reads - targets
+        self.mutated |= body.mutated - targets
+        self.functions.update(body.functions)
+
+    def visit_ListComp(self, node):
+        self._comprehension(node, [node.elt])
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self._comprehension(node, [node.key, node.value])
+
+
+def analyze(source):
+    """CellNames of a cell, or None if it can't be analyzed"""
+    tree = parse(source)
+    if tree is None:
+        return None
+    defined = set()
+    used = set()
+    referenced = set()
+    functions = { }
+    mutated = set()
+    modules = set()
+    for stmt in tree.body:
+        reads = _Reads()
+        reads.visit(stmt)
+        used |= reads.reads - defined
+        referenced |= reads.reads
+        functions.update(reads.functions)
+        mutated |= reads.mutated
+        visitor = _Defined()
+        visitor.visit(stmt)
+        defined |= visitor.names
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            modules |= visitor.names
+    if '*' in defined:
+        return None
+    return CellNames(defined, used, referenced, functions, mutated, modules)
+
+
+def effects(info, functions, modules=(), mutations=True):
+    """(reads, writes) of a cell, including those of the functions it calls.
+
+    `functions` is the {name: (reads, writes)} of all functions the cell
+    may call.  Objects the cell (or the functions) may change in place
+    count as written, unless `mutations` is false.  Names in `modules`
+    (imported modules) never do: calling a module's functions doesn't
+    count as changing it.
+    """
+    reads = set(info.used)
+    writes = set(info.mutated) if mutations else set()
+    todo = [n for n in info.referenced if n in functions]
+    seen = set()
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        func_reads, func_writes = functions[name]
+        reads |= func_reads
+        writes |= func_writes
+        todo.extend(n for n in func_reads if n in functions)
+    writes -= set(modules)
+    return reads, writes | info.defined
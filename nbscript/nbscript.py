@@ -11,8 +11,8 @@ import subprocess
 import sys
 import time
 
-import nbformat
-import nbconvert
+from . import payload
+
 
 LOG = logging.getLogger('nbscript')
 LOG.setLevel(logging.DEBUG)
@@ -32,10 +32,11 @@ FORMAT_MAP = {v: k for k, v in EXT_MAP.items()}
 
 
 
-if 'NB_ARGV' in os.environ:
-    argv = json.loads(os.environ['NB_ARGV'])
-else:
-    argv = None
+# The notebook's argv, and its parameters (read when first used), see
+# nbscript.payload.
+argv = payload.load_argv()
+params = payload.lazy_params()
+
 
 def is_active():
     """Detect if nbscript is running this Python interperter"""
@@ -45,15 +46,31 @@ def is_active():
 
 
 def output_filename():
-    """Returns filename for --save, or None.
+    """Returns the absolute filename for --save, or None.
 
     This is a convenience method for saving other output files, such as
     the state.  Note that relying on it too much can lead to
     complexity, since it is a abstraction layer violation!
     """
-    if 'NBSCRIPT_OUTPUT_FILENAME' in os.environ:
-        return
-    os.environ['NBSCRIPT_OUTPUT_FILENAME']
+    return os.environ.get('NBSCRIPT_OUTPUT_FILENAME')
+
+
+def _non_negative(type_):
+    """argparse type: a number of this type which is at least zero"""
+    def convert(value):
+        value = type_(value)
+        if value < 0:
+            raise argparse.ArgumentTypeError("must not be negative: %s"%value)
+        return value
+    return convert
+
+
+def _positive(value):
+    """argparse type: an integer which is at least one"""
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %s"%value)
+    return value
 
 
 @contextlib.contextmanager
@@ -63,19 +80,42 @@ def setenv_context(mapping):
     for key, value in mapping.items():
         old[key] = os.environ.get(key)
         os.environ[key] = value
-    yield
-    for key, value in old.items():
-        if value is None:   del os.environ[key]
-        else:               os.environ[key] = old[key]
+    try:
+        yield
+    finally:
+        for key, value in old.items():
+            if value is None:   del os.environ[key]
+            else:               os.environ[key] = old[key]
 
 
 def nbscript(argv=sys.argv[1:], _return_names=False):
+    from . import events
+    # An events file opened for this run isn't written to after it.
+    with events.closing_files():
+        return _nbscript(argv, _return_names=_return_names)
+
+
+def _nbscript(argv, _return_names=False):
+    from .events import clock
+    start_time = clock()
     if os.environ.get('NBSCRIPT_RUNNING') is not None:
         LOG.critical("Detected that we are already in snotebook... not executing again.")
         sys.exit(0)
 
-    parser_outer = argparse.ArgumentParser(usage="nbscript [nbscript and nbconvert args] notebook [nb_argv ...]")
-    parser_outer.add_argument("--to", help="Convert to this format (same as nbconvert --to option).")
+    # `nbscript pipeline PIPELINE` runs a pipeline of notebooks, and its
+    # stages run nbscript with NBSCRIPT_PIPELINE_STAGE set.
+    if argv and argv[0] == 'pipeline':
+        from . import pipeline
+        return pipeline.main(argv[1:])
+    if os.environ.get('NBSCRIPT_PIPELINE_STAGE') and not _return_names:
+        from . import pipeline
+        return pipeline.run_stage(argv)
+
+    parser_outer = argparse.ArgumentParser(usage="nbscript [nbscript and nbconvert args] notebook [nb_argv ...]\n"
+                                                 "       nbscript pipeline [-h] PIPELINE")
+    parser_outer.add_argument("--to", help="Convert to this format (same as nbconvert --to option).  "
+                                           "Several comma-separated formats are exported from "
+                                           "one execution (implies --inprocess).")
     #parser_outer.add_argument("--export", "-e", action='append', help="Set environment variable (format NAME=VALUE)")
     parser_outer.add_argument("--output", "-o",
                               help="Filename to write to")
@@ -84,6 +124,106 @@ def nbscript(argv=sys.argv[1:], _return_names=False):
     parser_outer.add_argument("--timestamp", "--ts", action='store_true',
                               help="Timestamp output filename (timestamp automatically "
                                    "added before extension)")
+    parser_outer.add_argument("--inprocess", action='store_true',
+                              help="Execute in this Python process instead of running "
+                                   "`jupyter nbconvert` (only --Class.trait=value style "
+                                   "nbconvert options are understood)")
+    parser_outer.add_argument("--stream", action='store_true',
+                              help="Print cells and outputs to stdout as they run, "
+                                   "instead of after the end (implies --inprocess).  "
+                                   "If saving to a file, that is written too.")
+    parser_outer.add_argument("--checkpoint-interval", type=_non_negative(float), metavar="SECONDS",
+                              help="While running, save the notebook so far at most "
+                                   "this often (implies --inprocess).  Needs an output "
+                                   "file; if it isn't a notebook, the checkpoint is "
+                                   "NAME.checkpoint.ipynb and is removed at the end.")
+    parser_outer.add_argument("--checkpoint-cells", type=_positive, metavar="N",
+                              help="Like --checkpoint-interval, but every N cells")
+    parser_outer.add_argument("--checkpoint-state", action='store_true',
+                              help="With checkpointing, also save the kernel state "
+                                   "(with dill) so that the run can be resumed")
+    parser_outer.add_argument("--resume", metavar="PREVIOUS",
+                              help="Resume from this checkpoint or output (saved with "
+                                   "--checkpoint-state): skip the cells which were "
+                                   "completed and load the saved state.  If it doesn't "
+                                   "exist, run normally (implies --inprocess).")
+    parser_outer.add_argument("--rerun", metavar="PREVIOUS",
+                              help="Run only the cells which changed since this output "
+                                   "(saved with --checkpoint-state) and the cells which "
+                                   "depend on them; the others keep their outputs "
+                                   "(implies --inprocess).")
+    parser_outer.add_argument("--parallel-cells", type=int, metavar="N",
+                              help="Run consecutive cells tagged nbscript-parallel "
+                                   "which don't use each other's variables in N worker "
+                                   "kernels at once, starting from the state before "
+                                   "them (implies --inprocess).")
+    parser_outer.add_argument("--parallel-all", action='store_true',
+                              help="With --parallel-cells, also run untagged cells in "
+                                   "parallel when they don't use each other's variables")
+    parser_outer.add_argument("--params", metavar="FILE",
+                              help="Parameters for the notebook, a JSON file.  Only "
+                                   "its name is passed on, the notebook reads it with "
+                                   "nbscript.params when first used.")
+    parser_outer.add_argument("--save-state", action='store_true',
+                              help="When the run ends, save the kernel's variables to "
+                                   "OUTPUT.vars/ (arrays as .npy, which "
+                                   "nbscript.load_state() opens with mmap; implies "
+                                   "--inprocess).")
+    parser_outer.add_argument("--cache", action='store_true',
+                              help="Use the cell result cache (implies --inprocess).  "
+                                   "Tag cells nbscript-cache / nbscript-no-cache to "
+                                   "choose which cells are cached.")
+    parser_outer.add_argument("--cache-dir",
+                              help="Cache directory (default $XDG_CACHE_HOME/nbscript)")
+    parser_outer.add_argument("--cache-size", type=int, default=1024, metavar="MB",
+                              help="Maximum cache size in MB (default %(default)s)")
+    parser_outer.add_argument("--profile", action='store_true',
+                              help="Measure wall time, CPU time and peak memory of each "
+                                   "cell (implies --inprocess).  Saved in the cell "
+                                   "metadata and OUTPUT.profile.{json,csv}, slowest "
+                                   "cells printed to stderr.")
+    parser_outer.add_argument("--profile-top", type=int, default=5, metavar="N",
+                              help="Number of cells in the --profile summary (default %(default)s)")
+    parser_outer.add_argument("--max-output-size", metavar="SIZE",
+                              help="Truncate text outputs larger than this (keeping "
+                                   "the head and tail) and remove larger images and "
+                                   "other outputs (implies --inprocess).  SIZE may "
+                                   "have a k/M/G suffix.")
+    parser_outer.add_argument("--max-notebook-size", metavar="SIZE",
+                              help="Like --max-output-size, for all outputs after "
+                                   "the notebook's outputs reach this size")
+    parser_outer.add_argument("--offload-outputs", action='store_true',
+                              help="Move images and other binary outputs over the "
+                                   "limits to files in OUTPUT_files/ instead of "
+                                   "removing them")
+    parser_outer.add_argument("--compile", action='store_true',
+                              help="Compile the notebook to a plain Python module "
+                                   "(cached in CACHE_DIR/compiled) and print its filename")
+    parser_outer.add_argument("--fast", action='store_true',
+                              help="Run the compiled notebook in this process, without "
+                                   "a kernel and without an output notebook.  Magics "
+                                   "which can't be translated to Python are errors.")
+    parser_outer.add_argument("--daemon", action='store_true',
+                              help="Run in a pre-started kernel of a running "
+                                   "nbscript-daemon")
+    parser_outer.add_argument("--daemon-socket",
+                              help="Socket of the nbscript-daemon (default "
+                                   "$NBSCRIPT_DAEMON_SOCKET or per-user default)")
+    parser_outer.add_argument("--sweep", metavar="PARAMS",
+                              help="Run once per line of this file (JSON list of "
+                                   "arguments or a JSON string), in-process.  Each "
+                                   "output filename gets the run index added.  "
+                                   "Implies --save if --output is not given.")
+    parser_outer.add_argument("--jobs", "-j", type=int, default=1,
+                              help="With --sweep, number of runs at once (default 1)")
+    parser_outer.add_argument("--sweep-index", type=int, action='append',
+                              help="With --sweep, only do this run (line number, "
+                                   "counting from zero and skipping blank lines).  "
+                                   "May be given more than once.")
+    parser_outer.add_argument("--events", metavar="FILE",
+                              help="Append timing events (JSON lines) to this file "
+                                   "(default $NBSCRIPT_EVENTS).  Per-cell events need "
+                                   "--inprocess.")
     parser_outer.add_argument("--verbose", "-v", action="store_true",
                               help="Verbose")
     parser_outer.add_argument("notebook",
@@ -105,18 +245,17 @@ def nbscript(argv=sys.argv[1:], _return_names=False):
 
     env['NB_NAME'] = args.notebook
     env['NB_ARGV'] = json.dumps([args.notebook] + args.nb_argv)
+    if args.params:
+        env['NB_PARAMS_FILE'] = os.path.abspath(args.params)
     #if args.nbconvert_args:
     #    nbconvert_args = args.nbconvert_args.split()
     #else:
     #    nbconvert_args = [ ]
 
-    # Manually do nbconvert process (not working yet)
-    #nb = nbformat.read(open(args.notebook), as_version=4)
-    #nbc, resc = preprocessor(nbc, resc)
-    #nb = nbconvert.preprocessors.execute.executenb(nb, cwd=None)
-    #self.writer.write(output, resources, notebook_name=notebook_name)
-
     #output_basename = args.notebook+'`date +%Y-%m-%d_%H:%M:%S`'
+    # A sweep can't go to stdout, so it is saved by default.
+    if args.sweep and not args.output:
+        args.save = True
     to_format = args.to
     output_fname = args.output
     # determine to_format: first from the option, then from output filename,
@@ -135,15 +274,22 @@ def nbscript(argv=sys.argv[1:], _return_names=False):
         else:
             to_format = DEFAULT_FORMAT_STDOUT
 
+    # --to a,b,c executes once and exports to each format.  The first one
+    # is the main output (checkpoints, NBSCRIPT_OUTPUT_FILENAME).
+    extra_formats = to_format.split(',')[1:]
+    to_format = to_format.split(',')[0]
+
     # --save inferrs a filename from the input filename
-    if args.save:
+    def save_fname(to_format):
         basename, oldext = os.path.splitext(args.notebook)
         if oldext:
             oldext = oldext[1:]
         ext = FORMAT_MAP.get(to_format, to_format)
         if ext == oldext:
             basename += '.out'
-        output_fname = basename + '.' + ext
+        return basename + '.' + ext
+    if args.save:
+        output_fname = save_fname(to_format)
 
     # Make the saving arguments.  Stdout if a filename not given, otherwise to
     # the filename given.
@@ -152,12 +298,13 @@ def nbscript(argv=sys.argv[1:], _return_names=False):
         output = ['--stdout', '--to', to_format]
     else:
         # output_filename is defined
+        timestamp = time.strftime('.%Y-%m-%d_%H:%M:%S')
+        def add_timestamp(fname):
+            basename, ext = os.path.splitext(fname)
+            return basename + timestamp + ext
         if args.timestamp:
             # adjust output filename
-            basename, ext = os.path.splitext(output_fname)
-            if args.timestamp:
-                basename += time.strftime('.%Y-%m-%d_%H:%M:%S')
-            output_fname = basename + ext
+            output_fname = add_timestamp(output_fname)
         if output_fname == args.notebook:
             raise ValueError("Input name is the same as the output name, so refusing to convert")
         # "--output-dir=." is added, because by default the dirname of the
@@ -166,11 +313,184 @@ def nbscript(argv=sys.argv[1:], _return_names=False):
         # see FilesWriter.build_directory in
         #   https://nbconvert.readthedocs.io/en/latest/config_options.html
         output = ['--output-dir=.', '--output', output_fname, '--to', to_format]
-        env['NBSCRIPT_OUTPUT_FILENAME'] = output_fname
+        # Absolute, since the kernel runs in the notebook's directory.
+        env['NBSCRIPT_OUTPUT_FILENAME'] = os.path.abspath(output_fname)
+
+    # The other formats' files are named the same way, with their extension.
+    exports = [(to_format, output_fname)]
+    for fmt in extra_formats:
+        if output_fname is None:
+            raise ValueError("Exporting to several formats needs an output file (--save or --output)")
+        ext = FORMAT_MAP.get(fmt, fmt)
+        if args.save:
+            fname = save_fname(fmt)
+        else:
+            basename, oldext = os.path.splitext(args.output)
+            if oldext[1:] not in EXT_MAP and oldext[1:] != FORMAT_MAP.get(to_format, to_format):
+                basename = args.output
+            fname = basename + '.' + ext
+        if args.timestamp:
+            fname = add_timestamp(fname)
+        if fname == args.notebook or fname in [f for _, f in exports]:
+            raise ValueError("Output name %s is used twice, so refusing to convert"%fname)
+        exports.append((fmt, fname))
+
+    # These run the notebook some other way, without the options below.
+    modes = [opt for opt, value in (('--compile', args.compile), ('--fast', args.fast),
+                                    ('--sweep', args.sweep), ('--daemon', args.daemon))
+             if value]
+    if modes:
+        incompatible = [opt for opt, value in (
+            ('--stream', args.stream),
+            ('--checkpoint-interval', args.checkpoint_interval is not None),
+            ('--checkpoint-cells', args.checkpoint_cells is not None),
+            ('--checkpoint-state', args.checkpoint_state),
+            ('--resume', args.resume),
+            ('--rerun', args.rerun),
+            ('--cache', args.cache),
+            ('--save-state', args.save_state),
+            ('--profile', args.profile),
+            ('--max-output-size', args.max_output_size),
+            ('--max-notebook-size', args.max_notebook_size),
+            ('--offload-outputs', args.offload_outputs),
+            ('--parallel-cells', args.parallel_cells),
+            ('--parallel-all', args.parallel_all),
+            ('several --to formats', extra_formats),
+            ('nbconvert options', nbconvert_args),
+            ) if value]
+        incompatible += modes[1:]
+        if incompatible:
+            raise ValueError("%s can't be used with %s"%(modes[0], ', '.join(incompatible)))
 
     if _return_names:
         return locals()
 
+    from . import events
+    events.setup(args.events)
+    events.emit('parse_args', duration=clock() - start_time,
+                notebook=args.notebook, output=output_fname)
+
+    # Compiled to a plain Python script, run without a kernel.
+    if args.compile or args.fast:
+        from . import script
+        if args.fast and output_fname is not None:
+            raise ValueError("--fast doesn't make an output notebook (no --save or --output)")
+        fname = script.compile_notebook(args.notebook, cache_dir=args.cache_dir)
+        if not args.fast:
+            print(fname)
+            return 0
+        env['NBSCRIPT_RUNNING'] = 'True'
+        with payload.packed(env) as run_env, setenv_context(run_env):
+            return script.run(fname, args.notebook, json.loads(env['NB_ARGV']))
+
+    # Parameter sweep: many runs of the same notebook.
+    if args.sweep:
+        from . import sweep
+        env['NBSCRIPT_RUNNING'] = 'True'
+        results = sweep.sweep(args.notebook, sweep.read_params(args.sweep),
+                              to_format, output_fname, env, jobs=args.jobs,
+                              indices=args.sweep_index)
+        return max([r['returncode'] for r in results] + [0])
+
+    # Execute in a warm kernel from a running nbscript-daemon.
+    if args.daemon:
+        from . import daemon
+        env['NBSCRIPT_RUNNING'] = 'True'
+        with payload.packed(env) as run_env:
+            return daemon.submit(args.notebook, to_format, output_fname, run_env,
+                                 socket_path=args.daemon_socket)
+
+    listeners = [ ]
+    checkpointer = None
+    if args.checkpoint_interval is not None or args.checkpoint_cells is not None:
+        if output_fname is None:
+            raise ValueError("Checkpointing needs an output file (--save or --output)")
+        from . import checkpoint
+        checkpointer = checkpoint.Checkpointer(
+            checkpoint.checkpoint_fname(output_fname, to_format),
+            interval=args.checkpoint_interval, every_cells=args.checkpoint_cells,
+            state=args.checkpoint_state)
+        listeners.append(checkpointer)
+    elif args.checkpoint_state:
+        raise ValueError("--checkpoint-state needs --checkpoint-interval or --checkpoint-cells")
+    if args.resume:
+        from . import resume
+        listeners.insert(0, resume.Resumer(args.resume))
+    if args.cache:
+        from . import cache
+        cache_argv = json.loads(env['NB_ARGV'])
+        if args.params:
+            # Cached results depend on the parameters too.
+            cache_argv.append(cache.file_hash(args.params))
+        listeners.insert(1 if args.resume else 0, cache.CellCache(
+            cache_argv, cache_dir=args.cache_dir,
+            max_bytes=args.cache_size * 2**20))
+
+    if args.rerun:
+        if args.resume or args.cache:
+            raise ValueError("--rerun can't be used with --resume or --cache")
+        # After the checkpointer, which records what the state covers.
+        from . import rerun
+        listeners.append(rerun.PartialRerun(args.rerun))
+
+    if args.parallel_cells:
+        if args.resume or args.rerun or args.cache:
+            raise ValueError("--parallel-cells can't be used with --resume, --rerun or --cache")
+        from . import parallel
+        listeners.append(parallel.ParallelCells(args.parallel_cells,
+                                                tagged_only=not args.parallel_all))
+    elif args.parallel_all:
+        raise ValueError("--parallel-all needs --parallel-cells")
+
+    if args.save_state:
+        if output_fname is None:
+            raise ValueError("--save-state needs an output file (--save or --output)")
+        from . import state
+        listeners.append(state.StateSaver(state.state_dir(output_fname)))
+
+    profiler = None
+    if args.profile:
+        from . import profiling
+        profiler = profiling.Profiler()
+        listeners.append(profiler)
+
+    # Outputs are limited after the cache stores them and before they
+    # are checkpointed (the listeners are called in order).  The limits
+    # in the notebook metadata come after all cells in the file, so they
+    # are only read if the run is in-process anyway and the command line
+    # doesn't set all of them.
+    cli_limits = [limit for limit in (args.max_output_size, args.max_notebook_size,
+                                      args.offload_outputs or None) if limit is not None]
+    if cli_limits or args.inprocess or args.stream or listeners or extra_formats:
+        from . import outputs
+        output_config = outputs.notebook_config(args.notebook) if len(cli_limits) < 3 else { }
+        if cli_limits or output_config:
+            if args.offload_outputs and output_fname is None:
+                raise ValueError("--offload-outputs needs an output file (--save or --output)")
+            listeners.insert(int(bool(args.resume)) + int(bool(args.cache)), outputs.OutputLimiter(
+                output_config, max_output=args.max_output_size,
+                max_notebook=args.max_notebook_size,
+                offload=args.offload_outputs or None,
+                sidecar_dir=outputs.sidecar_dir(output_fname) if output_fname else None))
+
+    # In-process execution: same result as below, without starting
+    # `jupyter nbconvert` in a new interpreter.
+    if args.inprocess or args.stream or listeners or extra_formats:
+        from . import execute
+        env['NBSCRIPT_RUNNING'] = 'True'
+        with payload.packed(env) as run_env, setenv_context(run_env):
+            ret = execute.run(args.notebook, to_format, output_fname,
+                              nbconvert_args=nbconvert_args,
+                              stream=args.stream, listeners=listeners,
+                              exports=exports[1:])
+        if checkpointer is not None and checkpointer.fname != output_fname:
+            checkpointer.remove()
+        if profiler is not None:
+            if output_fname is not None:
+                profiler.write(output_fname)
+            profiler.summary(n=args.profile_top)
+        return ret
+
     # Do the conversion
     cmd_nbconvert = ['jupyter', 'nbconvert',
                     '--execute', '--allow-errors', '--ExecutePreprocessor.timeout=None',
@@ -183,7 +503,7 @@ def nbscript(argv=sys.argv[1:], _return_names=False):
 
     # Actually run it
     env['NBSCRIPT_RUNNING'] = 'True'
-    with setenv_context(env):
+    with payload.packed(env) as run_env, setenv_context(run_env), events.span('nbconvert'):
         p = subprocess.Popen(cmd_nbconvert)
         p.wait()
 
@@ -0,0 +1,185 @@
+"""Limiting the size of cell outputs.
+
+When a cell ends, its outputs are limited before they are checkpointed
+or saved:
+
+* Stream output (and text/plain results) larger than `max_output`
+  characters is truncated, keeping the head and the tail.
+* Other text formats (HTML, ...) larger than that are dropped, the
+  text/plain version stays.
+* Binary outputs (images, PDF) larger than that are moved to sidecar
+  files named by their sha256 (so duplicates are stored once) if
+  `offload` is on, and linked from the notebook with a markdown
+  output.  Otherwise they are dropped.
+* Once the outputs of the notebook add up to `max_notebook`, all later
+  outputs are handled like this regardless of their size.
+
+Error outputs are never changed.  The limits can also be set in the
+notebook metadata, as `nbscript.outputs.{max_output_size,
+max_notebook_size, offload}` (used by in-process runs); command line
+options override them.
+"""
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+
+LOG = logging.getLogger('nbscript.outputs')
+
+EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif',
+              'application/pdf': '.pdf'}
+
+_UNITS = {'': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30}
+
+
+def parse_size(value):
+    """Size as an int, or a string with an optional k/M/G suffix"""
+    if value is None or isinstance(value, int):
+        return value
+    m = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([kKmMgG]?)[bB]?\s*$', str(value))
+    if not m:
+        raise ValueError("Invalid size: %r"%value)
+    return int(float(m.group(1)) * _UNITS[m.group(2).lower()])
+
+
+def notebook_config(notebook):
+    """The nbscript.outputs config in the notebook's metadata, or {}"""
+    from . import scan
+    try:
+        metadata = scan.notebook_metadata(notebook)
+    except (IOError, OSError, ValueError):
+        return { }
+    return (metadata.get('nbscript') or { }).get('outputs') or { }
+
+
+def sidecar_dir(output_fname):
+    """Directory for offloaded outputs: NAME_files, like nbconvert's"""
+    return os.path.splitext(output_fname)[0] + '_files'
+
+
+def is_binary(mimetype):
+    """nbformat stores these base64-encoded"""
+    return not (mimetype.startswith('text/') or mimetype == 'image/svg+xml'
+                or mimetype.endswith('json') or mimetype.endswith('+xml')
+                or mimetype.endswith('javascript'))
+
+
+def _size(value):
+    if isinstance(value, list):
+        return sum(len(x) for x in value)
+    if isinstance(value, str):
+        return len(value)
+    return len(json.dumps(value))
+
+
+def truncate(text, max_size):
+    """Keep the head and tail of text, at line boundaries if possible"""
+    if isinstance(text, list):
+        text = ''.join(text)
+    if len(text) <= max_size:
+        return text
+    half = max_size // 2
+    head = text[:half]
+    if '\n' in head:
+        head = head[:head.rindex('\n')+1]
+    tail = text[len(text)-half:]
+    if '\n' in tail[:-1]:
+        tail = tail[tail.index('\n')+1:]
+    return '%s... [nbscript: %d characters omitted] ...\n%s'%(
+        head, len(text) - len(head) - len(tail), tail)
+
+
+class OutputLimiter(object):
+    """Execution listener which limits the size of outputs"""
+    def __init__(self, config=None, max_output=None, max_notebook=None,
+                 offload=None, sidecar_dir=None):
+        config = config or { }
+        if max_output is None:
+            max_output = config.get('max_output_size')
+        if max_notebook is None:
+            max_notebook = config.get('max_notebook_size')
+        if offload is None:
+            offload = config.get('offload', False)
+        self.max_output = parse_size(max_output)
+        self.max_notebook = parse_size(max_notebook)
+        self.sidecar_dir = sidecar_dir
+        if offload and sidecar_dir is None:
+            LOG.warning("Not offloading outputs: there is no output file")
+            offload = False
+        self.offload = offload
+        self.total = 0
+        self.n_offloaded = 0
+
+    def _over(self, size):
+        if self.max_notebook is not None and self.total + size > self.max_notebook:
+            return True
+        return self.max_output is not None and size > self.max_output
+
+    def _offload(self, mimetype, value):
+        """Write a binary output to a sidecar file, return its relative path"""
+        import base64
+        data = base64.b64decode(value if isinstance(value, str) else ''.join(value))
+        ext = EXTENSIONS.get(mimetype) or mimetypes.guess_extension(mimetype) or '.bin'
+        fname = os.path.join(self.sidecar_dir, hashlib.sha256(data).hexdigest()[:32] + ext)
+        if not os.path.exists(fname):
+            from .checkpoint import atomic_write
+            if not os.path.isdir(self.sidecar_dir):
+                os.makedirs(self.sidecar_dir)
+            atomic_write(fname, data)
+        self.n_offloaded += 1
+        return os.path.join(os.path.basename(self.sidecar_dir), os.path.basename(fname))
+
+    def _limit_text(self, text, size):
+        limit = self.max_output
+        if self.max_notebook is not None:
+            limit = max(min(limit if limit is not None else size,
+                            self.max_notebook - self.total), 200)
+        return truncate(text, limit)
+
+    def limit(self, out):
+        """Limit one output in place, return its size afterwards"""
+        if out.output_type == 'stream':
+            size = _size(out.text)
+            if self._over(size):
+                out.text = self._limit_text(out.text, size)
+                size = _size(out.text)
+            return size
+        if out.output_type not in ('display_data', 'execute_result'):
+            return _size(out.get('traceback', [ ]))
+        notes = [ ]
+        links = [ ]
+        for mimetype in sorted(out.data, key=lambda m: m == 'text/plain'):
+            value = out.data[mimetype]
+            size = _size(value)
+            if not self._over(size):
+                continue
+            if mimetype == 'text/plain':
+                out.data[mimetype] = self._limit_text(value, size)
+                continue
+            del out.data[mimetype]
+            if is_binary(mimetype) and self.offload:
+                path = self._offload(mimetype, value)
+                out.metadata.setdefault('nbscript', { }).setdefault('offloaded', { })[mimetype] = path
+                if mimetype.startswith('image/'):
+                    links.append('![%s](%s)'%(mimetype, path))
+                else:
+                    links.append('[%s](%s)'%(mimetype, path))
+            else:
+                notes.append('[nbscript: %s output of %d characters removed]'%(mimetype, size))
+        if links:
+            out.data['text/markdown'] = '\n'.join(links)
+        if notes:
+            text = out.data.get('text/plain', '')
+            if isinstance(text, list):
+                text = ''.join(text)
+            out.data['text/plain'] = '\n'.join(([text] if text else [ ]) + notes)
+        return sum(_size(value) for value in out.data.values())
+
+    def cell_end(self, ep, cell, index):
+        for out in cell.get('outputs', [ ]):
+            self.total += self.limit(out)
+
+    cell_skipped = cell_end
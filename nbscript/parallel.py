@@ -0,0 +1,242 @@
+"""Running independent cells at the same time in worker kernels.
+
+With `nbscript --parallel-cells N`, consecutive code cells tagged
+`nbscript-parallel` (markdown cells between them don't matter) form a
+group.  When execution reaches a group, the kernel's global namespace
+is saved with dill, and the group's cells run in up to N worker
+kernels at once, each starting from that state.  Their outputs are
+put into the notebook in the original order, and the variables each
+cell defines are loaded back into the main kernel, in cell order,
+before execution continues after the group.
+
+The names each cell defines and uses are found by static analysis
+(`nbscript.names`).  A cell which uses a name defined by an earlier
+cell of the group starts a new group, so the cells of a group don't
+depend on each other.  Tagging a cell also says that it doesn't change
+existing objects in place.  With `--parallel-all`, untagged cells are
+grouped too, but for them the objects they call methods on or pass to
+functions (`x.append(1)`, `f(x)`) count as defined by them.  Cells
+which can't be analyzed (cell magics, `from x import *`) and cells
+tagged `nbscript-no-parallel` always run in the main kernel.
+
+Other effects aren't seen: changes through aliases happen only in the
+worker, and files written by one cell aren't necessarily there for the
+next one.  If the state can't be saved, the group runs normally; if a
+cell's variables can't be saved, that cell and the rest of the group
+run again in the main kernel.  The cells get execution counts in
+notebook order, as if they had run in the main kernel.
+"""
+
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import nbformat
+
+from . import names
+from .cache import LOAD_VARS_CODE, SAVE_VARS_CODE
+from .resume import LOAD_STATE_CODE, SAVE_STATE_CODE
+
+LOG = logging.getLogger('nbscript.parallel')
+
+TAG_PARALLEL = 'nbscript-parallel'
+TAG_NO_PARALLEL = 'nbscript-no-parallel'
+
+COUNT_CODE = "get_ipython().execution_count += %d"
+
+
+def plan_groups(nb, tagged_only=True):
+    """Groups of cell indices which can run at the same time.
+
+    Returns a list of (cell indices, {index: names to bring back}).
+    Only groups of at least two cells are returned.
+    """
+    groups = [ ]
+    functions = { }
+    modules = set()
+    current = [ ]
+    saved = { }
+    written = set()
+
+    def close():
+        if len(current) > 1:
+            groups.append((list(current), dict(saved)))
+        del current[:]
+        saved.clear()
+        written.clear()
+
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type != 'code' or not cell.source.strip():
+            continue
+        tags = cell.metadata.get('tags', [ ])
+        info = names.analyze(cell.source)
+        if info is not None:
+            for name, (reads, writes) in info.functions.items():
+                old_reads, old_writes = functions.get(name, (set(), set()))
+                functions[name] = (old_reads | reads, old_writes | writes)
+            modules |= info.modules
+        if (info is None or TAG_NO_PARALLEL in tags
+                or (tagged_only and TAG_PARALLEL not in tags)):
+            close()
+            continue
+        reads, writes = names.effects(info, functions, modules,
+                                      mutations=TAG_PARALLEL not in tags)
+        # Writing a name an earlier cell of the group uses is fine: it
+        # got the value from before the group, as it would have anyway.
+        if reads & written:
+            close()
+        current.append(index)
+        saved[index] = sorted(writes)
+        written |= writes
+    close()
+    return groups
+
+
+class _WorkerCell(object):
+    """Listener for running one cell in a worker kernel: loads the
+    state first, and saves the cell's variables after."""
+    def __init__(self, index, state, vars_fname, save_names):
+        self.index = index
+        self.state = state
+        self.vars_fname = vars_fname
+        self.save_names = save_names
+        self.saved = False
+
+    def cell_start(self, ep, cell, index):
+        ep.run_code(LOAD_STATE_CODE%self.state)
+
+    def cell_end(self, ep, cell, index):
+        if any(out.output_type == 'error' for out in cell.outputs):
+            return
+        try:
+            ep.run_code(SAVE_VARS_CODE%(self.save_names, self.vars_fname))
+            self.saved = True
+        except RuntimeError as e:
+            LOG.debug('cell %d: saving variables failed: %s', self.index, e)
+
+
+class ParallelCells(object):
+    """Execution listener which runs the groups of independent cells in
+    worker kernels.  The worker kernels are started when first needed
+    and shut down at the end."""
+    def __init__(self, workers=2, tagged_only=True):
+        self.workers = max(workers, 1)
+        self.tagged_only = tagged_only
+        self.groups = { }       # first cell index -> (indices, names)
+        self._parallel = set()  # cells which ran in a worker
+        self._kernels = [ ]
+        self._idle = [ ]
+        self._lock = threading.Lock()
+        self._tmpdir = None
+
+    def prepare(self, nb):
+        self.groups = dict((indices[0], (indices, saved))
+                           for indices, saved in plan_groups(nb, self.tagged_only))
+        for indices, _ in self.groups.values():
+            LOG.debug('parallel cells: %s', indices)
+
+    def skip_cell(self, ep, cell, index):
+        if index in self.groups:
+            self._run_group(ep, *self.groups[index])
+        return index in self._parallel
+
+    def _kernel(self, ep):
+        """An idle worker kernel, started if needed (the preprocessor
+        waits until it is ready)"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        from jupyter_client import KernelManager
+        km = KernelManager(kernel_name=ep.km.kernel_name)
+        km.start_kernel(**ep._add_kernel_env(   # pylint: disable=protected-access
+            {'cwd': ep.resources['metadata']['path']}))
+        with self._lock:
+            self._kernels.append(km)
+        return km
+
+    def _run_group(self, ep, indices, saved):
+        from .execute import NbscriptExecutePreprocessor
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='nbscript-parallel-')
+        state = os.path.join(self._tmpdir, 'state')
+        try:
+            ep.run_code(SAVE_STATE_CODE%state)
+        except RuntimeError as e:
+            LOG.warning('Running cells %s one at a time, saving the state failed: %s',
+                        indices, e)
+            return
+        LOG.debug('running cells %s in %d worker kernels', indices, self.workers)
+        results = { }
+        slots = threading.BoundedSemaphore(self.workers)
+
+        def run(index):
+            try:
+                cell = copy.deepcopy(ep.nb.cells[index])
+                nb = nbformat.v4.new_notebook(metadata=ep.nb.metadata, cells=[cell])
+                worker = _WorkerCell(index, state,
+                                     os.path.join(self._tmpdir, '%d.vars'%index),
+                                     saved[index])
+                km = self._kernel(ep)
+                try:
+                    wep = NbscriptExecutePreprocessor(config=ep.config, listeners=[worker])
+                    wep.preprocess(nb, copy.deepcopy(ep.resources), km=km)
+                finally:
+                    with self._lock:
+                        self._idle.append(km)
+                results[index] = (cell, worker)
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.warning('cell %d failed in a worker kernel: %s: %s', index,
+                            type(e).__name__, e)
+            finally:
+                slots.release()
+
+        threads = [ ]
+        for index in indices:
+            slots.acquire()
+            t = threading.Thread(target=run, args=(index,))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        # Execution counts continue from the cells before, and the main
+        # kernel's counter skips the ones the group used.
+        count = max([c.get('execution_count') or 0 for c in ep.nb.cells[:indices[0]]] + [0])
+        done = 0
+        for index in indices:
+            # Errors are kept like in the main kernel, but the variables of
+            # an otherwise successful cell have to come back.  If they
+            # can't, this cell and the ones after it run in the main kernel.
+            cell, worker = results.get(index, (None, None))
+            if cell is None or (not worker.saved and not any(
+                    out.output_type == 'error' for out in cell.outputs)):
+                LOG.info('running cells from %d in the main kernel', index)
+                break
+            if worker.saved:
+                ep.run_code(LOAD_VARS_CODE%worker.vars_fname)
+            ep.nb.cells[index].outputs = cell.outputs
+            done += 1
+            ep.nb.cells[index].execution_count = count + done
+            self._parallel.add(index)
+        if done:
+            try:
+                ep.run_code(COUNT_CODE%done)
+            except RuntimeError as e:
+                LOG.debug('not a Python kernel, execution count not updated: %s', e)
+        for fname in os.listdir(self._tmpdir):
+            os.unlink(os.path.join(self._tmpdir, fname))
+
+    def finish(self, ep):
+        for km in self._kernels:
+            try:
+                km.shutdown_kernel(now=True)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("Shutting down a worker kernel failed")
+        self._kernels = [ ]
+        self._idle = [ ]
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
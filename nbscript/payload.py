@@ -0,0 +1,132 @@
+"""Passing the notebook's argv and parameters to the kernel.
+
+argv goes to the kernel as JSON in the NB_ARGV environment variable.
+The environment has size limits (on Linux, 128 KiB for one variable)
+and is copied to every process the kernel starts, so an argv larger
+than ENV_LIMIT is written to a file instead, in shared memory
+(/dev/shm) if there is one, and NB_ARGV_FILE is its name.  The file is
+removed when the run is done.
+
+Parameters (`nbscript --params FILE`, a JSON file) are passed only as
+the file name, in NB_PARAMS_FILE.
+
+In the notebook, `nbscript.argv` is read when nbscript is imported.
+`nbscript.params` is a LazyParams, which reads and decodes the file
+when it is first used (or None, if there are no parameters).
+"""
+
+import contextlib
+import json
+import os
+
+ENV_LIMIT = 32768
+
+ARGV_FILE_ENV = 'NB_ARGV_FILE'
+PARAMS_FILE_ENV = 'NB_PARAMS_FILE'
+
+
+def payload_dir():
+    """Directory for argv files: shared memory if possible"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def _read_json(fname):
+    with open(fname, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def load_argv(environ=None):
+    """The notebook's argv from the environment, or None"""
+    environ = os.environ if environ is None else environ
+    if environ.get(ARGV_FILE_ENV):
+        return _read_json(environ[ARGV_FILE_ENV])
+    if 'NB_ARGV' in environ:
+        return json.loads(environ['NB_ARGV'])
+    return None
+
+
+def load_params(environ=None):
+    """The notebook's parameters from the environment, or None"""
+    environ = os.environ if environ is None else environ
+    if environ.get(PARAMS_FILE_ENV):
+        return _read_json(environ[PARAMS_FILE_ENV])
+    return None
+
+
+class LazyParams(object):
+    """The parameters of a JSON file, read when first used.
+
+    Indexing, iteration, `len()`, `in` and attributes (like `.get()`)
+    go to the decoded value.
+    """
+    def __init__(self, fname):
+        self._fname = fname
+        self._value = None
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._value = _read_json(self._fname)
+            self._loaded = True
+        return self._value
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, item):
+        return item in self._load()
+
+    def __eq__(self, other):
+        return self._load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+def lazy_params(environ=None):
+    """A LazyParams for the parameter file of the environment, or None"""
+    environ = os.environ if environ is None else environ
+    if environ.get(PARAMS_FILE_ENV):
+        return LazyParams(environ[PARAMS_FILE_ENV])
+    return None
+
+
+@contextlib.contextmanager
+def packed(env):
+    """A copy of env with a large NB_ARGV moved to a file.
+
+    The file is removed at the end of the block.
+    """
+    env = dict(env)
+    fname = None
+    if len(env.get('NB_ARGV', '')) > ENV_LIMIT:
+        import tempfile
+        fd, fname = tempfile.mkstemp(prefix='nbscript-argv-', suffix='.json',
+                                     dir=payload_dir())
+        with os.fdopen(fd, 'wb') as f:
+            f.write(env.pop('NB_ARGV').encode('utf-8'))
+        env[ARGV_FILE_ENV] = fname
+    try:
+        yield env
+    finally:
+        if fname is not None and os.path.exists(fname):
+            os.unlink(fname)
@@ -0,0 +1,348 @@
+"""Pipelines of notebooks which depend on each other.
+
+`nbscript pipeline pipeline.yaml` runs the stages of a pipeline file
+like::
+
+    stages:
+      preprocess:
+        notebook: preprocess.ipynb
+        inputs: [raw.csv]
+        outputs: {clean: clean.csv}
+      train:
+        notebook: train.ipynb
+        needs: [preprocess]
+        args: [--data, "{preprocess.clean}"]
+        outputs: {model: model.pkl}
+        slurm: [--mem-per-cpu=4G, --cpus-per-task=4]
+      evaluate:
+        notebook: evaluate.ipynb
+        needs: [preprocess, train]
+
+Each stage runs its notebook with `nbscript --save` (or the options in
+`nbscript`) once the stages it `needs` have finished, stages which
+don't depend on each other at the same time (`--jobs`).  With `--slurm`
+each stage is submitted with snotebook instead, with
+`--dependency=afterok:...` on the jobs of the stages it needs.
+
+`outputs` are the files a stage writes (a list, or a dict of names to
+files).  `{stage.name}` in `args` is replaced with that output of that
+stage (for a list, the name is the file name itself), and the notebook
+gets the outputs of the stages it needs as the JSON environment
+variable NBSCRIPT_INPUTS (`{stage: {name: file}}`), and its own as
+NBSCRIPT_OUTPUTS (`{name: file}`).  Paths are relative to the
+directory of the pipeline file, where stages run.
+
+A stage is skipped if it has run successfully before with the same
+notebook code, arguments, and input files (its `inputs` and the outputs
+of the stages it needs), and its outputs still exist.  This is recorded
+in PIPELINE.stamps/STAGE.json by the stage itself, so it also works in
+Slurm jobs.  A stage fails if nbscript fails or a cell raises an error;
+the stages which need it are then not run.
+
+Pipeline files are YAML (which needs PyYAML) or JSON (`.json`).
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+LOG = logging.getLogger('nbscript.pipeline')
+
+PIPELINE_ENV = 'NBSCRIPT_PIPELINE'
+STAGE_ENV = 'NBSCRIPT_PIPELINE_STAGE'
+
+STAGE_KEYS = {'notebook', 'needs', 'inputs', 'outputs', 'args', 'nbscript', 'slurm'}
+
+_REF_RE = re.compile(r'\{([\w-]+)\.([^{}]+)\}')
+
+
+def _list(value):
+    """A list of arguments: a list, or a string split like a command line"""
+    if value is None:
+        return [ ]
+    if isinstance(value, str):
+        return shlex.split(value)
+    return [str(x) for x in value]
+
+
+def _outputs(value):
+    if value is None:
+        return { }
+    if isinstance(value, dict):
+        return dict((str(k), str(v)) for k, v in value.items())
+    return dict((str(x), str(x)) for x in value)
+
+
+def read_pipeline(fname):
+    """Read and check a pipeline file, return {stage: dict} in order"""
+    with open(fname) as f:
+        if fname.endswith('.json'):
+            data = json.load(f)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading %s needs PyYAML (pip install pyyaml), "
+                                  "or write the pipeline in JSON"%fname)
+            data = yaml.safe_load(f)
+    if not isinstance(data, dict) or not isinstance(data.get('stages'), dict):
+        raise ValueError("%s: expected a mapping with 'stages'"%fname)
+    stages = { }
+    for name, stage in data['stages'].items():
+        if not isinstance(stage, dict) or 'notebook' not in stage:
+            raise ValueError("%s: stage %s has no notebook"%(fname, name))
+        unknown = set(stage) - STAGE_KEYS
+        if unknown:
+            raise ValueError("%s: unknown keys in stage %s: %s"%(
+                fname, name, ', '.join(sorted(unknown))))
+        stages[name] = {'notebook': stage['notebook'],
+                        'needs': _list(stage.get('needs')),
+                        'inputs': _list(stage.get('inputs')),
+                        'outputs': _outputs(stage.get('outputs')),
+                        'args': _list(stage.get('args')),
+                        'nbscript': _list(stage.get('nbscript')),
+                        'slurm': _list(stage.get('slurm')),
+                        }
+    for name, stage in stages.items():
+        for need in stage['needs']:
+            if need not in stages:
+                raise ValueError("%s: stage %s needs unknown stage %s"%(fname, name, need))
+    order(stages)
+    return stages
+
+
+def order(stages):
+    """Stage names so that each comes after the stages it needs"""
+    done = [ ]
+    visiting = set()
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError("Stages depend on each other: %s"%name)
+        visiting.add(name)
+        for need in stages[name]['needs']:
+            visit(need)
+        visiting.discard(name)
+        done.append(name)
+    for name in stages:
+        visit(name)
+    return done
+
+
+def stage_args(stages, name):
+    """The notebook arguments of a stage, with {stage.output} replaced"""
+    def replace(m):
+        stage, output = m.groups()
+        if stage not in stages or output not in stages[stage]['outputs']:
+            raise ValueError("Stage %s: unknown output %s"%(name, m.group(0)))
+        return stages[stage]['outputs'][output]
+    return [_REF_RE.sub(replace, arg) for arg in stages[name]['args']]
+
+
+def stage_inputs(stages, name):
+    """Input files of a stage: its own inputs and the outputs it needs"""
+    inputs = list(stages[name]['inputs'])
+    for need in stages[name]['needs']:
+        inputs.extend(sorted(stages[need]['outputs'].values()))
+    return inputs
+
+
+def command(stages, name):
+    """The nbscript command line of a stage"""
+    options = stages[name]['nbscript']
+    if not any(opt in ('--save', '-o') or opt.startswith('--output') for opt in options):
+        options = ['--save'] + options
+    return ['nbscript'] + options + [stages[name]['notebook']] + stage_args(stages, name)
+
+
+def stage_env(stages, name, pipeline_fname):
+    """Environment variables of a stage's nbscript"""
+    return {PIPELINE_ENV: os.path.abspath(pipeline_fname),
+            STAGE_ENV: name,
+            'NBSCRIPT_INPUTS': json.dumps(dict(
+                (need, stages[need]['outputs']) for need in stages[name]['needs'])),
+            'NBSCRIPT_OUTPUTS': json.dumps(stages[name]['outputs']),
+            }
+
+
+def _notebook_hash(fname):
+    """Hash of the code of a notebook (not its outputs or metadata)"""
+    with open(fname) as f:
+        nb = json.load(f)
+    code = [(cell.get('cell_type'), ''.join(cell.get('source', '')))
+            for cell in nb.get('cells', [ ])]
+    return hashlib.sha256(json.dumps(code).encode('utf-8')).hexdigest()
+
+
+def stamp(stages, name):
+    """What determines the result of a stage, or None if an input is missing.
+
+    Paths are relative to the current directory (the pipeline's).
+    """
+    from .cache import file_hash
+    try:
+        inputs = dict((fname, file_hash(fname)) for fname in stage_inputs(stages, name))
+        return {'notebook': _notebook_hash(stages[name]['notebook']),
+                'command': command(stages, name),
+                'inputs': inputs}
+    except (IOError, OSError):
+        return None
+
+
+def stamp_fname(pipeline_fname, name):
+    return os.path.join(os.path.abspath(pipeline_fname) + '.stamps', name + '.json')
+
+
+def up_to_date(stages, name, pipeline_fname):
+    """Whether the stage already ran with the same stamp and its outputs exist"""
+    fname = stamp_fname(pipeline_fname, name)
+    if not os.path.exists(fname):
+        return False
+    with open(fname) as f:
+        old = json.load(f)
+    if not all(os.path.exists(out) for out in stages[name]['outputs'].values()):
+        return False
+    return old.get('stamp') == stamp(stages, name)
+
+
+def _has_errors(output_fname):
+    if not output_fname or not output_fname.endswith('.ipynb') \
+            or not os.path.exists(output_fname):
+        return False
+    with open(output_fname) as f:
+        nb = json.load(f)
+    return any(out.get('output_type') == 'error'
+               for cell in nb.get('cells', [ ]) for out in cell.get('outputs', [ ]))
+
+
+def run_stage(argv):
+    """Run one stage (nbscript with STAGE_ENV set), record its stamp if it succeeds"""
+    from . import nbscript
+    from .checkpoint import atomic_write
+    pipeline_fname = os.environ.pop(PIPELINE_ENV)
+    name = os.environ.pop(STAGE_ENV)
+    stages = read_pipeline(pipeline_fname)
+    current = stamp(stages, name)
+    output_fname = nbscript.nbscript(argv, _return_names=True)['output_fname']
+    start = time.time()
+    ret = nbscript.nbscript(argv)
+    if not ret and _has_errors(output_fname):
+        LOG.error("Stage %s: there were errors in %s", name, output_fname)
+        ret = 1
+    if ret:
+        return ret
+    missing = [out for out in stages[name]['outputs'].values() if not os.path.exists(out)]
+    if missing:
+        LOG.error("Stage %s did not write its outputs: %s", name, ', '.join(missing))
+        return 1
+    if current is not None:
+        fname = stamp_fname(pipeline_fname, name)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        atomic_write(fname, json.dumps({'stamp': current, 'time': start,
+                                        'duration': time.time() - start}, indent=1))
+    return 0
+
+
+def run_local(stages, pipeline_fname, jobs=None, force=False):
+    """Run the stages as local processes, returns {stage: status}.
+
+    Status is 'done', 'skipped', 'failed', or 'blocked' (a stage it
+    needs failed).
+    """
+    jobs = jobs or os.cpu_count() or 1
+    status = { }
+    pending = order(stages)
+    running = { }
+    while pending or running:
+        for name in list(pending):
+            needs = [status.get(need) for need in stages[name]['needs']]
+            if any(s in ('failed', 'blocked') for s in needs):
+                LOG.error("Not running %s: a stage it needs failed", name)
+                status[name] = 'blocked'
+                pending.remove(name)
+            elif all(s in ('done', 'skipped') for s in needs):
+                if not force and up_to_date(stages, name, pipeline_fname):
+                    LOG.info("Stage %s is up to date", name)
+                    status[name] = 'skipped'
+                    pending.remove(name)
+                elif len(running) < jobs:
+                    cmd = command(stages, name)
+                    LOG.info("Running stage %s: %s", name, ' '.join(cmd))
+                    env = dict(os.environ)
+                    env.update(stage_env(stages, name, pipeline_fname))
+                    running[name] = subprocess.Popen(cmd, env=env)
+                    pending.remove(name)
+        if not running:
+            continue
+        time.sleep(0.1)
+        for name, p in list(running.items()):
+            if p.poll() is not None:
+                del running[name]
+                status[name] = 'done' if p.returncode == 0 else 'failed'
+                if p.returncode:
+                    LOG.error("Stage %s failed with return code %s", name, p.returncode)
+    return status
+
+
+def submit_slurm(stages, pipeline_fname, force=False):
+    """Submit the stages with snotebook, returns {stage: job ID or 'skipped'}"""
+    from .jobdb import parse_job_id
+    submitted = { }
+    for name in order(stages):
+        deps = [submitted[need] for need in stages[name]['needs']
+                if submitted[need] != 'skipped']
+        if not deps and not force and up_to_date(stages, name, pipeline_fname):
+            LOG.info("Stage %s is up to date", name)
+            submitted[name] = 'skipped'
+            continue
+        cmd = ['snotebook'] + stages[name]['slurm']
+        if deps:
+            cmd.append('--dependency=afterok:' + ':'.join(deps))
+        cmd += ['---'] + command(stages, name)[1:]
+        LOG.info("Submitting stage %s: %s", name, ' '.join(cmd))
+        env = dict(os.environ)
+        env.update(stage_env(stages, name, pipeline_fname))
+        output = subprocess.check_output(cmd, env=env).decode('utf-8', 'replace')
+        sys.stdout.write(output)
+        job_id = parse_job_id(output)
+        if job_id is None:
+            raise RuntimeError("Could not find the job ID of stage %s in %r"%(name, output))
+        submitted[name] = job_id
+    return submitted
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='nbscript pipeline',
+                                     description="Run a pipeline of notebooks.")
+    parser.add_argument("pipeline", help="Pipeline file (YAML or JSON)")
+    parser.add_argument("--slurm", action='store_true',
+                        help="Submit the stages with snotebook, with dependencies")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Stages running at once locally (default: number of CPUs)")
+    parser.add_argument("--force", action='store_true',
+                        help="Run also the stages which are up to date")
+    args = parser.parse_args(argv)
+
+    stages = read_pipeline(args.pipeline)
+    pipeline_fname = os.path.abspath(args.pipeline)
+    old_cwd = os.getcwd()
+    os.chdir(os.path.dirname(pipeline_fname))
+    try:
+        if args.slurm:
+            submit_slurm(stages, pipeline_fname, force=args.force)
+            return 0
+        status = run_local(stages, pipeline_fname, jobs=args.jobs, force=args.force)
+    finally:
+        os.chdir(old_cwd)
+    for name in order(stages):
+        LOG.info("%-20s %s", name, status[name])
+    return 1 if any(s in ('failed', 'blocked') for s in status.values()) else 0
@@ -0,0 +1,159 @@
+"""Per-cell timing and memory profiling.
+
+With `nbscript --profile`, the wall time, CPU time (user+system,
+including waited-for child processes) and peak RSS of the kernel are
+measured for each cell.  They are stored in the cell metadata
+(`metadata.nbscript.profile`), written to `OUTPUT.profile.json` and
+`OUTPUT.profile.csv`, and the slowest cells are printed to stderr.
+
+The kernel process is measured from the outside through /proc (Linux),
+or psutil if that is installed.  On Linux the peak RSS is reset before
+each cell so it is the peak of that cell; otherwise it is the peak
+since the kernel started.
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import sys
+
+from .events import clock
+
+LOG = logging.getLogger('nbscript.profiling')
+
+_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+FIELDS = ['index', 'execution_count', 'wall_time', 'cpu_time', 'peak_rss', 'source']
+
+
+def kernel_pid(ep):
+    """pid of the kernel process of an ExecutePreprocessor, or None"""
+    km = getattr(ep, 'km', None)
+    process = getattr(getattr(km, 'provisioner', None), 'process', None)
+    if process is None:
+        process = getattr(km, 'kernel', None)
+    return getattr(process, 'pid', None)
+
+
+class ProcessStats(object):
+    """CPU time and peak RSS of one process"""
+    def __init__(self, pid):
+        self.pid = pid
+        self._proc = '/proc/%d'%pid
+        self._psutil = None
+        if not os.path.exists(self._proc):
+            try:
+                import psutil
+                self._psutil = psutil.Process(pid)
+            except ImportError:
+                pass
+
+    def cpu_time(self):
+        """Seconds of CPU time used, or None"""
+        if self._psutil is not None:
+            t = self._psutil.cpu_times()
+            return t.user + t.system + t.children_user + t.children_system
+        try:
+            with open(self._proc + '/stat') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            return None
+        # The command name may contain spaces, the fields are after ')'.
+        fields = stat.rsplit(')', 1)[1].split()
+        return sum(int(x) for x in fields[11:15]) / float(_TICKS)
+
+    def reset_peak_rss(self):
+        """Reset the peak RSS to the current RSS, if possible (Linux)"""
+        try:
+            with open(self._proc + '/clear_refs', 'w') as f:
+                f.write('5')
+        except (IOError, OSError):
+            pass
+
+    def peak_rss(self):
+        """Peak resident memory in bytes, or None"""
+        if self._psutil is not None:
+            info = self._psutil.memory_info()
+            return getattr(info, 'peak_wset', None) or info.rss
+        try:
+            with open(self._proc + '/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+        return None
+
+
+class Profiler(object):
+    """Execution listener which measures each cell"""
+    def __init__(self):
+        self.results = [ ]
+        self._stats = None
+        self._start = None
+
+    def cell_start(self, ep, cell, index):
+        if cell.cell_type != 'code':
+            return
+        if self._stats is None:
+            pid = kernel_pid(ep)
+            if pid is not None:
+                self._stats = ProcessStats(pid)
+        cpu = None
+        if self._stats is not None:
+            self._stats.reset_peak_rss()
+            cpu = self._stats.cpu_time()
+        self._start = (clock(), cpu)
+
+    def cell_end(self, ep, cell, index):
+        if cell.cell_type != 'code' or self._start is None:
+            return
+        wall_start, cpu_start = self._start
+        self._start = None
+        profile = {'wall_time': clock() - wall_start,
+                   'cpu_time': None,
+                   'peak_rss': None}
+        if self._stats is not None:
+            cpu = self._stats.cpu_time()
+            if cpu is not None and cpu_start is not None:
+                profile['cpu_time'] = cpu - cpu_start
+            profile['peak_rss'] = self._stats.peak_rss()
+        cell.metadata.setdefault('nbscript', { })['profile'] = profile
+        result = dict(profile)
+        result['index'] = index
+        result['execution_count'] = cell.get('execution_count')
+        result['source'] = cell.source.split('\n', 1)[0]
+        self.results.append(result)
+
+    def write(self, fname_base):
+        """Write FNAME_BASE.profile.json and FNAME_BASE.profile.csv"""
+        with open(fname_base + '.profile.json', 'w') as f:
+            json.dump({'cells': self.results}, f, indent=1)
+        if sys.version_info[0] >= 3:
+            f = io.open(fname_base + '.profile.csv', 'w', newline='')
+        else:
+            f = open(fname_base + '.profile.csv', 'wb')
+        with f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            for result in self.results:
+                writer.writerow(result)
+
+    def summary(self, n=5, stream=None):
+        """Print the n slowest cells"""
+        stream = stream if stream is not None else sys.stderr
+        total = sum(r['wall_time'] for r in self.results)
+        stream.write('nbscript profile: %d cells, %.2fs total, slowest:\n'%(
+            len(self.results), total))
+        stream.write('  %5s %10s %10s %10s  %s\n'%('cell', 'wall(s)', 'cpu(s)',
+                                                  'rss(MB)', 'source'))
+        top = sorted(self.results, key=lambda r: r['wall_time'], reverse=True)[:n]
+        for r in top:
+            stream.write('  %5d %10.3f %10s %10s  %s\n'%(
+                r['index'], r['wall_time'],
+                '-' if r['cpu_time'] is None else '%.3f'%r['cpu_time'],
+                '-' if r['peak_rss'] is None else '%.1f'%(r['peak_rss']/2.**20),
+                r['source'][:40]))
+        stream.flush()
@@ -0,0 +1,182 @@
+"""Re-running only the cells which changed.
+
+`nbscript --rerun PREVIOUS.ipynb` compares the notebook with a previous
+output which has a saved kernel state (made with `--checkpoint-state`,
+covering the whole notebook).  Code cells are matched to the previous
+ones by their source, and the names each cell defines and uses are
+found by static analysis (`nbscript.names`).  A cell is run again if
+
+* it is new or changed, or its previous run was incomplete or failed,
+* it uses or redefines a name which a re-run cell defines, may change
+  in place (`x.append(1)`, `f(x)`) or uses, or which a changed or
+  removed cell defined before (and so on, transitively).
+
+The other cells keep their previous outputs, and the saved state is
+loaded into the kernel before the first cell which runs.  This is only
+safe if that state has the values the re-run cells expect: each name a
+re-run cell uses must still have the value from the same (unchanged)
+cell which defines it before that cell in the new notebook.  When that
+can't be made true, or a cell can't be analyzed (cell magics,
+`from x import *`), the whole notebook is run.
+
+Objects which a cell may change in place count as defined by it, so
+if a re-run cell changes an object whose saved value already has the
+old cell's changes, the whole notebook is run.  Like all static
+analysis this is an approximation: changes made through aliases,
+files, or other modules aren't seen.  Cells which only do such things
+are re-run only when they change themselves.
+"""
+
+import difflib
+import logging
+import os
+
+import nbformat
+
+from . import names
+from .resume import LOAD_STATE_CODE, _cell_complete
+
+LOG = logging.getLogger('nbscript.rerun')
+
+
+def plan_rerun(nb, previous):
+    """Plan re-running `nb` from `previous`.
+
+    Returns (cells to run, {index in nb: index in previous} of the
+    cells to take from previous), or None if the whole notebook has to
+    run.
+    """
+    n_state = previous.metadata.get('nbscript', { }).get('state_cells', 0)
+    code = [i for i, cell in enumerate(nb.cells) if cell.cell_type == 'code']
+    prev_code = [k for k, cell in enumerate(previous.cells[:n_state])
+                 if cell.cell_type == 'code']
+
+    matcher = difflib.SequenceMatcher(None, [nb.cells[i].source for i in code],
+                                      [previous.cells[k].source for k in prev_code],
+                                      autojunk=False)
+    mapping = { }
+    for a, b, size in matcher.get_matching_blocks():
+        for j in range(size):
+            if _cell_complete(previous.cells[prev_code[b+j]]):
+                mapping[code[a+j]] = prev_code[b+j]
+
+    new = dict((i, names.analyze(nb.cells[i].source)) for i in code)
+    old = dict((k, names.analyze(previous.cells[k].source)) for k in prev_code)
+    if None in new.values() or None in old.values():
+        return None
+    functions = { }
+    modules = set()
+    for info in list(old.values()) + list(new.values()):
+        for name, (reads, writes) in info.functions.items():
+            old_reads, old_writes = functions.get(name, (set(), set()))
+            functions[name] = (old_reads | reads, old_writes | writes)
+        modules |= info.modules
+    new = dict((i, names.effects(info, functions, modules)) for i, info in new.items())
+    old = dict((k, names.effects(info, functions, modules)) for k, info in old.items())
+
+    # Names whose saved values came from cells which are gone.
+    stale = set()
+    for k in set(prev_code) - set(mapping.values()):
+        stale |= old[k][1]
+
+    dirty = set(i for i in code if i not in mapping)
+    for _ in range(len(code) + 1):
+        dirty_names = set(stale)
+        for i in code:
+            reads, writes = new[i]
+            if i not in dirty and (reads | writes) & dirty_names:
+                dirty.add(i)
+            if i in dirty:
+                # What a re-run cell reads may be changed in ways
+                # which aren't seen (aliases), so its readers run too.
+                dirty_names |= writes | reads
+
+        def same(want, have):
+            # want: cell of nb which should have set the value last,
+            # have: where the value in the kernel would come from.
+            if want is None:
+                return have is None
+            if want in dirty:
+                return have == ('new', want)
+            return have in (('new', want), ('old', mapping[want]))
+
+        # Simulate which cell set each name: first the saved state,
+        # then the re-run cells.
+        have = { }
+        for k in prev_code:
+            for name in old[k][1]:
+                have[name] = ('old', k)
+        want = { }
+        for i in code:
+            if i in dirty:
+                if not all(same(want.get(n), have.get(n)) for n in new[i][0]):
+                    return None
+                for name in new[i][1]:
+                    have[name] = ('new', i)
+            for name in new[i][1]:
+                want[name] = i
+        # The final state has to be right too, for the next cells.
+        wrong = set(i for n, i in want.items() if not same(i, have.get(n)))
+        if not wrong:
+            return dirty, dict((i, k) for i, k in mapping.items() if i not in dirty)
+        if wrong & dirty:
+            return None
+        dirty |= wrong
+    return None
+
+
+class PartialRerun(object):
+    """Execution listener which skips the cells which don't need to run
+    again, and loads the saved state before the first one which does."""
+    def __init__(self, previous_fname):
+        self.previous_fname = previous_fname
+        self.reuse = { }
+        self.state = None
+        self.last = None
+
+    def prepare(self, nb):
+        if not os.path.exists(self.previous_fname):
+            LOG.info("%s does not exist, running everything", self.previous_fname)
+            return
+        previous = nbformat.read(self.previous_fname, as_version=4)
+        meta = previous.metadata.get('nbscript', { })
+        state = meta.get('state')
+        if state is not None:
+            state = os.path.join(os.path.dirname(os.path.abspath(self.previous_fname)),
+                                 state)
+        if state is None or not os.path.exists(state):
+            LOG.warning("Can not re-run from %s (no saved state), running everything",
+                        self.previous_fname)
+            return
+        plan = plan_rerun(nb, previous)
+        if plan is None:
+            LOG.warning("Can not re-run only the changed cells of %s, running everything",
+                        self.previous_fname)
+            return
+        dirty, self.reuse = plan
+        for index, old_index in self.reuse.items():
+            old = previous.cells[old_index]
+            nb.cells[index].outputs = old.outputs
+            nb.cells[index].execution_count = old.execution_count
+        LOG.info("Re-running %d of %d code cells", len(dirty),
+                 len(dirty) + len(self.reuse))
+        self.state = state
+        if dirty:
+            self.last = max(dirty)
+        else:
+            nb.metadata['nbscript'] = meta
+
+    def skip_cell(self, ep, cell, index):
+        return index in self.reuse
+
+    def cell_start(self, ep, cell, index):
+        if self.state is not None:
+            ep.run_code(LOAD_STATE_CODE%self.state)
+            self.state = None
+
+    def cell_end(self, ep, cell, index):
+        # After the last cell which runs, the state has the values of
+        # all cells.  This listener comes after the checkpointer.
+        meta = ep.nb.metadata.get('nbscript', { })
+        if index == self.last and meta.get('state_cells') == index + 1:
+            meta['state_cells'] = len(ep.nb.cells)
@@ -0,0 +1,88 @@
+"""Resuming an interrupted run from its checkpoint.
+
+With `--checkpoint-state`, each checkpoint made at the end of a cell
+also saves the kernel's global namespace with dill (to `CHECKPOINT.state`)
+and records in the notebook metadata how many cells the state covers.
+
+`nbscript --resume PREVIOUS.ipynb` then reads that checkpoint.  If the
+first `state_cells` cells are unchanged and ran completely without
+errors, their outputs are copied, the state is loaded into the new
+kernel, and execution continues from the next cell.  Otherwise (or if
+there is no state) the notebook is run from the beginning.
+"""
+
+import logging
+import os
+
+import nbformat
+
+LOG = logging.getLogger('nbscript.resume')
+
+SAVE_STATE_CODE = "__import__('dill').dump_session(%r)"
+LOAD_STATE_CODE = "__import__('dill').load_session(%r)"
+
+
+def state_fname(checkpoint_fname):
+    """Filename of the kernel state saved with a checkpoint"""
+    return checkpoint_fname + '.state'
+
+
+def _cell_complete(cell):
+    if cell.cell_type != 'code' or not cell.source.strip():
+        return True
+    if cell.get('execution_count') is None:
+        return False
+    return not any(out.output_type == 'error' for out in cell.outputs)
+
+
+def find_resume_point(nb, previous):
+    """Number of cells of `nb` which can be taken from `previous`, and the
+    state file to load (or 0, None)."""
+    meta = previous.metadata.get('nbscript', { })
+    n_cells = meta.get('state_cells', 0)
+    if not meta.get('state') or n_cells > min(len(nb.cells), len(previous.cells)):
+        return 0, None
+    for cell, old in zip(nb.cells[:n_cells], previous.cells[:n_cells]):
+        if cell.cell_type != old.cell_type or cell.source != old.source:
+            return 0, None
+        if not _cell_complete(old):
+            return 0, None
+    return n_cells, meta['state']
+
+
+class Resumer(object):
+    """Execution listener which skips the already done cells and loads
+    the saved state before the first executed cell."""
+    def __init__(self, previous_fname):
+        self.previous_fname = previous_fname
+        self.n_cells = 0
+        self.state = None
+
+    def prepare(self, nb):
+        if not os.path.exists(self.previous_fname):
+            LOG.info("%s does not exist, not resuming", self.previous_fname)
+            return
+        previous = nbformat.read(self.previous_fname, as_version=4)
+        n_cells, state = find_resume_point(nb, previous)
+        if state is not None:
+            state = os.path.join(os.path.dirname(os.path.abspath(self.previous_fname)),
+                                 state)
+        if state is None or not os.path.exists(state):
+            LOG.warning("Can not resume from %s (no usable saved state), "
+                        "running from the beginning", self.previous_fname)
+            return
+        for cell, old in zip(nb.cells[:n_cells], previous.cells[:n_cells]):
+            if cell.cell_type == 'code':
+                cell.outputs = old.outputs
+                cell.execution_count = old.execution_count
+        LOG.info("Resuming from %s after cell %d", self.previous_fname, n_cells)
+        self.n_cells = n_cells
+        self.state = state
+
+    def skip_cell(self, ep, cell, index):
+        return index < self.n_cells
+
+    def cell_start(self, ep, cell, index):
+        if self.state is not None:
+            ep.run_code(LOAD_STATE_CODE%self.state)
+            self.state = None
@@ -0,0 +1,181 @@
+"""Streaming scan of notebook files.
+
+snotebook only needs the source of the first code cell (for `#SBATCH`
+lines) and nbscript only the notebook metadata before it starts, but
+reading the notebook with nbformat parses, upgrades and
+validates all of it, which for notebooks with large outputs takes
+seconds and a lot of memory.  This reads the JSON incrementally, skips
+over everything else without decoding it, and stops as soon as it has
+found what it needs.
+"""
+
+import io
+import json
+import re
+
+_WS_RE = re.compile(r'[ \t\n\r]*')
+_PLAIN_RE = re.compile(r'[^"\[\]{}]*')
+_SCALAR_RE = re.compile(r'[^,\]}]*')
+_decoder = json.JSONDecoder()
+
+
+class _Reader(object):
+    """Incremental reading of JSON text from a file"""
+    def __init__(self, f, chunk_size=2**16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+
+    def more(self):
+        """Read the next chunk, dropping what has already been consumed"""
+        data = self.f.read(self.chunk_size)
+        if not data:
+            raise ValueError("Unexpected end of file")
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        """Next non-whitespace character"""
+        while True:
+            self.pos = _WS_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self.more()
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected %r, got %r"%(chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                self.more()   # maybe it's incomplete
+                continue
+            if end == len(self.buf) and not isinstance(value, (str, list, dict)):
+                # A number might continue in the next chunk.
+                try:
+                    self.more()
+                except ValueError:
+                    pass
+                else:
+                    continue
+            self.pos = end
+            return value
+
+    def _skip_string(self):
+        # self.pos is after the opening quote.
+        while True:
+            i = self.buf.find('"', self.pos)
+            if i == -1:
+                # Keep trailing backslashes, they may escape the next quote.
+                self.pos = len(self.buf.rstrip('\\'))
+                self.more()
+                continue
+            j = i
+            while j > 0 and self.buf[j-1] == '\\':
+                j -= 1
+            self.pos = i + 1
+            if (i - j) % 2 == 0:
+                return
+
+    def skip(self):
+        """Skip over the next value without decoding it"""
+        c = self.peek()
+        if c not in '"[{':
+            while True:
+                self.pos = _SCALAR_RE.match(self.buf, self.pos).end()
+                if self.pos < len(self.buf):
+                    return
+                self.more()
+        depth = 0
+        while True:
+            if self.pos >= len(self.buf):
+                self.more()
+            c = self.buf[self.pos]
+            self.pos += 1
+            if c == '"':
+                self._skip_string()
+            elif c in '[{':
+                depth += 1
+            elif c in ']}':
+                depth -= 1
+            else:
+                self.pos = _PLAIN_RE.match(self.buf, self.pos).end()
+            if depth == 0:
+                return
+
+    def items(self):
+        """Iterate over the keys of an object, the caller reads or skips each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Expected a key, got %r"%(key,))
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """Iterate over the elements of an array, the caller reads or skips each"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+def first_code_cell_source(fname, chunk_size=2**16):
+    """Source of the first code cell of a v4 notebook, or None if none.
+
+    Raises ValueError if the file isn't a notebook of the expected
+    format (for example nbformat 3, which has worksheets).
+    """
+    with io.open(fname, encoding='utf-8') as f:
+        reader = _Reader(f, chunk_size=chunk_size)
+        for key in reader.items():
+            if key != 'cells':
+                if key == 'worksheets':
+                    raise ValueError("Old notebook format")
+                reader.skip()
+                continue
+            for _ in reader.elements():
+                cell_type = source = None
+                for cell_key in reader.items():
+                    if cell_key == 'cell_type':
+                        cell_type = reader.value()
+                    elif cell_key == 'source':
+                        source = reader.value()
+                    else:
+                        reader.skip()
+                if cell_type == 'code':
+                    if isinstance(source, list):
+                        source = ''.join(source)
+                    return source or ''
+            return None
+    raise ValueError("No cells in notebook")
+
+
+def notebook_metadata(fname, chunk_size=2**16):
+    """The top-level metadata of a notebook, without decoding the cells"""
+    with io.open(fname, encoding='utf-8') as f:
+        reader = _Reader(f, chunk_size=chunk_size)
+        for key in reader.items():
+            if key == 'metadata':
+                return reader.value()
+            reader.skip()
+    return { }
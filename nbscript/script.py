@@ -0,0 +1,287 @@
+"""Compiling notebooks to plain Python scripts.
+
+`nbscript --compile` turns the code cells of a notebook into a Python
+module, and `nbscript --fast` runs that module in this process: no
+kernel, no output capture and no output notebook, so a run costs about
+as much as `python nb.py`.  `nbscript.argv` works the same as in a
+kernel.
+
+Compiled modules are cached under the cache directory, keyed on a hash
+of the notebook file, so repeated runs don't parse the notebook at all.
+
+IPython syntax is translated where there is a plain Python equivalent
+(`!cmd`, `%cd`, `%env`, `%time`, `%%bash`, `%%time`) or removed where it
+only matters interactively (`%matplotlib`, `%load_ext`, ...).  Other
+magics are rejected with `CompileError`.  Like IPython, `!cmd` expands
+`{expr}` and `$name` with the variables when it runs (if that fails,
+the command is run as it is).  Lines within multi-line strings are
+never translated.  As in a kernel, the value of
+an expression at the end of a cell is printed.  Unlike a kernel run,
+an exception ends the run.
+"""
+
+import ast
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import runpy
+import sys
+import traceback
+
+LOG = logging.getLogger('nbscript.script')
+
+# Change when the generated code changes, to invalidate old modules.
+COMPILER_VERSION = '2'
+
+# Line magics which don't do anything outside of an interactive session.
+IGNORED_MAGICS = {'matplotlib', 'load_ext', 'reload_ext', 'autoreload', 'aimport',
+                  'config', 'pylab', 'precision', 'pprint', 'xmode', 'colors',
+                  'autosave', 'who', 'whos', 'lsmagic'}
+
+_LINE_MAGIC_RE = re.compile(r'^(\s*)%([A-Za-z_]\w*)[ \t]*(.*)$')
+_SHELL_RE = re.compile(r'^(\s*)!(.*)$')
+
+HEADER = '''\
+# Compiled by nbscript from %(notebook)s (sha256 %(digest)s).
+# Do not edit: this file is regenerated when the notebook changes.
+
+
+def __nbscript_display__(value):
+    if value is not None:
+        print(repr(value))
+
+
+def __nbscript_expand__(cmd, depth=1):
+    # Like IPython: {expr} and $name (not in single quotes) are
+    # evaluated in the caller's namespace, $$ is $.  If anything can't
+    # be evaluated, the command stays as it is.
+    import re, string, sys
+    frame = sys._getframe(depth + 1)
+    ns = dict(frame.f_globals)
+    ns.update(frame.f_locals)
+    class Formatter(string.Formatter):
+        def get_field(self, field_name, args, kwargs):
+            return eval(field_name, ns), field_name
+    def dollar(m):
+        return '$' + m.group(2) if m.group(1) else '{' + m.group(2) + '}'
+    fmt = ''.join(part if part.startswith("'") and part.endswith("'") and len(part) > 1
+                  else re.sub(r'\\$(\\$?)([\\w.]+)', dollar, part)
+                  for part in re.split(r"('[^'\\n]*')", cmd))
+    try:
+        return Formatter().vformat(fmt, (), { })
+    except Exception:
+        return cmd
+
+
+def __nbscript_system__(cmd, executable=None):
+    import subprocess, sys
+    if executable is None:
+        cmd = __nbscript_expand__(cmd)
+    sys.stdout.flush()
+    subprocess.call(cmd, shell=True, executable=executable)
+
+'''
+
+
+class CompileError(ValueError):
+    """The notebook has syntax which can't be run without IPython"""
+
+
+def notebook_digest(notebook):
+    """sha256 of the notebook file (and of the compiler version)"""
+    h = hashlib.sha256(COMPILER_VERSION.encode())
+    with open(notebook, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def _string_lines(source):
+    """Indices of the lines which begin inside a string literal"""
+    inside = set()
+    lineno = 0
+    quote = None
+    i = 0
+    while i < len(source):
+        c = source[i]
+        if c == '\n':
+            lineno += 1
+            if quote is not None and len(quote) == 1:
+                quote = None            # unterminated, not Python anyway
+            elif quote is not None:
+                inside.add(lineno)
+        elif quote is None:
+            if c == '#':
+                while i + 1 < len(source) and source[i+1] != '\n':
+                    i += 1
+            elif c in '"\'':
+                quote = c * 3 if source.startswith(c * 3, i) else c
+                i += len(quote)
+                continue
+        elif c == '\\':
+            if source[i+1:i+2] == '\n':
+                lineno += 1
+                inside.add(lineno)
+            i += 2
+            continue
+        elif source.startswith(quote, i):
+            i += len(quote)
+            quote = None
+            continue
+        i += 1
+    return inside
+
+
+def _translate_line_magic(indent, name, arg, where):
+    if name in IGNORED_MAGICS:
+        return indent + 'pass'
+    if name == 'time':
+        return indent + arg
+    if name in ('cd', 'env') and re.search(r'[${]', arg):
+        raise CompileError("%s: variables in %%%s are not supported by --compile"%(where, name))
+    if name == 'cd':
+        return indent + '__import__("os").chdir(%r)'%os.path.expanduser(arg)
+    if name == 'env' and arg.strip():
+        parts = re.split(r'\s*=\s*|\s+', arg.strip(), 1)
+        if len(parts) == 2:
+            return indent + '__import__("os").environ[%r] = %r'%tuple(parts)
+        return indent + 'print(__import__("os").environ.get(%r))'%parts[0]
+    raise CompileError("%s: magic %%%s is not supported by --compile"%(where, name))
+
+
+def _translate_cell(source, where):
+    """IPython cell source --> Python source"""
+    lines = source.split('\n')
+    if source.lstrip().startswith('%%'):
+        first, body = (source.lstrip().split('\n', 1) + [''])[:2]
+        name = first[2:].split()[0] if first[2:].split() else ''
+        if name in ('bash', 'sh') and first[2:].split() == [name]:
+            return '__nbscript_system__(%r, executable=%r)'%(body, '/bin/'+name)
+        if name == 'time' and first[2:].split() == [name]:
+            return _translate_cell(body, where)
+        raise CompileError("%s: cell magic %%%%%s is not supported by --compile"%(where, name))
+    out = [ ]
+    strings = _string_lines(source)
+    for lineno, line in enumerate(lines):
+        if lineno in strings:
+            out.append(line)
+            continue
+        m = _SHELL_RE.match(line)
+        if m:
+            out.append(m.group(1) + '__nbscript_system__(%r)'%m.group(2))
+            continue
+        m = _LINE_MAGIC_RE.match(line)
+        if m:
+            out.append(_translate_line_magic(m.group(1), m.group(2), m.group(3), where))
+            continue
+        if re.search(r'=\s*[!%]', line) and not line.lstrip().startswith('#'):
+            try:
+                ast.parse(line.strip())
+            except SyntaxError:
+                raise CompileError("%s: assigning the result of a magic or shell "
+                                   "command is not supported by --compile"%where)
+        out.append(line)
+    return '\n'.join(out)
+
+
+def _display_last_expr(source, where):
+    """Print the value of an expression at the end of the cell, like a kernel"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        raise CompileError("%s: %s"%(where, e))
+    if not tree.body or not isinstance(tree.body[-1], ast.Expr):
+        return source
+    if source.rstrip().endswith(';'):
+        return source
+    node = tree.body[-1]
+    lines = source.split('\n')
+    # The expression is the last statement, so it goes to the end of the
+    # cell (trailing comments are fine within the parentheses).  Offsets
+    # are in UTF-8 bytes.
+    first = lines[node.lineno-1].encode('utf-8')
+    segment = '\n'.join([first[node.col_offset:].decode('utf-8')] + lines[node.lineno:])
+    lines[node.lineno-1:] = [
+        first[:node.col_offset].decode('utf-8') + '__nbscript_display__((\n'
+        + segment + '\n))']
+    return '\n'.join(lines)
+
+
+def compile_source(nb, notebook, digest=''):
+    """Python source of the script for a notebook (a dict)"""
+    parts = [HEADER%{'notebook': os.path.basename(notebook), 'digest': digest}]
+    for index, cell in enumerate(nb['cells']):
+        if cell['cell_type'] != 'code':
+            continue
+        source = cell['source']
+        if isinstance(source, list):
+            source = ''.join(source)
+        where = '%s cell %d'%(notebook, index)
+        source = _display_last_expr(_translate_cell(source, where), where)
+        parts.append('# In[%d]:\n%s\n\n'%(index, source))
+    return '\n'.join(parts)
+
+
+def compile_notebook(notebook, cache_dir=None):
+    """Compile a notebook (if not cached), return the module's filename"""
+    from .cache import default_cache_dir
+    from .checkpoint import atomic_write
+    cache_dir = os.path.join(cache_dir or default_cache_dir(), 'compiled')
+    digest = notebook_digest(notebook)
+    basename = re.sub(r'\W', '_', os.path.splitext(os.path.basename(notebook))[0])
+    fname = os.path.join(cache_dir, '%s_%s.py'%(basename, digest[:16]))
+    if os.path.exists(fname):
+        LOG.debug('using compiled %s', fname)
+        return fname
+    with io.open(notebook, encoding='utf-8') as f:
+        nb = json.load(f)
+    if nb.get('nbformat', 4) < 4:
+        import nbformat
+        nb = nbformat.read(notebook, as_version=4)
+    source = compile_source(nb, notebook, digest)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    atomic_write(fname, source)
+    LOG.debug('compiled %s to %s', notebook, fname)
+    return fname
+
+
+def run(fname, notebook, argv):
+    """Run a compiled notebook in this process, return the exit status.
+
+    Like a kernel, this runs in the notebook's directory, which is also
+    first in sys.path, so modules next to the notebook can be imported.
+    `argv` is the notebook's argv, which `nbscript.argv` and `sys.argv`
+    are set to.  `nbscript.params` is read from the environment, as in a
+    kernel.
+    """
+    import nbscript
+    from . import nbscript as nbscript_module
+    from . import payload
+    old = (os.getcwd(), sys.argv, nbscript.argv, nbscript_module.argv,
+           nbscript.params, nbscript_module.params)
+    old_path = list(sys.path)
+    fname = os.path.abspath(fname)
+    os.chdir(os.path.dirname(os.path.abspath(notebook)))
+    sys.path.insert(0, os.getcwd())
+    sys.argv = list(argv)
+    nbscript.argv = nbscript_module.argv = list(argv)
+    nbscript.params = nbscript_module.params = payload.lazy_params()
+    try:
+        runpy.run_path(fname, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write('%s\n'%e.code)
+        return 1
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        return 1
+    finally:
+        os.chdir(old[0])
+        sys.path[:] = old_path
+        (sys.argv, nbscript.argv, nbscript_module.argv,
+         nbscript.params, nbscript_module.params) = old[1:]
+    return 0
@@ -6,11 +6,14 @@
 # Relevant documentation:
 #   https://jupyter-notebook.readthedocs.io/en/stable/extending/handlers.html
 
+import codecs
 import json
 import os
-import subprocess
+import shlex
 
-from tornado import web
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 from traitlets import Bool, List, Unicode, Union, HasTraits
 from traitlets.config import Configurable
 #from traitlets import Application
@@ -19,6 +22,13 @@ from jupyter_core.paths import jupyter_config_path
 from notebook.utils import url_path_join as ujoin
 from notebook.base.handlers import IPythonHandler
 
+from .jobs import FileTail, JobRegistry, sse_event
+
+# Seconds between keepalive comments on an idle event stream, and
+# between checks of a file being followed.
+KEEPALIVE_INTERVAL = 15
+FILE_POLL_INTERVAL = 1
+
 
 # This does NOT yet work!
 class NBScriptBatch(Configurable):
@@ -44,6 +54,7 @@ class NbscriptBatchHandler(IPythonHandler):
     asynchronous = False
 
     @web.authenticated
+    @gen.coroutine
     def get(self):
         """Do the processing
 
@@ -51,6 +62,11 @@ class NbscriptBatchHandler(IPythonHandler):
 
         HTTP arguments:
              path:  relative path to command
+             asynchronous:  if given ("1"/"0"), overrides the default
+
+        The job is run on the IOLoop (the server isn't blocked).  If
+        asynchronous, return right away, and the status can be found
+        from /nbscript/batch/<id>.  Otherwise return when it is done.
 
         HTTP return body:
             JSON object
@@ -67,44 +83,115 @@ class NbscriptBatchHandler(IPythonHandler):
         base_cmd = self.batch_command
         # print('b'*10, base_cmd)
         if isinstance(base_cmd, str):
-            # String command: substitute {} for fullpath
-            if '{path}' in base_cmd:
-                cmd = base_cmd.format(path=fullpath)
-            else:
-                # if no '{}' in the string, just appendit
-                cmd = base_cmd + ' ' + fullpath
+            # String command: split like a shell would, but run without
+            # a shell, so that the path is always one argument.
+            base_cmd = shlex.split(base_cmd)
+        # Substitute '{path}', and if that doesn't exist in any
+        # arguments, append it.
+        if any('{path}' in x for x in base_cmd):
+            cmd = [x.replace('{path}', fullpath) for x in base_cmd]
         else:
-            # If list command, substitute '{}', and if that doesn't
-            # exist in any arguments, append it.
-            if any('{path}' in x for x in base_cmd):
-                cmd = [x.format(path=fullpath) for x in base_cmd]
-            else:
-                cmd = base_cmd + [fullpath]
+            cmd = base_cmd + [fullpath]
 
         print('c'*10, cmd)
-        ret = {
-            'fullpath': fullpath,
-            'cmd': cmd,
-            'asynchronous': self.asynchronous,
-            }
+        asynchronous = self.asynchronous
+        if self.get_argument('asynchronous', None) is not None:
+            asynchronous = self.get_argument('asynchronous') not in ('', '0', 'false')
 
         # Run the process
-        if self.asynchronous:
-            subprocess.call(cmd)
-        else:
-            # Run in foreground, capture output and so on
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT)
-            out, _ = p.communicate()
-            ret['stdouterr'] = out.decode(errors='backslashreplace')
-            ret['returncode'] = p.returncode
+        job = self.settings['nbscript_jobs'].submit(cmd, fullpath=fullpath)
+        if not asynchronous:
+            yield job.done.wait()
+        ret = job.to_dict(output=not asynchronous)
+        ret['asynchronous'] = asynchronous
 
         # self.set_status(401)
         self.finish(json.dumps(ret))
 
 
+class NbscriptBatchJobHandler(IPythonHandler):
+
+    @web.authenticated
+    def get(self, job_id):
+        """Status of a job: JSON object with status, returncode, stdouterr"""
+        job = self.settings['nbscript_jobs'].get(job_id)
+        if job is None:
+            raise web.HTTPError(404, "No such job: %s"%job_id)
+        self.finish(json.dumps(job.to_dict()))
+
+
+class NbscriptBatchStreamHandler(IPythonHandler):
+    """Stream output as Server-Sent Events.
+
+    /nbscript/batch/<id>/stream streams a job's output, ending with an
+    "end" event (data: the return code) when the job is done.
+    /nbscript/batch/stream?path=X.log follows a file, such as the
+    .log of a snotebook job (add follow=0 to stop at the end of the
+    file).
+
+    Each "data" event has the next piece of output (clients should
+    concatenate them, they don't end at line ends) and its id is the byte
+    offset after it.  To continue after reconnecting, give the offset
+    as the Last-Event-ID header (browsers do this) or offset=N.
+    """
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, job_id=None):
+        job = None
+        if job_id is not None:
+            job = self.settings['nbscript_jobs'].get(job_id)
+            if job is None:
+                raise web.HTTPError(404, "No such job: %s"%job_id)
+            source = job
+        else:
+            root = os.path.realpath(self.settings['notebook_dir'])
+            path = os.path.realpath(os.path.join(root, self.get_argument('path')))
+            if not path.startswith(root + os.sep):
+                raise web.HTTPError(403, "Path outside of notebook directory")
+            if not os.path.isfile(path):
+                raise web.HTTPError(404, "No such file")
+            source = FileTail(path)
+        follow = self.get_argument('follow', '1') not in ('', '0', 'false')
+        offset = int(self.get_argument('offset', None)
+                     or self.request.headers.get('Last-Event-ID') or 0)
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        last_write = IOLoop.current().time()
+        try:
+            while True:
+                data, offset = source.read(offset)
+                if data:
+                    self.write(sse_event(decoder.decode(data), event_id=offset))
+                elif job is not None and job.done.is_set():
+                    self.write(sse_event(str(job.returncode), event='end'))
+                    yield self.flush()
+                    break
+                elif job is None and not follow:
+                    break
+                elif IOLoop.current().time() - last_write > KEEPALIVE_INTERVAL:
+                    self.write(': keepalive\n\n')
+                else:
+                    if job is not None:
+                        yield job.new_output.wait(
+                            timeout=IOLoop.current().time() + KEEPALIVE_INTERVAL)
+                    else:
+                        yield gen.sleep(FILE_POLL_INTERVAL)
+                    continue
+                yield self.flush()
+                last_write = IOLoop.current().time()
+        except StreamClosedError:
+            return
+        self.finish()
+
+
 handlers = [
     (r"/nbscript/batch", NbscriptBatchHandler),
+    (r"/nbscript/batch/stream", NbscriptBatchStreamHandler),
+    (r"/nbscript/batch/([0-9a-f]+)", NbscriptBatchJobHandler),
+    (r"/nbscript/batch/([0-9a-f]+)/stream", NbscriptBatchStreamHandler),
     ]
 
 
@@ -114,6 +201,7 @@ def load_jupyter_server_extension(nbapp):
     webapp = nbapp.web_app
     base_url = webapp.settings['base_url']
     webapp.settings['notebook_dir'] = nbapp.notebook_dir
+    webapp.settings['nbscript_jobs'] = JobRegistry()
     webapp.add_handlers(".*$", [
         (ujoin(base_url, pat), handler)
         for pat, handler in handlers
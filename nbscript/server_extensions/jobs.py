@@ -0,0 +1,189 @@
+"""Registry of batch jobs run by the server extension.
+
+Jobs are run as subprocesses on the Tornado IOLoop, so the notebook
+server isn't blocked while they run.  At most `max_running` jobs run at
+once, the rest wait in the queue.  Only the last `max_finished`
+finished jobs are remembered, and only the last `max_output` bytes of
+each job's output (a ring buffer, so that a streaming client which is
+behind can continue from a byte offset).
+"""
+
+import collections
+import os
+import re
+import shlex
+import subprocess
+import time
+import uuid
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Condition, Event, Semaphore
+from tornado.process import Subprocess
+
+
+def sse_event(data, event=None, event_id=None):
+    """Format one Server-Sent Event.
+
+    SSE ends lines at \\r\\n, \\r or \\n, so a line of data can't
+    contain any of them.  Clients get \\n for each line end (progress
+    bars printed with \\r become separate lines).
+    """
+    lines = [ ]
+    if event is not None:
+        lines.append('event: %s'%event)
+    if event_id is not None:
+        lines.append('id: %s'%event_id)
+    lines.extend('data: %s'%line for line in re.split(r'\r\n|\r|\n', data))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Job(object):
+    """One batch job"""
+    def __init__(self, cmd, info=None, max_output=2**20):
+        self.id = uuid.uuid4().hex
+        self.cmd = cmd
+        self.info = info or { }
+        self.status = 'queued'
+        self.returncode = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = Event()
+        self.new_output = Condition()
+        self.max_output = max_output
+        self.output_dropped = 0     # bytes dropped from the start
+        self.output_total = 0       # bytes received
+        self._output = collections.deque()
+        self._output_size = 0
+
+    def output(self):
+        """Captured stdout and stderr (the retained part), as a string"""
+        return b''.join(self._output).decode('utf-8', 'backslashreplace')
+
+    def append_output(self, data):
+        self._output.append(data)
+        self._output_size += len(data)
+        self.output_total += len(data)
+        while self._output_size > self.max_output:
+            excess = self._output_size - self.max_output
+            first = self._output[0]
+            if len(first) <= excess:
+                self._output.popleft()
+                excess = len(first)
+            else:
+                self._output[0] = first[excess:]
+            self._output_size -= excess
+            self.output_dropped += excess
+        self.new_output.notify_all()
+
+    def read(self, offset):
+        """Output from byte offset on, returns (data, new_offset).
+
+        If that part was already dropped, start from the oldest retained
+        byte.
+        """
+        offset = max(offset, self.output_dropped)
+        parts = [ ]
+        pos = self.output_dropped
+        for chunk in self._output:
+            end = pos + len(chunk)
+            if end > offset:
+                parts.append(chunk[max(offset - pos, 0):])
+            pos = end
+        data = b''.join(parts)
+        return data, offset + len(data)
+
+    def to_dict(self, output=True):
+        ret = dict(self.info)
+        ret.update({
+            'id': self.id,
+            'cmd': self.cmd,
+            'status': self.status,
+            'returncode': self.returncode,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'output_dropped': self.output_dropped,
+            })
+        if output:
+            ret['stdouterr'] = self.output()
+        return ret
+
+
+class JobRegistry(object):
+    """Runs jobs with bounded concurrency and keeps track of them"""
+    def __init__(self, max_running=4, max_finished=100):
+        self.max_finished = max_finished
+        self.jobs = collections.OrderedDict()
+        self._slots = Semaphore(max_running)
+
+    def submit(self, cmd, **info):
+        """Queue a command, return the Job.
+
+        The command is run without a shell, a string is split into
+        arguments with shlex.
+        """
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        job = Job(cmd, info)
+        self.jobs[job.id] = job
+        IOLoop.current().spawn_callback(self._run, job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _forget_old(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+    @gen.coroutine
+    def _run(self, job):
+        with (yield self._slots.acquire()):
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                proc = Subprocess(job.cmd, stdout=Subprocess.STREAM, stderr=subprocess.STDOUT)
+            except (OSError, ValueError) as e:
+                job.append_output(str(e).encode())
+                job.returncode = -1
+                job.status = 'failed'
+            else:
+                try:
+                    while True:
+                        data = yield proc.stdout.read_bytes(65536, partial=True)
+                        job.append_output(data)
+                except StreamClosedError:
+                    pass
+                job.returncode = yield proc.wait_for_exit(raise_error=False)
+                job.status = 'finished' if job.returncode == 0 else 'failed'
+            job.finished = time.time()
+            job.done.set()
+            job.new_output.notify_all()
+        self._forget_old()
+
+
+class FileTail(object):
+    """Read a growing file (such as a Slurm .log) from a byte offset"""
+    def __init__(self, path, max_read=2**16):
+        self.path = path
+        self.max_read = max_read
+
+    def read(self, offset):
+        """Returns (data, new_offset), at most max_read bytes.
+
+        If the file got shorter (rewritten), start from the beginning.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < offset:
+                    offset = 0
+                f.seek(offset)
+                data = f.read(self.max_read)
+        except (IOError, OSError):
+            return b'', offset
+        return data, offset + len(data)
@@ -13,34 +13,73 @@ except ImportError:
     from pipes import quote as shlex_quote
 
 
+from . import events
 from . import nbscript
+from . import sweep
 
 LOG = logging.getLogger('nbscript.snotebook')
 logging.lastResort.setLevel(logging.DEBUG)
 
+# With --auto-resume, seconds before the time limit to requeue the job.
+AUTO_RESUME_SIGNAL_TIME = 300
+
 
 def snotebook(argv=sys.argv[1:]):
+    start_time = events.clock()
     if os.environ.get('NBSCRIPT_RUNNING') is not None:
         LOG.critical("Detected that we are already in snotebook... not executing again.")
         sys.exit(0)
 
-    parser_outer = argparse.ArgumentParser(usage="snotebook [slurm args [--- nbscript args] notebook [nb_argv ...]")
+    # `snotebook status` and `snotebook wait` check on submitted jobs.
+    if argv and argv[0] in ('status', 'wait'):
+        from . import jobdb
+        return jobdb.main(argv)
+
+    parser_outer = argparse.ArgumentParser(usage="snotebook [slurm args [--- nbscript args] notebook [nb_argv ...]\n"
+                                                 "       snotebook {status,wait} [-h] [JOBID ...]")
     parser_outer.add_argument("--srun", action='store_true',
                               help="Run with srun (blocking until complete), not sbatch.  Output to stdout if --output not given.")
     parser_outer.add_argument("--raw", action='store_true',
                               help="Don't run with slurm, direct execution")
+    parser_outer.add_argument("--array", metavar="PARAMS",
+                              help="Submit one Slurm array job with one task per line "
+                                   "of this parameter file (see nbscript --sweep).")
+    parser_outer.add_argument("--array-limit", type=int,
+                              help="Maximum number of array tasks running at once.")
+    parser_outer.add_argument("--auto-resume", type=int, metavar="N",
+                              help="Checkpoint (with state) after every cell, and if the "
+                                   "job is about to hit its time limit, requeue it to "
+                                   "continue with nbscript --resume, at most N times.")
+    parser_outer.add_argument("--pack", nargs='+', metavar="NOTEBOOK",
+                              help="Run several notebooks in one job, --per-node at a "
+                                   "time on each node, each as its own job step.")
+    parser_outer.add_argument("--per-node", type=int, metavar="K",
+                              help="With --pack, notebooks per node (default: all "
+                                   "on one node).")
+    parser_outer.add_argument("--events", metavar="FILE",
+                              help="Append timing events (JSON lines) to this file, "
+                                   "also from the job (default $NBSCRIPT_EVENTS)")
     parser_outer.add_argument("--verbose", "-v", action="store_true",
                               help="Verbose.")
-    parser_outer.add_argument("notebook",
+    parser_outer.add_argument("notebook", nargs='?',
                               help="Input notebook")
     parser_outer.add_argument("argv", nargs=argparse.REMAINDER,
                               help="arguments of the notebook itself.")
 
     args, slurm_or_nbscript_args = parser_outer.parse_known_args(argv)
+    if args.pack:
+        if args.notebook is not None:
+            parser_outer.error("--pack takes all the notebooks, got also %s"%args.notebook)
+        args.notebook = args.pack[0]
+    elif args.notebook is None:
+        parser_outer.error("the following arguments are required: notebook")
+    elif args.per_node:
+        parser_outer.error("--per-node needs --pack")
     #args_inner, remaining2 = parser_inner.parse_known_args()
 
     if args.verbose:
         LOG.setLevel(logging.DEBUG)
+    events.setup(args.events)
     LOG.debug('args: %s', args)
     LOG.debug('slurm_or_nbscript_args: %s', slurm_or_nbscript_args)
 
@@ -50,16 +89,25 @@ def snotebook(argv=sys.argv[1:]):
     if args.verbose:
         options_nbscript.extend(['--verbose'])
 
+    # Array job: each task runs one line of the parameter file with
+    # `nbscript --sweep PARAMS --sweep-index $SLURM_ARRAY_TASK_ID`.
+    if args.array:
+        if args.srun or args.raw:
+            raise ValueError("--array can only be used with sbatch, not --srun or --raw")
+        n_tasks = len(sweep.read_params(args.array))
+        if n_tasks == 0:
+            raise ValueError("No parameters in %s"%args.array)
+        options_nbscript.extend(['--sweep', args.array])
+
     # Find slurm args from within notebook itself.  #SBATCH in the first
     # code cell (only the first).
-    import nbformat
-    nb = nbformat.read(args.notebook, as_version=4)
-    for cell in nb['cells']:
-        if cell['cell_type'] != 'code': continue
-        source = cell['source']
-        for m in re.finditer("^#SBATCH (.*)", source, re.M):
-            options_slurm.extend(shlex.split(m.group(1)))
-        break
+    with events.span('sbatch_directives', notebook=args.notebook):
+        options_slurm.extend(sbatch_directives(args.notebook))
+        # A packed job has one allocation for all notebooks.
+        for notebook in (args.pack or [ ])[1:]:
+            if sbatch_directives(notebook) != options_slurm:
+                LOG.warning("#SBATCH lines of %s differ from %s, using those of %s",
+                            notebook, args.notebook, args.notebook)
     LOG.debug('options_slurm: %s', options_slurm)
 
     # Add in extra options from command line. '---' separates slurm options and
@@ -73,6 +121,10 @@ def snotebook(argv=sys.argv[1:]):
     LOG.debug('options_slurm: %s', options_slurm)
     LOG.debug('options_nbscript: %s', options_nbscript)
 
+    if args.pack:
+        cmd_submit, batch_command, cmd_nbscript = pack_job(args, options_slurm, options_nbscript)
+        return submit(args, cmd_submit, batch_command, cmd_nbscript, start_time)
+
     def make_cmd_nbscript():
         return ['nbscript',
                 ] + options_nbscript + [
@@ -98,6 +150,23 @@ def snotebook(argv=sys.argv[1:]):
             LOG.debug('nbscript_locals: %s', nbscript_locals)
     LOG.debug('cmd_nbscript: %s', cmd_nbscript)
 
+    # Auto-resume: the requeued job resumes from the checkpoint of the
+    # previous one (the output itself, if it is a notebook), so the
+    # output name must stay the same.
+    if args.auto_resume:
+        if args.srun or args.raw or args.array:
+            raise ValueError("--auto-resume can only be used with plain sbatch")
+        if nbscript_locals['args'].timestamp:
+            raise ValueError("--auto-resume can not be used with --timestamp")
+        from .checkpoint import checkpoint_fname
+        options_nbscript.extend(['--checkpoint-cells', '1', '--checkpoint-state',
+                                 '--resume', checkpoint_fname(nbscript_locals['output_fname'],
+                                                              nbscript_locals['to_format'])])
+        cmd_nbscript = make_cmd_nbscript()
+        LOG.debug('cmd_nbscript: %s', cmd_nbscript)
+        options_slurm.extend(['--requeue', '--open-mode=append',
+                              '--signal=B:USR1@%d'%AUTO_RESUME_SIGNAL_TIME])
+
     # Create the slurm command to run
     if args.srun:
         cmd_submit = ['srun', 'bash', ]
@@ -105,22 +174,51 @@ def snotebook(argv=sys.argv[1:]):
         cmd_submit = ["bash"]
     else:
         cmd_submit = ['sbatch']
+        if args.array:
+            array = '--array=0-%d'%(n_tasks-1)
+            if args.array_limit:
+                array += '%%%d'%args.array_limit
+            options_slurm.append(array)
         if nbscript_locals['args'].save:
-            options_slurm.extend(['--output='+nbscript_locals['output_fname_before_timestamp']+'.log'])
+            log_fname = nbscript_locals['output_fname_before_timestamp']
+            if args.array:
+                # Slurm replaces %a with the array task ID.
+                log_fname = sweep.run_output_fname(log_fname, '%a')
+            options_slurm.extend(['--output='+log_fname+'.log'])
 
     cmd_submit.extend(options_slurm)
 
     LOG.debug('cmd_submit: %s', cmd_submit)
     LOG.debug('cmd_nbscript: %s', cmd_nbscript)
 
-    batch_command = """\
+    nbscript_line = [shlex_quote(x) for x in cmd_nbscript]
+    if args.array:
+        nbscript_line[1:1] = ['--sweep-index', '"$SLURM_ARRAY_TASK_ID"']
+    if args.auto_resume:
+        # Slurm sends USR1 before the time limit.  Run nbscript in the
+        # background so that the trap runs right away, and keep waiting
+        # if the job wasn't requeued.
+        batch_command = """\
+#!/bin/bash
+set -x
+trap 'if [ "${{SLURM_RESTART_COUNT:-0}}" -lt {n} ]; then scontrol requeue "$SLURM_JOB_ID"; fi' USR1
+{nbscript} &
+pid=$!
+while kill -0 $pid 2>/dev/null; do wait $pid; ret=$?; done
+exit $ret
+""".format(nbscript=" ".join(nbscript_line), n=args.auto_resume)
+    else:
+        batch_command = """\
 #!/bin/bash
 set -x
 {nbscript}
-""".format(nbscript=" ".join(shlex_quote(x) for x in cmd_nbscript))
+""".format(nbscript=" ".join(nbscript_line))
 
     LOG.debug('cmd_submit: %s', batch_command)
+    return submit(args, cmd_submit, batch_command, cmd_nbscript, start_time)
 
+def submit(args, cmd_submit, batch_command, cmd_nbscript, start_time):
+    """Submit the batch script, return the return code of sbatch"""
     env = dict(os.environ)
     env.pop('SLURM_JOB_ID', None)  # remove jobid so that this won't be a job step
     env.pop('SLURM_JOBID', None)   # (same)
@@ -128,17 +226,142 @@ set -x
     #env['SNOTEBOOK_INPUT'] = args.notebook
     #env['SNOTEBOOK_OUTPUT'] = output_basename
 
-    retcode = execute_sbatch(cmd_submit, batch_command.encode(), env, cmd_nbscript=cmd_nbscript)
+    if args.events:
+        env[events.ENV_VAR] = os.path.abspath(args.events)
 
-    LOG.debug('snotebook completed, return value %d', retcode)
+    events.emit('parse_args', duration=events.clock() - start_time,
+                notebook=args.notebook)
+    with events.span('submit', command=cmd_submit[0]):
+        retcode = execute_sbatch(cmd_submit, batch_command.encode(), env, cmd_nbscript=cmd_nbscript)
+
+    LOG.debug('snotebook completed, return value %s', retcode)
     return(retcode)
 
-def execute_sbatch(cmd_submit, stdin, env, cmd_nbscript):  # pylint: disable=unused-argument
-    """Execute sbatch.  This is separate for mocking during testing"""
-    p = subprocess.Popen(cmd_submit, stdin=subprocess.PIPE, env=env)
-    p.stdin.write(stdin)
-    p.stdin.close()
-    p.wait()
+def _has_option(options, names):
+    """Whether any of these (long or short) options is in options"""
+    for opt in options:
+        for name in names:
+            if opt.split('=', 1)[0] == name or (len(name) == 2 and opt.startswith(name)):
+                return True
+    return False
+
+def pack_job(args, options_slurm, options_nbscript):
+    """(cmd_submit, batch_command, cmd_nbscripts) of a --pack job.
+
+    The job gets --per-node tasks on each node it needs, and the batch
+    script starts each notebook as a job step of one task (with the
+    CPUs per task of the job), as many at once as there are tasks.
+    Output and log names are the same as when submitting the notebooks
+    one by one.
+    """
+    if args.srun or args.array or args.auto_resume:
+        raise ValueError("--pack can not be used with --srun, --array or --auto-resume")
+    per_node = args.per_node or len(args.pack)
+    if per_node < 1:
+        raise ValueError("--per-node must be at least 1")
+    cmds = [ ]
+    logs = [ ]
+    outputs = { }
+    for notebook in args.pack:
+        cmd_nbscript = ['nbscript'] + options_nbscript + [notebook]
+        names = nbscript.nbscript(cmd_nbscript[1:], _return_names=True)
+        if not names['output_fname']:
+            cmd_nbscript[1:1] = ['--save']
+            names = nbscript.nbscript(cmd_nbscript[1:], _return_names=True)
+        output = names['output_fname_before_timestamp']
+        if output in outputs:
+            raise ValueError("%s and %s would both be saved to %s"%(
+                outputs[output], notebook, output))
+        outputs[output] = notebook
+        LOG.debug('cmd_nbscript: %s', cmd_nbscript)
+        cmds.append(cmd_nbscript)
+        logs.append(output + '.log')
+
+    if args.raw:
+        cmd_submit = ['bash']
+        step = [ ]
+    else:
+        cmd_submit = ['sbatch']
+        if not _has_option(options_slurm, ('--nodes', '-N')):
+            cmd_submit.append('--nodes=%d'%(-(-len(cmds) // per_node)))
+        if not _has_option(options_slurm, ('--ntasks', '-n', '--ntasks-per-node')):
+            cmd_submit.append('--ntasks-per-node=%d'%per_node)
+        step = ['srun', '"$step_flag"', '--nodes=1', '--ntasks=1',
+                '--cpus-per-task="${SLURM_CPUS_PER_TASK:-1}"']
+    cmd_submit.extend(options_slurm)
+
+    commands = [ ]
+    for cmd_nbscript, log in zip(cmds, logs):
+        commands.append('start\n%s > %s 2>&1 &'%(
+            ' '.join(step + [shlex_quote(x) for x in cmd_nbscript]), shlex_quote(log)))
+    batch_command = PACK_SCRIPT.format(per_node=per_node, commands='\n'.join(commands))
+    return cmd_submit, batch_command, cmds
+
+# Runs the `start`ed commands, at most $SLURM_NTASKS at once.  Exits
+# with 1 if any of them failed.  Job steps share the allocation with
+# srun --exact since Slurm 20.11 (--exclusive alone doesn't anymore
+# from 21.08), and with --exclusive before.
+PACK_SCRIPT = """\
+#!/bin/bash
+set -x
+step_flag=--exact
+srun --help 2>/dev/null | grep -q -e --exact || step_flag=--exclusive
+max=${{SLURM_NTASKS:-{per_node}}}
+running=0
+ret=0
+start() {{
+    if [ $running -ge $max ]; then
+        wait -n || ret=1
+        running=$((running - 1))
+    fi
+    running=$((running + 1))
+}}
+{commands}
+while [ $running -gt 0 ]; do
+    wait -n || ret=1
+    running=$((running - 1))
+done
+exit $ret
+"""
+
+def sbatch_directives(notebook):
+    """Options from the #SBATCH lines in the first code cell"""
+    from . import scan
+    try:
+        source = scan.first_code_cell_source(notebook)
+    except ValueError as e:
+        LOG.debug('scanning %s failed (%s), reading it with nbformat', notebook, e)
+        import nbformat
+        nb = nbformat.read(notebook, as_version=4)
+        source = next((cell['source'] for cell in nb['cells']
+                       if cell['cell_type'] == 'code'), None)
+    options = [ ]
+    if source is not None:
+        for m in re.finditer("^#SBATCH (.*)", source, re.M):
+            options.extend(shlex.split(m.group(1)))
+    return options
+
+def execute_sbatch(cmd_submit, stdin, env, cmd_nbscript):
+    """Execute sbatch.  This is separate for mocking during testing
+
+    Jobs submitted with sbatch are tracked in the job database (see
+    `snotebook status`).  `cmd_nbscript` is the nbscript command of the
+    job, or the list of them for a packed job.
+    """
+    track = cmd_submit[0] == 'sbatch'
+    p = subprocess.Popen(cmd_submit, stdin=subprocess.PIPE, env=env,
+                         stdout=subprocess.PIPE if track else None)
+    stdout, _ = p.communicate(stdin)
+    if track:
+        stdout = stdout.decode('utf-8', 'replace')
+        sys.stdout.write(stdout)
+        sys.stdout.flush()
+        if p.returncode == 0:
+            from . import jobdb
+            try:
+                jobdb.record_submission(stdout, cmd_submit, cmd_nbscript)
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.warning("Could not save the job in the job database: %s", e)
     return p.returncode
 
 
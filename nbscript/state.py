@@ -0,0 +1,158 @@
+"""Saving the final kernel state, for post-processing.
+
+`nbscript --save-state --save nb.ipynb` saves the global variables of
+the kernel when the run ends, to the directory `nb.out.ipynb.vars/`:
+
+* NumPy arrays (not of object dtype) as `NAME.npy`
+* pandas DataFrames as uncompressed Arrow files `NAME.arrow`, if
+  pyarrow is installed
+* modules as their name, to be imported again
+* everything else that dill can pickle as `NAME.pkl`
+
+`index.json` lists what was saved and how, and the names which
+couldn't be.  `load_state(fname)` loads them back: arrays are opened
+with mmap, so loading even a very large state is instant and only the
+parts which are used are read from disk.  Separately pickled variables
+don't share objects with each other anymore.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+
+LOG = logging.getLogger('nbscript.state')
+
+INDEX = 'index.json'
+
+# Names of the IPython namespace which aren't the notebook's variables.
+IGNORED_NAMES = {'In', 'Out', 'get_ipython', 'exit', 'quit'}
+
+SAVE_CODE = "__import__('nbscript.state').state.save(globals(), %r)"
+
+
+def state_dir(output_fname):
+    """Directory of the state saved with an output file"""
+    return output_fname + '.vars'
+
+
+def _is_array(value):
+    numpy = sys.modules.get('numpy')
+    return (numpy is not None and type(value) is numpy.ndarray
+            and not value.dtype.hasobject)
+
+
+def _is_dataframe(value):
+    pandas = sys.modules.get('pandas')
+    if pandas is None or type(value) is not pandas.DataFrame:
+        return False
+    try:
+        import pyarrow.feather   # pylint: disable=unused-import
+    except ImportError:
+        return False
+    return True
+
+
+def _save_one(dirname, name, value):
+    """Save one variable, return its index entry"""
+    if _is_array(value):
+        import numpy
+        fname = name + '.npy'
+        numpy.save(os.path.join(dirname, fname), value, allow_pickle=False)
+        return {'kind': 'npy', 'file': fname}
+    if _is_dataframe(value):
+        import pyarrow.feather
+        fname = name + '.arrow'
+        pyarrow.feather.write_feather(value, os.path.join(dirname, fname),
+                                      compression='uncompressed')
+        return {'kind': 'arrow', 'file': fname}
+    if type(value).__name__ == 'module':
+        return {'kind': 'module', 'module': value.__name__}
+    import dill
+    fname = name + '.pkl'
+    with open(os.path.join(dirname, fname), 'wb') as f:
+        dill.dump(value, f, recurse=True)
+    return {'kind': 'dill', 'file': fname}
+
+
+def save(namespace, dirname):
+    """Save the variables of namespace to dirname (replacing it)"""
+    tmp = dirname + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    index = {'variables': { }, 'failed': { }}
+    for name, value in sorted(namespace.items()):
+        if name.startswith('_') or name in IGNORED_NAMES:
+            continue
+        try:
+            index['variables'][name] = _save_one(tmp, name, value)
+        except Exception as e:  # pylint: disable=broad-except
+            index['failed'][name] = '%s: %s'%(type(e).__name__, e)
+            for ext in ('.npy', '.arrow', '.pkl'):
+                if os.path.exists(os.path.join(tmp, name + ext)):
+                    os.unlink(os.path.join(tmp, name + ext))
+    with open(os.path.join(tmp, INDEX), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmp, dirname)
+    return index
+
+
+def _load_one(dirname, entry):
+    kind = entry['kind']
+    if kind == 'npy':
+        import numpy
+        return numpy.load(os.path.join(dirname, entry['file']), mmap_mode='r')
+    if kind == 'arrow':
+        import pyarrow.feather
+        return pyarrow.feather.read_feather(os.path.join(dirname, entry['file']),
+                                            memory_map=True)
+    if kind == 'module':
+        import importlib
+        return importlib.import_module(entry['module'])
+    import dill
+    with open(os.path.join(dirname, entry['file']), 'rb') as f:
+        return dill.load(f)
+
+
+def load_state(fname, namespace=None, names=None):
+    """Load a saved state, return it as a dict.
+
+    `fname` is the output file of the run (or the state directory
+    itself).  Only `names` are loaded if given.  If `namespace` (like
+    `globals()`) is given, the variables are also put there.
+    """
+    dirname = fname if os.path.isdir(fname) else state_dir(fname)
+    with open(os.path.join(dirname, INDEX)) as f:
+        index = json.load(f)
+    variables = { }
+    for name, entry in sorted(index['variables'].items()):
+        if names is not None and name not in names:
+            continue
+        variables[name] = _load_one(dirname, entry)
+    if namespace is not None:
+        namespace.update(variables)
+    return variables
+
+
+class StateSaver(object):
+    """Execution listener which saves the state when the last cell is done.
+
+    A notebook without cells has nothing to run, so its (empty) state is
+    saved right away.
+    """
+    def __init__(self, dirname):
+        self.dirname = os.path.abspath(dirname)
+
+    def prepare(self, nb):
+        if not nb.cells:
+            save({ }, self.dirname)
+
+    def finish(self, ep):
+        try:
+            ep.run_code(SAVE_CODE%self.dirname)
+        except RuntimeError as e:
+            LOG.error("Could not save the state: %s", e)
@@ -0,0 +1,132 @@
+"""Parameter sweeps: run one notebook with many argv sets in parallel.
+
+Each line of the parameter file is one run.  A line is either a JSON
+list of arguments or a JSON string, which is split like a shell command
+line.  The arguments are appended to the notebook's argv.  Blank lines
+are ignored.
+
+The notebook is read once.  Each run executes a copy of it in its own
+kernel, in-process, with at most `jobs` runs at once.
+"""
+
+import copy
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+
+from . import events, payload
+
+LOG = logging.getLogger('nbscript.sweep')
+
+
+def read_params(fname):
+    """Read a parameter file, return a list of argument lists"""
+    params = [ ]
+    with open(fname) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            value = json.loads(line)
+            if isinstance(value, list):
+                params.append([str(x) for x in value])
+            elif isinstance(value, str):
+                params.append(shlex.split(value))
+            else:
+                raise ValueError("%s:%d: each line must be a JSON list or string"%(
+                    fname, lineno))
+    return params
+
+
+def run_output_fname(output_fname, index):
+    """Output filename for one run: the run index goes before the extension
+
+    `index` may also be a string, such as Slurm's '%a' filename pattern.
+    """
+    basename, ext = os.path.splitext(output_fname)
+    return '%s.%s%s'%(basename, index, ext)
+
+
+def summary_fname(output_fname):
+    """Filename of the sweep summary"""
+    return output_fname + '.sweep.json'
+
+
+def _run_one(nb, notebook, to_format, output_fname, env):
+    from . import execute
+    nb, resources = execute.execute(copy.deepcopy(nb), notebook, env=env)
+    execute.export(nb, to_format, output_fname, notebook, resources=resources)
+    return sum(1 for cell in nb.cells for out in cell.get('outputs', [])
+               if out.get('output_type') == 'error')
+
+
+def sweep(notebook, params, to_format, output_fname, env, jobs=1, indices=None):
+    """Run `notebook` once for each argument list in `params`.
+
+    `env` is the environment nbscript would use for a single run.  Its
+    NB_ARGV gets the run arguments appended, and NBSCRIPT_OUTPUT_FILENAME
+    is the run's own output file.  Writes a summary JSON next to
+    `output_fname` and returns the list of results.
+
+    If `indices` is given, only those runs are done and no summary is
+    written (this is used for Slurm array tasks, which each do one run).
+    """
+    from . import execute
+    nb = execute.read(notebook)
+    base_argv = json.loads(env['NB_ARGV'])
+    if indices is None:
+        indices = range(len(params))
+        write_summary = True
+    else:
+        for index in indices:
+            if not 0 <= index < len(params):
+                raise ValueError("Sweep index %d out of range (%d runs)"%(index, len(params)))
+        write_summary = False
+    results = [None] * len(params)
+    slots = threading.BoundedSemaphore(max(jobs, 1))
+
+    def run(index):
+        try:
+            run_fname = run_output_fname(output_fname, index)
+            run_env = dict(env)
+            run_env['NB_ARGV'] = json.dumps(base_argv + params[index])
+            run_env['NBSCRIPT_OUTPUT_FILENAME'] = os.path.abspath(run_fname)
+            result = {'index': index, 'argv': params[index], 'output': run_fname}
+            LOG.debug('sweep run %d: %s', index, run_env['NB_ARGV'])
+            start = time.time()
+            try:
+                with events.span('sweep_run', index=index), \
+                        payload.packed(run_env) as kernel_env:
+                    result['cell_errors'] = _run_one(nb, notebook, to_format, run_fname,
+                                                     kernel_env)
+                result['returncode'] = 0
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.error('sweep run %d failed: %s: %s', index, type(e).__name__, e)
+                result['returncode'] = 1
+                result['error'] = '%s: %s'%(type(e).__name__, e)
+            result['wall_time'] = time.time() - start
+            results[index] = result
+        finally:
+            slots.release()
+
+    threads = [ ]
+    for index in indices:
+        slots.acquire()
+        t = threading.Thread(target=run, args=(index,))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    results = [results[index] for index in indices]
+
+    if not write_summary:
+        return results
+    with open(summary_fname(output_fname), 'w') as f:
+        json.dump({'notebook': notebook, 'runs': results}, f, indent=1)
+    n_failed = sum(1 for r in results if r['returncode'] != 0)
+    LOG.info('sweep: %d runs, %d failed, summary in %s', len(results), n_failed,
+             summary_fname(output_fname))
+    return results
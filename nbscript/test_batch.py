@@ -0,0 +1,100 @@
+# pylint: disable=wrong-import-position
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from tornado import web
+from tornado.escape import url_escape
+from tornado.testing import AsyncHTTPTestCase
+
+pytest.importorskip('notebook.base.handlers')
+from .server_extensions import batch
+from .server_extensions.jobs import JobRegistry
+
+
+class EchoBatchHandler(batch.NbscriptBatchHandler):
+    """Prints the path instead of running nbscript"""
+    batch_command = [sys.executable, '-c', 'import sys; print(sys.argv[1])', '{path}']
+
+
+class ShellBatchHandler(batch.NbscriptBatchHandler):
+    """A string command"""
+    batch_command = '"%s" -c "import sys; print(sys.argv[1:])"'%sys.executable
+
+
+class BatchHandlersTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, 'root')
+        os.mkdir(self.root)
+        super(BatchHandlersTest, self).setUp()
+
+    def tearDown(self):
+        super(BatchHandlersTest, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def get_app(self):
+        handlers = [(pat, EchoBatchHandler if handler is batch.NbscriptBatchHandler else handler)
+                    for pat, handler in batch.handlers]
+        handlers.append((r"/shell", ShellBatchHandler))
+        return web.Application(handlers, notebook_dir=self.root,
+                               nbscript_jobs=JobRegistry())
+
+    def get_json(self, url):
+        response = self.fetch(url)
+        assert response.code == 200
+        return json.loads(response.body.decode())
+
+    def test_submit(self):
+        ret = self.get_json('/nbscript/batch?path=nb.ipynb')
+        assert ret['asynchronous'] is False
+        assert ret['status'] == 'finished'
+        assert ret['stdouterr'] == os.path.join(self.root, 'nb.ipynb') + '\n'
+        assert ret['fullpath'] == os.path.join(self.root, 'nb.ipynb')
+
+    def test_submit_string_command(self):
+        """The path is one argument, not shell syntax"""
+        path = 'a b;touch pwned $(touch pwned2).ipynb'
+        ret = self.get_json('/shell?path=%s'%url_escape(path))
+        assert ret['status'] == 'finished'
+        assert ret['stdouterr'] == '%r\n'%[os.path.join(self.root, path)]
+        assert not [f for f in os.listdir('.') + os.listdir(self.root) if 'pwned' in f]
+
+    def test_submit_stream(self):
+        ret = self.get_json('/nbscript/batch?path=nb.ipynb&asynchronous=1')
+        assert ret['asynchronous'] is True
+        assert 'stdouterr' not in ret
+        response = self.fetch('/nbscript/batch/%s/stream'%ret['id'])
+        assert response.code == 200
+        assert response.headers['Content-Type'] == 'text/event-stream'
+        body = response.body.decode()
+        assert 'data: %s\n'%os.path.join(self.root, 'nb.ipynb') in body
+        assert body.endswith('event: end\ndata: 0\n\n')
+        assert self.get_json('/nbscript/batch/%s'%ret['id'])['status'] == 'finished'
+
+    def test_unknown_job(self):
+        assert self.fetch('/nbscript/batch/0123abcd').code == 404
+        assert self.fetch('/nbscript/batch/0123abcd/stream').code == 404
+
+    def test_file_stream(self):
+        with open(os.path.join(self.root, 'x.log'), 'w') as f:
+            f.write('line 1\nline 2')
+        response = self.fetch('/nbscript/batch/stream?path=x.log&follow=0')
+        assert response.code == 200
+        assert response.body.decode() == 'id: 13\ndata: line 1\ndata: line 2\n\n'
+        response = self.fetch('/nbscript/batch/stream?path=x.log&follow=0&offset=7')
+        assert response.body.decode() == 'id: 13\ndata: line 2\n\n'
+        assert self.fetch('/nbscript/batch/stream?path=y.log&follow=0').code == 404
+
+    def test_file_stream_outside(self):
+        outside = os.path.join(self.tmpdir, 'secret.log')
+        with open(outside, 'w') as f:
+            f.write('secret')
+        os.symlink(outside, os.path.join(self.root, 'link.log'))
+        for path in ['../secret.log', 'sub/../../secret.log', outside, 'link.log']:
+            response = self.fetch('/nbscript/batch/stream?follow=0&path=%s'%path)
+            assert response.code == 403, path
+            assert b'secret' not in response.body
@@ -0,0 +1,78 @@
+import sys
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .server_extensions.jobs import FileTail, Job, JobRegistry, sse_event
+
+
+def run(coro):
+    return IOLoop.current().run_sync(coro, timeout=30)
+
+def test_job():
+    registry = JobRegistry()
+    @gen.coroutine
+    def go():
+        job = registry.submit([sys.executable, '-c', 'import sys; print("out"); sys.exit(3)'],
+                              fullpath='x')
+        assert registry.get(job.id) is job
+        yield job.done.wait()
+        raise gen.Return(job.to_dict())
+    ret = run(go)
+    assert ret['status'] == 'failed'
+    assert ret['returncode'] == 3
+    assert ret['stdouterr'] == 'out\n'
+    assert ret['fullpath'] == 'x'
+
+def test_concurrency_limit():
+    """Jobs run in parallel, but at most max_running at once"""
+    registry = JobRegistry(max_running=2, max_finished=3)
+    @gen.coroutine
+    def go():
+        jobs = [registry.submit('sleep 0.2') for _ in range(4)]
+        yield gen.moment
+        assert [j.status for j in jobs] == ['running', 'running', 'queued', 'queued']
+        for job in jobs:
+            yield job.done.wait()
+        raise gen.Return(jobs)
+    jobs = run(go)
+    assert all(j.returncode == 0 for j in jobs)
+    # When each job started, at most one other was running.
+    for job in jobs:
+        running = [j for j in jobs if j.started <= job.started < j.finished]
+        assert len(running) <= 2
+    assert len(registry.jobs) == 3
+    assert registry.get(jobs[0].id) is None
+
+def test_output_ring_buffer():
+    job = Job(['true'], max_output=10)
+    job.append_output(b'0123')
+    job.append_output(b'456789')
+    assert job.read(0) == (b'0123456789', 10)
+    assert job.read(4) == (b'456789', 10)
+    job.append_output(b'abcdef')
+    assert job.output_dropped == 6
+    assert job.output() == '6789abcdef'
+    # Offsets which were dropped continue from the oldest byte.
+    assert job.read(2) == (b'6789abcdef', 16)
+    assert job.read(12) == (b'cdef', 16)
+    assert job.read(16) == (b'', 16)
+
+def test_file_tail(tmpdir):
+    path = str(tmpdir.join('x.log'))
+    tail = FileTail(path, max_read=4)
+    assert tail.read(0) == (b'', 0)
+    with open(path, 'wb') as f:
+        f.write(b'123456')
+    assert tail.read(0) == (b'1234', 4)
+    assert tail.read(4) == (b'56', 6)
+    # Rewritten shorter: start over
+    with open(path, 'wb') as f:
+        f.write(b'ab')
+    assert tail.read(6) == (b'ab', 2)
+
+def test_sse_event():
+    assert sse_event('a\nb\n', event_id=4) == 'id: 4\ndata: a\ndata: b\ndata: \n\n'
+    assert sse_event('0', event='end') == 'event: end\ndata: 0\n\n'
+    # Lone \r (progress bars) also ends lines in SSE.
+    assert sse_event('10%\r20%\r\ndone\r') == 'data: 10%\ndata: 20%\ndata: done\ndata: \n\n'
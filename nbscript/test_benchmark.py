@@ -0,0 +1,18 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import json
+
+from . import benchmark
+from .testutil import tdir
+
+
+def test_benchmark(tdir):
+    """A quick run of the benchmark suite writes all results"""
+    data = benchmark.main(['--repeat=1', '--sizes=2,3', '--output-size=100',
+                           '--output=bench.json'])
+    assert json.load(open('bench.json')) == data
+    names = set(r['name'] for r in data['results'])
+    assert names == set(benchmark.BENCHMARKS)
+    formats = [r['params']['format'] for r in data['results']
+               if r['name'] == 'export' and r['params']['cells'] == 3]
+    assert formats == benchmark.FORMATS
+    assert all(r['seconds'] > 0 for r in data['results'] if r['name'] != 'startup')
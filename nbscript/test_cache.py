@@ -0,0 +1,80 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import os
+
+import nbformat
+import pytest
+
+from . import cache, names
+from .nbscript import nbscript
+from .testutil import tdir
+
+pytest.importorskip('dill')
+
+
+def write_nb(fname, sources, tags=None):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    for index, tag in (tags or { }).items():
+        nb.cells[index].metadata['tags'] = [tag]
+    nbformat.write(nb, fname)
+
+SOURCES = ["x = 41",
+           "open('ran.txt', 'a').write('b')\ny = x + 1",
+           "print(y)",
+           ]
+
+def last_output(fname):
+    nb = nbformat.read(fname, as_version=4)
+    return nb.cells[-1].outputs[0].text
+
+def test_defined_names():
+    assert names.defined_names("a = 1\nb, c = 2, 3\nd[0] = 1\ne.f += 1") == {'a', 'b', 'c', 'd', 'e'}
+    assert names.defined_names("import os.path\nfrom x import y as z") == {'os', 'z'}
+    assert names.defined_names("def f(a):\n    b = a\nclass C: pass") == {'f', 'C'}
+    assert names.defined_names("[i for i in range(3)]\n%time q = 1\n!ls") == set()
+    assert names.defined_names("from os import *") is None
+    assert names.defined_names("%%bash\nls") is None
+    info = names.analyze("import numpy as np\na.b.append(1)\nf(c, d=e[0])\nnp.sum(g)")
+    assert info.mutated == {'a', 'c', 'e', 'g', 'np'}
+    assert info.modules == {'np'}
+    assert names.effects(info, { }, {'np'})[1] == {'a', 'c', 'e', 'g', 'np'}
+    assert names.effects(names.analyze("np.sum(g)"), { }, {'np'})[1] == {'g'}
+
+def test_cache_hit(tdir):
+    write_nb('nb.ipynb', SOURCES)
+    for _ in range(2):
+        nbscript(['--cache', '--cache-dir', 'cache', '--save', 'nb.ipynb'])
+        assert last_output('nb.out.ipynb') == '42\n'
+    assert open('ran.txt').read() == 'b'
+    # Other argv: other keys
+    nbscript(['--cache', '--cache-dir', 'cache', '--save', 'nb.ipynb', 'A'])
+    assert open('ran.txt').read() == 'bb'
+
+def test_cache_mutation(tdir):
+    # lst is only changed through a method call, a hit still restores it.
+    write_nb('nb.ipynb', ["lst = [ ]", "lst.append(1)", "print(lst)"],
+             tags={2: cache.TAG_NO_CACHE})
+    for _ in range(2):
+        nbscript(['--cache', '--cache-dir', 'cache', '--save', 'nb.ipynb'])
+        assert last_output('nb.out.ipynb') == '[1]\n'
+    # The same through a function defined in another cell.
+    write_nb('nb.ipynb', ["lst = [ ]\ndef add(x):\n    lst.append(x)", "add(2)", "print(lst)"],
+             tags={2: cache.TAG_NO_CACHE})
+    for _ in range(2):
+        nbscript(['--cache', '--cache-dir', 'cache', '--save', 'nb.ipynb'])
+        assert last_output('nb.out.ipynb') == '[2]\n'
+
+def test_cache_tags(tdir):
+    write_nb('nb.ipynb', SOURCES, tags={1: cache.TAG_NO_CACHE})
+    for _ in range(2):
+        nbscript(['--cache', '--cache-dir', 'cache', '--save', 'nb.ipynb'])
+        assert last_output('nb.out.ipynb') == '42\n'
+    assert open('ran.txt').read() == 'bb'
+
+def test_cache_evict(tdir):
+    write_nb('nb.ipynb', SOURCES)
+    for _ in range(2):
+        nbscript(['--cache', '--cache-dir', 'cache', '--cache-size', '0',
+                  '--save', 'nb.ipynb'])
+    assert open('ran.txt').read() == 'bb'
+    assert os.listdir('cache') == [ ]
@@ -0,0 +1,71 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import os
+
+import nbformat
+import pytest
+
+from . import checkpoint, execute
+from .nbscript import nbscript
+from .testutil import assert_out, tdir
+
+
+def test_serialize_same_as_nbformat(tdir):
+    nb = execute.read('one.ipynb')
+    cp = checkpoint.Checkpointer('cp.ipynb')
+    assert cp.serialize(nb) == nbformat.writes(nb) + '\n'
+    # Changed cells are only reserialized if they are marked dirty.
+    nb.cells[1].outputs.append(nbformat.v4.new_output('stream', text='X'))
+    assert '"X"' not in cp.serialize(nb)
+    cp.cell_start(None, nb.cells[1], 1)
+    assert cp.serialize(nb) == nbformat.writes(nb) + '\n'
+
+def test_atomic_write_mode(tdir):
+    umask = os.umask(0o022)
+    try:
+        checkpoint.atomic_write('new.txt', 'a')
+        assert os.stat('new.txt').st_mode & 0o777 == 0o644
+        os.chmod('new.txt', 0o600)
+        checkpoint.atomic_write('new.txt', b'b')
+        assert os.stat('new.txt').st_mode & 0o777 == 0o600
+    finally:
+        os.umask(umask)
+    assert open('new.txt').read() == 'b'
+    assert not [f for f in os.listdir('.') if f.endswith('.tmp')]
+
+def test_checkpoint_during_run(tdir):
+    """Each cell's checkpoint contains the outputs so far"""
+    seen = [ ]
+    class Spy(object):
+        def cell_end(self, ep, cell, index):
+            nb = nbformat.read('cp.ipynb', as_version=4)
+            seen.append(sum(1 for c in nb.cells if c.outputs))
+    cp = checkpoint.Checkpointer('cp.ipynb', every_cells=1)
+    nb = execute.read('one.ipynb')
+    execute.execute(nb, 'one.ipynb', env={'NB_ARGV': '["one.ipynb"]'},
+                    listeners=[cp, Spy()])
+    assert seen == [1, 2, 3, 4]
+    assert not [f for f in os.listdir('.') if f.endswith('.tmp')]
+
+def test_checkpoint_save(tdir):
+    nbscript(['--checkpoint-cells', '1', '--save', 'one.ipynb'])
+    assert_out('one.out.ipynb')
+
+def test_checkpoint_other_format(tdir, monkeypatch):
+    written = [ ]
+    write = checkpoint.Checkpointer.write
+    def spy(self, nb):
+        write(self, nb)
+        written.append((os.path.abspath(self.fname), os.path.exists(self.fname)))
+    monkeypatch.setattr(checkpoint.Checkpointer, 'write', spy)
+    # An interval of 0 checkpoints after every cell and output.
+    nbscript(['--checkpoint-interval', '0', '--to', 'markdown', '--save', 'one.ipynb'])
+    assert_out('one.md')
+    assert len(written) >= 4
+    assert set(written) == {(os.path.abspath('one.checkpoint.ipynb'), True)}
+    assert not os.path.exists('one.checkpoint.ipynb')
+
+@pytest.mark.parametrize('option', [['--checkpoint-interval', '-1'],
+                                    ['--checkpoint-cells', '0']])
+def test_checkpoint_invalid(tdir, option):
+    with pytest.raises(SystemExit):
+        nbscript(option + ['--save', 'one.ipynb'])
@@ -0,0 +1,58 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from . import daemon
+from .nbscript import nbscript
+from .testutil import assert_out, tdir
+
+
+@pytest.fixture
+def nbdaemon(tdir):
+    """A running daemon with a one-kernel pool, yields the socket path"""
+    socket_path = os.path.join(tdir, 'daemon.sock')
+    pool = daemon.KernelPool(size=1, preload='import nbscript')
+    server = daemon.NbscriptDaemon(socket_path, pool)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+def test_daemon_stdout(nbdaemon, capfd):
+    for i in range(2):
+        ret = nbscript(['--daemon', '--daemon-socket', nbdaemon,
+                        'one.ipynb', 'A', '--B%d'%i])
+        assert ret == 0
+        captured = capfd.readouterr()
+        assert '0123456789' in captured.out
+        assert 'Yes running nbscript' in captured.out
+        assert 'A --B%d'%i in captured.out
+
+def test_daemon_save(nbdaemon):
+    os.mkdir('subdir')
+    os.rename('one.ipynb', 'subdir/one.ipynb')
+    nbscript(['--daemon', '--daemon-socket', nbdaemon, '--save', 'subdir/one.ipynb'])
+    assert_out('subdir/one.out.ipynb')
+
+def test_daemon_bad_request(nbdaemon):
+    """A malformed request gets an error reply"""
+    for line in (b'not json\n', b'{"notebook": "one.ipynb"}\n'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(nbdaemon)
+        with sock, sock.makefile('rwb') as f:
+            f.write(line)
+            f.flush()
+            reply = json.loads(f.readline().decode())
+        assert reply['returncode'] == 1
+        assert reply['error']
+    assert nbscript(['--daemon', '--daemon-socket', nbdaemon, '--save', 'one.ipynb']) == 0
+
+def test_daemon_not_running(tdir):
+    with pytest.raises(RuntimeError):
+        nbscript(['--daemon', '--daemon-socket', 'missing.sock', 'one.ipynb'])
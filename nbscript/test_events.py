@@ -0,0 +1,67 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import json
+import os
+
+import pytest
+
+from . import events
+from . import snotebook
+from .nbscript import nbscript
+from .testutil import tdir, tdir_slurm
+
+
+@pytest.fixture
+def collected():
+    got = [ ]
+    events.register(got.append)
+    yield got
+    events.unregister(got.append)
+    events.close_files()
+
+
+def test_no_callbacks():
+    with events.span('x'):
+        events.emit('y')
+
+
+def test_span(collected):
+    with pytest.raises(ValueError):
+        with events.span('x', a=1):
+            raise ValueError()
+    assert [(e['event'], e['phase'], e['a']) for e in collected] == [('x', 'start', 1), ('x', 'end', 1)]
+    assert collected[1]['error'] == 'ValueError'
+    assert collected[1]['duration'] >= 0
+
+
+def test_nbscript_events(tdir, collected):
+    nbscript(['--inprocess', '--save', '--events', 'ev.jsonl', 'one.ipynb'])
+    lines = [json.loads(line) for line in open('ev.jsonl')]
+    assert lines == collected
+    names = [(e['event'], e.get('phase')) for e in lines]
+    assert names[:3] == [('parse_args', None), ('read', 'start'), ('read', 'end')]
+    assert names.index(('kernel_start', 'end')) < names.index(('cell', 'start'))
+    cells = [e for e in lines if e['event'] == 'cell' and e['phase'] == 'end']
+    assert [e['index'] for e in cells] == [0, 1, 2, 3]
+    assert names[-4:] == [('export', 'start'), ('export', 'end'),
+                          ('write', 'start'), ('write', 'end')]
+    times = [e['t'] for e in lines]
+    assert times == sorted(times)
+
+
+def test_nbscript_closes_events(tdir):
+    nbscript(['--inprocess', '--save', '--events', 'ev1.jsonl', 'one.ipynb'])
+    n = len(open('ev1.jsonl').readlines())
+    nbscript(['--inprocess', '--save', '--events', 'ev2.jsonl', 'one.ipynb'])
+    assert len(open('ev1.jsonl').readlines()) == n
+    assert len(open('ev2.jsonl').readlines()) == n
+    assert not events._callbacks  # pylint: disable=protected-access
+
+def test_snotebook_events(tdir_slurm, collected, monkeypatch):
+    def sbatch(cmd_submit, stdin, env, cmd_nbscript):
+        assert env[events.ENV_VAR] == os.path.abspath('ev.jsonl')
+        return 0
+    monkeypatch.setattr(snotebook, "execute_sbatch", sbatch)
+    snotebook.snotebook(['--events', 'ev.jsonl', 'slurm.ipynb'])
+    names = [(e['event'], e.get('phase')) for e in collected]
+    assert names == [('sbatch_directives', 'start'), ('sbatch_directives', 'end'),
+                     ('parse_args', None), ('submit', 'start'), ('submit', 'end')]
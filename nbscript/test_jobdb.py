@@ -0,0 +1,144 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import os
+import stat
+
+import pytest
+
+from . import jobdb
+from . import snotebook
+from .testutil import tdir_slurm
+
+
+def fake_command(dirname, name, script):
+    fname = os.path.join(dirname, name)
+    with open(fname, 'w') as f:
+        f.write('#!/bin/sh\n' + script)
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR)
+
+
+@pytest.fixture
+def fake_slurm(tdir_slurm, monkeypatch):
+    """sbatch and sacct on PATH, and a job database in the test dir
+
+    The fake sacct logs its arguments to sacct.calls and prints
+    sacct.out.
+    """
+    bindir = os.path.join(tdir_slurm, 'bin')
+    os.mkdir(bindir)
+    fake_command(bindir, 'sbatch', 'cat > sbatch.stdin\necho "Submitted batch job 1001"\n')
+    fake_command(bindir, 'sacct', 'echo "$@" >> sacct.calls\ncat sacct.out\n')
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('NBSCRIPT_JOBDB', os.path.join(tdir_slurm, 'jobs.sqlite'))
+    yield tdir_slurm
+
+
+def sacct_calls():
+    if not os.path.exists('sacct.calls'):
+        return [ ]
+    return open('sacct.calls').read().splitlines()
+
+
+def test_parse_job_id():
+    assert jobdb.parse_job_id('Submitted batch job 1234\n') == '1234'
+    assert jobdb.parse_job_id('1234;cluster\n') == '1234'
+    assert jobdb.parse_job_id('sbatch: error: invalid\n') is None
+
+
+def test_submit_tracks_job(fake_slurm):
+    assert snotebook.snotebook(['slurm.ipynb']) == 0
+    assert b'nbscript' in open('sbatch.stdin', 'rb').read()
+    rows = jobdb.JobDB().jobs()
+    assert [row['job_id'] for row in rows] == ['1001']
+    assert rows[0]['notebook'] == os.path.abspath('slurm.ipynb')
+    assert rows[0]['log'] == os.path.abspath('slurm.out.ipynb.log')
+    assert rows[0]['state'] == 'SUBMITTED'
+
+def test_submit_tracks_pack(fake_slurm, capsys):
+    import shutil
+    shutil.copy('slurm.ipynb', 'other.ipynb')
+    assert snotebook.snotebook(['--pack', 'slurm.ipynb', 'other.ipynb']) == 0
+    db = jobdb.JobDB()
+    assert [row['notebook'] for row in db.jobs()] == [os.path.abspath('slurm.ipynb')]
+    packed = db.packed('1001')
+    assert [row['notebook'] for row in packed] == [os.path.abspath('other.ipynb')]
+    assert packed[0]['log'] == os.path.abspath('other.out.ipynb.log')
+    with open('sacct.out', 'w') as f:
+        f.write('1001|RUNNING|0:0\n')
+    capsys.readouterr()
+    assert snotebook.snotebook(['status']) == 0
+    lines = capsys.readouterr().out.splitlines()[1:]
+    assert [line.split()[:2] for line in lines] == [['1001', 'RUNNING']] * 2
+    assert lines[1].endswith('other.ipynb')
+    db.forget(['1001'])
+    assert not db.packed('1001')
+
+
+def test_status_batched(fake_slurm, capsys):
+    db = jobdb.JobDB()
+    for job_id in ('11', '12', '13'):
+        db.add(job_id, notebook='x.ipynb')
+    with open('sacct.out', 'w') as f:
+        f.write('11|COMPLETED|0:0\n'
+                '12|RUNNING|0:0\n'
+                '13_0|COMPLETED|0:0\n'
+                '13_1|FAILED|1:0\n')
+    assert snotebook.snotebook(['status']) == 0
+    calls = sacct_calls()
+    assert len(calls) == 1
+    assert '--jobs=11,12,13' in calls[0]
+    states = dict((row['job_id'], row['state']) for row in db.jobs())
+    assert states == {'11': 'COMPLETED', '12': 'RUNNING', '13': 'FAILED'}
+    assert 'RUNNING' in capsys.readouterr().out
+
+    # Rate limited: the cached states are used.
+    assert snotebook.snotebook(['status']) == 0
+    assert len(sacct_calls()) == 1
+
+    # Finished jobs aren't queried again.
+    assert snotebook.snotebook(['status', '--interval=0']) == 0
+    calls = sacct_calls()
+    assert len(calls) == 2
+    assert '--jobs=12 ' in calls[1] + ' '
+
+
+def test_wait(fake_slurm, monkeypatch):
+    db = jobdb.JobDB()
+    db.add('21')
+    db.add('22')
+    outputs = ['21|RUNNING|0:0\n22|PENDING|0:0\n',
+               '21|COMPLETED|0:0\n22|CANCELLED by 1000|0:0\n']
+    def sleep(seconds):
+        with open('sacct.out', 'w') as f:
+            f.write(outputs.pop(0))
+    sleep(0)
+    monkeypatch.setattr(jobdb.time, 'sleep', sleep)
+    assert snotebook.snotebook(['wait', '--interval=0', '21']) == 0
+    assert len(sacct_calls()) == 2
+    assert snotebook.snotebook(['wait', '--interval=0']) == 1
+    assert db.jobs(['22'])[0]['state'] == 'CANCELLED'
+
+def test_sacct_fails(fake_slurm, capsys):
+    db = jobdb.JobDB()
+    db.add('31')
+    fake_command(os.environ['PATH'].split(os.pathsep)[0], 'sacct',
+                 'echo "$@" >> sacct.calls\nexit 1\n')
+    assert snotebook.snotebook(['status']) == 0
+    assert db.jobs()[0]['state'] == 'SUBMITTED'
+    # The failed call doesn't count for the rate limit.
+    assert snotebook.snotebook(['status']) == 0
+    assert len(sacct_calls()) == 2
+
+def test_wait_preempted_missing(fake_slurm, monkeypatch):
+    db = jobdb.JobDB()
+    db.add('41')
+    db.add('42')
+    # A preempted job is requeued, 42 is never reported by sacct.
+    outputs = ['41|PREEMPTED|0:0\n', '41|COMPLETED|0:0\n']
+    def sleep(seconds):
+        with open('sacct.out', 'w') as f:
+            f.write(outputs.pop(0))
+    sleep(0)
+    monkeypatch.setattr(jobdb.time, 'sleep', sleep)
+    assert snotebook.snotebook(['wait', '--interval=0', '--missing-timeout=0']) == 1
+    states = dict((row['job_id'], row['state']) for row in db.jobs())
+    assert states == {'41': 'COMPLETED', '42': 'SUBMITTED'}
@@ -105,3 +105,150 @@ def test_argv(tdir, capfd, argv):
     nbscript(['one.ipynb'] + list(argv))
     captured = capfd.readouterr()
     assert " ".join(argv) in captured.out
+
+
+def test_inprocess_stdout(tdir, capfd):
+    """Test in-process execution to stdout"""
+    nbscript(['--inprocess', 'one.ipynb', 'A', '--B'])
+    captured = capfd.readouterr()
+    assert '0123456789' in captured.out
+    assert 'Yes running nbscript' in captured.out
+    assert 'A --B' in captured.out
+
+@pytest.mark.parametrize("fmt,output", test_formats)
+def test_inprocess_save_subdir(tdir, fmt, output):
+    """Test in-process execution when input is subdir/X.ipynb"""
+    os.mkdir('subdir')
+    os.rename('one.ipynb', 'subdir/one.ipynb')
+    to = ['--to', fmt] if fmt else []
+    nbscript(['--inprocess'] + to + ['--save', 'subdir/one.ipynb'])
+    assert_out('subdir/'+output)
+
+def test_inprocess_timestamp_filename(tdir):
+    nbscript(['--inprocess', '--out', 'out.ipynb', '--timestamp', 'one.ipynb'])
+    output = glob.glob('out*')[0]
+    assert time.strftime('%Y-%m-%d') in output
+    assert output.endswith('.ipynb')
+    assert 'NBSCRIPT_RUNNING' not in os.environ
+
+def test_inprocess_nbconvert_options(tdir, capfd):
+    """nbconvert's flags and aliases work in-process too"""
+    nbscript(['--inprocess', '--allow-errors', '--ExecutePreprocessor.timeout=60',
+              '--no-input', 'one.ipynb'])
+    assert 'Yes running nbscript' in capfd.readouterr().out
+    for option in (['--inplace'], ['--output-dir', 'x'], ['--bogus']):
+        with pytest.raises(ValueError):
+            nbscript(['--inprocess'] + option + ['one.ipynb'])
+
+def test_sweep(tdir):
+    import json
+    with open('params.jsonl', 'w') as f:
+        f.write('["A", "--B"]\n')
+        f.write('\n')
+        f.write('"C \'D E\'"\n')
+        f.write('[1]\n')
+    ret = nbscript(['--sweep', 'params.jsonl', '-j', '2', 'one.ipynb', 'X'])
+    assert ret == 0
+    for i in range(3):
+        assert_out('one.out.%d.ipynb'%i)
+    assert 'X A --B' in open('one.out.0.ipynb').read()
+    assert 'X C D E' in open('one.out.1.ipynb').read()
+    summary = json.load(open('one.out.ipynb.sweep.json'))
+    assert [r['index'] for r in summary['runs']] == [0, 1, 2]
+    assert summary['runs'][2]['argv'] == ['1']
+    assert all(r['returncode'] == 0 for r in summary['runs'])
+    assert all(r['wall_time'] > 0 for r in summary['runs'])
+
+def test_sweep_index(tdir):
+    with open('params.jsonl', 'w') as f:
+        f.write('["A"]\n["B"]\n["C"]\n')
+    nbscript(['--sweep', 'params.jsonl', '--sweep-index', '1', 'one.ipynb'])
+    assert os.listdir('.').count('one.out.1.ipynb') == 1
+    assert 'one.ipynb B' in open('one.out.1.ipynb').read()
+    assert not os.path.exists('one.out.0.ipynb')
+    assert not os.path.exists('one.out.ipynb.sweep.json')
+
+@pytest.mark.parametrize('argv', [
+    ['--sweep', 'params.jsonl', '--profile'],
+    ['--sweep', 'params.jsonl', '--ExecutePreprocessor.timeout=10'],
+    ['--daemon', '--cache'],
+    ['--daemon', '--checkpoint-cells', '1', '--save'],
+    ['--fast', '--stream'],
+    ['--fast', '--max-output-size', '1k'],
+    ['--fast', '--daemon'],
+    ['--sweep', 'params.jsonl', '--to', 'notebook,markdown'],
+    ])
+def test_mode_incompatible(tdir, argv):
+    """Options which --sweep, --daemon and --fast would ignore are errors"""
+    with open('params.jsonl', 'w') as f:
+        f.write('["A"]\n')
+    with pytest.raises(ValueError):
+        nbscript(argv + ['one.ipynb'])
+    assert not os.path.exists('one.out.0.ipynb')
+
+def test_stream_stdout(tdir, capfd):
+    """Test streaming output to stdout"""
+    nbscript(['--stream', 'one.ipynb', 'A', '--B'])
+    captured = capfd.readouterr()
+    assert '+*In[2]:*+' in captured.out
+    assert '+*Out[2]:*+\n----\n0123456789\n----' in captured.out
+    assert 'Yes running nbscript' in captured.out
+    assert 'A --B' in captured.out
+
+def test_stream_save(tdir, capfd):
+    """--stream with --save prints to stdout and writes the file"""
+    nbscript(['--stream', '--save', 'one.ipynb'])
+    captured = capfd.readouterr()
+    assert '0123456789' in captured.out
+    assert_out('one.out.ipynb')
+
+def test_profile(tdir, capfd):
+    import json
+    nbscript(['--profile', '--save', 'one.ipynb'])
+    captured = capfd.readouterr()
+    assert 'nbscript profile: 4 cells' in captured.err
+    assert_out('one.out.ipynb')
+    profile = json.load(open('one.out.ipynb.profile.json'))
+    assert [c['index'] for c in profile['cells']] == [0, 1, 2, 3]
+    assert all(c['wall_time'] >= 0 for c in profile['cells'])
+    assert open('one.out.ipynb.profile.csv').readline().startswith('index,')
+    nb = json.load(open('one.out.ipynb'))
+    assert 'wall_time' in nb['cells'][0]['metadata']['nbscript']['profile']
+
+def test_multiple_formats_save(tdir):
+    """--to a,b,c executes once and writes each format"""
+    nbscript(['--to', 'notebook,markdown,html', '--save', 'one.ipynb'])
+    assert_out('one.out.ipynb')
+    assert_out('one.md')
+    assert_out('one.html')
+
+def test_multiple_formats_fork_first(tdir, monkeypatch):
+    """This process only forks before the kernel starts (and its threads)"""
+    from . import execute
+    calls = [ ]
+    fork, execute_nb = os.fork, execute.execute
+    def record_fork():
+        calls.append('fork')
+        return fork()
+    def record_execute(*args, **kwargs):
+        calls.append('execute')
+        return execute_nb(*args, **kwargs)
+    monkeypatch.setattr(os, 'fork', record_fork)
+    monkeypatch.setattr(execute, 'execute', record_execute)
+    nbscript(['--to', 'notebook,markdown,html', '--save', 'one.ipynb'])
+    assert calls == ['fork', 'execute']
+    assert_out('one.out.ipynb')
+    assert_out('one.md')
+    assert_out('one.html')
+
+def test_multiple_formats_output(tdir):
+    os.mkdir('sub')
+    nbscript(['--to', 'notebook,markdown', '--output', 'sub/res.ipynb', '--timestamp', 'one.ipynb'])
+    outputs = sorted(os.listdir('sub'))
+    assert len(outputs) == 2
+    assert outputs[0].endswith('.ipynb') and outputs[1].endswith('.md')
+    assert outputs[0][:-len('.ipynb')] == outputs[1][:-len('.md')]
+    for fname in outputs:
+        assert_out(join('sub', fname))
+    with pytest.raises(ValueError):
+        nbscript(['--to', 'notebook,markdown', 'one.ipynb'])
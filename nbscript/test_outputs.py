@@ -0,0 +1,104 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import base64
+import os
+
+import nbformat
+from nbformat.v4 import new_code_cell, new_notebook, new_output
+import pytest
+
+from . import outputs
+from .nbscript import nbscript
+from .testutil import tdir
+
+PNG = base64.b64encode(b'\x89PNG' + bytes(range(256)) * 40).decode()
+
+
+def test_parse_size():
+    assert outputs.parse_size(10) == 10
+    assert outputs.parse_size('10') == 10
+    assert outputs.parse_size('1.5k') == 1536
+    assert outputs.parse_size('2MB') == 2 * 2**20
+    with pytest.raises(ValueError):
+        outputs.parse_size('lots')
+
+
+def test_truncate():
+    text = ''.join('line %d\n'%i for i in range(1000))
+    short = outputs.truncate(text, 100)
+    assert short.startswith('line 0\n')
+    assert short.endswith('line 999\n')
+    assert 'characters omitted' in short
+    assert len(short) < 200
+    assert outputs.truncate('abc', 100) == 'abc'
+
+
+def test_limiter(tdir):
+    cell = new_code_cell(outputs=[
+        new_output('stream', text='x\n' * 1000),
+        new_output('display_data', data={'image/png': PNG, 'text/plain': '<Figure>'}),
+        new_output('display_data', data={'text/html': '<b>' * 1000, 'text/plain': 'table'}),
+        new_output('display_data', data={'image/png': PNG}),
+        new_output('error', ename='E', evalue='', traceback=['x' * 10000]),
+        ])
+    limiter = outputs.OutputLimiter(max_output=500, offload=True, sidecar_dir='nb.out_files')
+    limiter.cell_end(None, cell, 0)
+    stream, image, html, image2, error = cell.outputs
+    assert len(stream.text) < 600
+    assert 'image/png' not in image.data
+    assert image.data['text/markdown'] == '![image/png](%s)'%image.metadata['nbscript']['offloaded']['image/png']
+    assert image.data['text/plain'] == '<Figure>'
+    fname = image.metadata['nbscript']['offloaded']['image/png']
+    assert base64.b64encode(open(fname, 'rb').read()).decode() == PNG
+    # Same content, one file
+    assert image2.metadata['nbscript']['offloaded']['image/png'] == fname
+    assert os.listdir('nb.out_files') == [os.path.basename(fname)]
+    assert 'text/html' not in html.data
+    assert html.data['text/plain'].startswith('table\n[nbscript: text/html output')
+    assert error.traceback == ['x' * 10000]
+
+
+def test_limiter_notebook_size():
+    cells = [new_code_cell(outputs=[new_output('stream', text='%d\n'%i * 300)])
+             for i in range(5)]
+    limiter = outputs.OutputLimiter(max_notebook=1500)
+    for i, cell in enumerate(cells):
+        limiter.cell_end(None, cell, i)
+    assert cells[1].outputs[0].text == '1\n' * 300
+    assert 'omitted' in cells[2].outputs[0].text
+    assert all(len(cell.outputs[0].text) < 300 for cell in cells[3:])
+    # Without offloading, images are removed.
+    cell = new_code_cell(outputs=[new_output('display_data', data={'image/png': PNG})])
+    limiter.cell_end(None, cell, 5)
+    assert list(cell.outputs[0].data) == ['text/plain']
+
+
+def test_nbscript_limits(tdir):
+    nb = new_notebook(cells=[
+        new_code_cell("print('y\\n' * 10000)"),
+        new_code_cell("from IPython.display import display\n"
+                      "display({'image/png': %r, 'text/plain': 'img'}, raw=True)"%PNG),
+        ])
+    nb.metadata['nbscript'] = {'outputs': {'max_output_size': '1k'}}
+    nbformat.write(nb, 'big.ipynb')
+    assert nbscript(['--inprocess', '--save', 'big.ipynb']) == 0
+    out = nbformat.read('big.out.ipynb', as_version=4)
+    assert 'omitted' in out.cells[0].outputs[0].text
+    assert list(out.cells[1].outputs[0].data) == ['text/plain']
+    assert not os.path.exists('big.out_files')
+
+    assert nbscript(['--save', '--offload-outputs', 'big.ipynb']) == 0
+    out = nbformat.read('big.out.ipynb', as_version=4)
+    assert 'text/markdown' in out.cells[1].outputs[0].data
+    assert len(os.listdir('big.out_files')) == 1
+
+def test_plain_run_skips_metadata(tdir, monkeypatch):
+    """Without in-process execution, the limits in the metadata aren't read"""
+    def notebook_config(notebook):
+        raise AssertionError("read %s"%notebook)
+    monkeypatch.setattr(outputs, 'notebook_config', notebook_config)
+    assert nbscript(['--save', 'one.ipynb']) == 0
+    with pytest.raises(AssertionError):
+        nbscript(['--inprocess', '--save', 'one.ipynb'])
+    # All limits given: the metadata doesn't matter.
+    assert nbscript(['--max-output-size', '1M', '--max-notebook-size', '1G',
+                     '--offload-outputs', '--save', 'one.ipynb']) == 0
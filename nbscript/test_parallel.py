@@ -0,0 +1,98 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import nbformat
+import pytest
+
+from .nbscript import nbscript
+from .parallel import plan_groups, TAG_PARALLEL
+from .testutil import tdir
+
+pytest.importorskip('dill')
+
+
+def make_nb(sources, tagged=()):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    for i in tagged:
+        nb.cells[i].metadata['tags'] = [TAG_PARALLEL]
+    return nb
+
+def outputs_text(fname):
+    nb = nbformat.read(fname, as_version=4)
+    return [''.join(out.get('text', '') for out in cell.get('outputs', [ ]))
+            for cell in nb.cells]
+
+
+def test_plan_groups():
+    sources = ["data = 1",
+               "a = data + 1",
+               "b = data * 2",
+               "c = a + 1",       # uses a: starts a new group
+               "d = data",
+               "print(a, b, c, d)",
+               ]
+    assert plan_groups(make_nb(sources, tagged=[1, 2, 3, 4])) == [
+        ([1, 2], {1: ['a'], 2: ['b']}),
+        ([3, 4], {3: ['c'], 4: ['d']}),
+        ]
+    # Untagged cells only with tagged_only=False.
+    assert plan_groups(make_nb(sources)) == [ ]
+    assert [g for g, _ in plan_groups(make_nb(sources), tagged_only=False)] == [
+        [1, 2], [3, 4]]
+    # Cell magics can't be analyzed, functions count with their effects.
+    sources = ["def f():\n    global x\n    x = 1",
+               "%%capture\ny = 1",
+               "f()",
+               "print(x)",
+               ]
+    assert plan_groups(make_nb(sources, tagged=[0, 1, 2, 3])) == [ ]
+    # Untagged cells which may change an object in place count as
+    # defining it, tagged ones are trusted not to.
+    sources = ["import numpy as np\nlst = [ ]", "lst.append(1)", "print(np.sum(lst))"]
+    assert plan_groups(make_nb(sources), tagged_only=False) == [ ]
+    assert plan_groups(make_nb(sources, tagged=[1, 2])) == [
+        ([1, 2], {1: [ ], 2: [ ]})]
+
+def test_parallel(tdir):
+    sources = ["import os\nbase = 10",
+               "import time\ntime.sleep(1)\na = base + 1\nprint('a', os.getpid())",
+               "import time\ntime.sleep(1)\nb = base + 2\nprint('b', os.getpid())",
+               "import time\ntime.sleep(1)\nc = base + 3\nprint('c', os.getpid())",
+               "print(a, b, c, os.getpid())",
+               ]
+    nb = make_nb(sources, tagged=[1, 2, 3])
+    nb.cells.insert(2, nbformat.v4.new_markdown_cell("text"))
+    nbformat.write(nb, 'nb.ipynb')
+    nbscript(['--parallel-cells', '3', '--save', 'nb.ipynb'])
+    out = outputs_text('nb.out.ipynb')
+    assert [text.split()[0] for text in out[1:5] if text] == ['a', 'b', 'c']
+    assert out[2] == ''
+    assert out[5].split()[:3] == ['11', '12', '13']
+    # The group ran in three different kernels, not in the main one.
+    pids = set(text.split()[1] for text in out[1:5] if text)
+    assert len(pids) == 3
+    assert out[5].split()[3] not in pids
+    counts = [c.get('execution_count') for c in nbformat.read('nb.out.ipynb', 4).cells]
+    assert counts == [1, 2, None, 3, 4, 5]
+
+def test_parallel_fallback(tdir):
+    # A generator can't be saved, so that cell runs in the main kernel.
+    sources = ["base = 1",
+               "a = base + 1",
+               "g = (i for i in range(3))",
+               "print(a, sum(g))",
+               ]
+    nbformat.write(make_nb(sources, tagged=[1, 2]), 'nb.ipynb')
+    nbscript(['--parallel-cells', '2', '--save', 'nb.ipynb'])
+    assert outputs_text('nb.out.ipynb')[3] == '2 3\n'
+
+def test_parallel_all_mutation(tdir):
+    nbformat.write(make_nb(["lst = [ ]", "lst.append(1)", "print(lst)"]), 'nb.ipynb')
+    nbscript(['--parallel-cells', '2', '--parallel-all', '--save', 'nb.ipynb'])
+    assert outputs_text('nb.out.ipynb')[2] == '[1]\n'
+
+def test_parallel_options(tdir):
+    nbformat.write(make_nb(["1"]), 'nb.ipynb')
+    with pytest.raises(ValueError):
+        nbscript(['--parallel-cells', '2', '--cache', 'nb.ipynb'])
+    with pytest.raises(ValueError):
+        nbscript(['--parallel-all', 'nb.ipynb'])
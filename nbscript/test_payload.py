@@ -0,0 +1,58 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import json
+import os
+
+import nbformat
+
+from . import payload
+from .nbscript import nbscript
+from .testutil import tdir
+
+
+def write_nb(fname, sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    nbformat.write(nb, fname)
+
+def outputs_text(fname):
+    nb = nbformat.read(fname, as_version=4)
+    return [''.join(out.get('text', '') for out in cell.outputs) for cell in nb.cells]
+
+
+def test_packed():
+    small = {'NB_ARGV': json.dumps(['nb.ipynb', 'a']), 'X': '1'}
+    with payload.packed(small) as env:
+        assert env == small
+    large = {'NB_ARGV': json.dumps(['nb.ipynb'] + ['x' * 100] * 1000)}
+    with payload.packed(large) as env:
+        assert 'NB_ARGV' not in env
+        fname = env[payload.ARGV_FILE_ENV]
+        assert payload.load_argv(env) == json.loads(large['NB_ARGV'])
+    assert not os.path.exists(fname)
+    assert payload.load_argv({ }) is None
+
+def test_lazy_params(tdir):
+    assert payload.lazy_params({ }) is None
+    params = payload.lazy_params({payload.PARAMS_FILE_ENV: 'params.json'})
+    # Not read yet: the file doesn't even exist.
+    with open('params.json', 'w') as f:
+        json.dump({'n': 3, 'files': ['a']}, f)
+    assert params['n'] == 3
+    assert params.get('x', 1) == 1
+    assert 'files' in params and len(params) == 2
+    assert params == {'n': 3, 'files': ['a']}
+
+def test_large_argv(tdir):
+    write_nb('nb.ipynb', ["import nbscript, os\n"
+                          "print(len(nbscript.argv), nbscript.argv[-1], 'NB_ARGV' in os.environ)"])
+    args = ['arg%05d'%i for i in range(5000)]
+    nbscript(['--save', 'nb.ipynb'] + args)
+    assert outputs_text('nb.out.ipynb')[0] == '5001 arg04999 False\n'
+
+def test_params(tdir):
+    with open('params.json', 'w') as f:
+        json.dump({'files': ['a.txt', 'b.txt'], 'n': 3}, f)
+    write_nb('nb.ipynb', ["import nbscript\n"
+                          "print(nbscript.params['n'], nbscript.params['files'][1])"])
+    nbscript(['--params', 'params.json', '--save', 'nb.ipynb'])
+    assert outputs_text('nb.out.ipynb')[0] == '3 b.txt\n'
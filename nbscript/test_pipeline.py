@@ -0,0 +1,102 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import json
+import os
+
+import nbformat
+import pytest
+
+from . import pipeline
+from .nbscript import nbscript
+from .test_jobdb import fake_command
+from .testutil import tdir
+
+
+def write_nb(fname, source):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(source)]
+    nbformat.write(nb, fname)
+
+def write_pipeline(stages, fname='pipeline.json'):
+    with open(fname, 'w') as f:
+        json.dump({'stages': stages}, f)
+    return fname
+
+# prep writes prep.txt from raw.txt, use gets its name in argv and
+# NBSCRIPT_INPUTS, other is independent.  Each appends to ran.txt.
+STAGES = {
+    'prep': {'notebook': 'prep.ipynb', 'inputs': ['raw.txt'],
+             'outputs': {'data': 'prep.txt'}},
+    'use': {'notebook': 'use.ipynb', 'needs': ['prep'], 'args': ['{prep.data}'],
+            'outputs': ['use.txt']},
+    'other': {'notebook': 'other.ipynb'},
+    }
+
+def setup_pipeline():
+    open('raw.txt', 'w').write('raw')
+    write_nb('prep.ipynb', "open('ran.txt', 'a').write('prep ')\n"
+                           "open('prep.txt', 'w').write(open('raw.txt').read() + ' prep')")
+    write_nb('use.ipynb', "import json, os, nbscript\n"
+                          "open('ran.txt', 'a').write('use ')\n"
+                          "inputs = json.loads(os.environ['NBSCRIPT_INPUTS'])\n"
+                          "assert inputs['prep']['data'] == nbscript.argv[1]\n"
+                          "open('use.txt', 'w').write(open(nbscript.argv[1]).read() + ' use')")
+    write_nb('other.ipynb', "open('ran.txt', 'a').write('other ')")
+    return write_pipeline(STAGES)
+
+def ran():
+    return sorted(open('ran.txt').read().split())
+
+
+def test_read_pipeline(tdir):
+    stages = pipeline.read_pipeline(write_pipeline(STAGES))
+    assert pipeline.order(stages) == ['prep', 'use', 'other']
+    assert pipeline.command(stages, 'use') == ['nbscript', '--save', 'use.ipynb', 'prep.txt']
+    assert pipeline.stage_inputs(stages, 'use') == ['prep.txt']
+    with pytest.raises(ValueError):
+        pipeline.read_pipeline(write_pipeline({'a': {'notebook': 'a.ipynb', 'needs': ['b']},
+                                               'b': {'notebook': 'b.ipynb', 'needs': ['a']}}))
+    with pytest.raises(ValueError):
+        pipeline.read_pipeline(write_pipeline({'a': {'notebook': 'a.ipynb', 'need': ['b']}}))
+
+def test_read_yaml(tdir):
+    pytest.importorskip('yaml')
+    with open('pipeline.yaml', 'w') as f:
+        f.write("stages:\n  a:\n    notebook: a.ipynb\n    args: --x 1\n")
+    stages = pipeline.read_pipeline('pipeline.yaml')
+    assert stages['a']['args'] == ['--x', '1']
+
+def test_pipeline(tdir):
+    fname = setup_pipeline()
+    assert nbscript(['pipeline', fname]) == 0
+    assert open('use.txt').read() == 'raw prep use'
+    assert os.path.exists('use.out.ipynb')
+    assert ran() == ['other', 'prep', 'use']
+    # Nothing changed, nothing runs.
+    assert nbscript(['pipeline', fname]) == 0
+    assert ran() == ['other', 'prep', 'use']
+    # A changed input re-runs the stages which depend on it.
+    open('raw.txt', 'w').write('new')
+    assert nbscript(['pipeline', fname]) == 0
+    assert open('use.txt').read() == 'new prep use'
+    assert ran() == ['other', 'prep', 'prep', 'use', 'use']
+
+def test_pipeline_failure(tdir):
+    fname = setup_pipeline()
+    write_nb('prep.ipynb', "raise RuntimeError('failed')")
+    assert nbscript(['pipeline', fname]) == 1
+    assert ran() == ['other']
+    assert not os.path.exists(pipeline.stamp_fname(fname, 'prep'))
+
+def test_pipeline_slurm(tdir, monkeypatch):
+    fname = setup_pipeline()
+    bindir = os.path.join(tdir, 'bin')
+    os.mkdir(bindir)
+    fake_command(bindir, 'snotebook',
+                 'echo "$NBSCRIPT_PIPELINE_STAGE $@" >> snotebook.calls\n'
+                 'echo "Submitted batch job $(wc -l < snotebook.calls)"\n')
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    assert nbscript(['pipeline', '--slurm', fname]) == 0
+    calls = open('snotebook.calls').read().splitlines()
+    assert calls == ['prep --- --save prep.ipynb',
+                     'use --dependency=afterok:1 --- --save use.ipynb prep.txt',
+                     'other --- --save other.ipynb']
@@ -0,0 +1,162 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import os
+
+import nbformat
+import pytest
+
+from . import names
+from .nbscript import nbscript
+from .rerun import plan_rerun
+from .testutil import tdir
+
+pytest.importorskip('dill')
+
+
+def make_nb(sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    return nb
+
+def executed(sources):
+    """A previous output with a state covering all cells"""
+    nb = make_nb(sources)
+    for i, cell in enumerate(nb.cells):
+        cell.execution_count = i + 1
+    nb.metadata['nbscript'] = {'state': 'x.state', 'state_cells': len(sources)}
+    return nb
+
+def write_nb(fname, sources):
+    nbformat.write(make_nb(sources), fname)
+
+def outputs_text(fname):
+    nb = nbformat.read(fname, as_version=4)
+    return [''.join(out.get('text', '') for out in cell.outputs) for cell in nb.cells]
+
+
+def test_analyze():
+    info = names.analyze("x = x + 1\ny = [i for i in z]\nf(y)")
+    assert info.defined == {'x', 'y'}
+    assert info.used == {'x', 'z', 'f'}
+    info = names.analyze("def f(a, b=c):\n    global g\n    g = a + w\n"
+                         "class C:\n    def m(self): return q\n")
+    assert info.used == {'c'}
+    assert info.functions == {'f': ({'w'}, {'g'}), 'C': ({'q'}, set())}
+    assert names.analyze("%%bash\nls") is None
+
+
+SOURCES = ["a = 1",
+           "b = a + 1",
+           "c = 10",
+           "print(b + c)",
+           ]
+
+def test_plan_unchanged():
+    assert plan_rerun(make_nb(SOURCES), executed(SOURCES)) == (
+        set(), {0: 0, 1: 1, 2: 2, 3: 3})
+
+def test_plan_downstream():
+    # Changing `a` re-runs the cells which depend on it, not `c = 10`.
+    dirty, reuse = plan_rerun(make_nb(["a = 2"] + SOURCES[1:]), executed(SOURCES))
+    assert dirty == {0, 1, 3}
+    assert reuse == {2: 2}
+
+def test_plan_inserted():
+    sources = SOURCES[:3] + ["c = c * 2"] + SOURCES[3:]
+    dirty, reuse = plan_rerun(make_nb(sources), executed(SOURCES))
+    assert dirty == {3, 4}
+    assert reuse == {0: 0, 1: 1, 2: 2}
+
+def test_plan_functions():
+    # The cell calling f depends on what f reads when called.
+    sources = ["w = 1", "def f():\n    return w", "print(f())"]
+    dirty, reuse = plan_rerun(make_nb(["w = 2"] + sources[1:]), executed(sources))
+    assert dirty == {0, 2}
+
+def test_plan_stale():
+    # The saved x is from the old version of the changed cell, so the
+    # cell which defines it first runs again too.
+    sources = ["x = 1", "x = x + 1"]
+    assert plan_rerun(make_nb(["x = 1", "x = x + 2"]), executed(sources)) == ({0, 1}, { })
+    # Same when the cell which set x last is removed.
+    assert plan_rerun(make_nb(["x = 1", "print(x)"]),
+                      executed(["x = 1", "x = 2", "print(x)"])) == ({0, 1}, { })
+
+def test_plan_unsafe():
+    # y would come from the saved state, but nothing defines it now.
+    assert plan_rerun(make_nb(["print(y)"]), executed(["y = 1", "print(y)"])) is None
+    assert plan_rerun(make_nb(["%%bash\nls"]), executed(["%%bash\nls"])) is None
+
+def test_plan_mutation():
+    # The saved lst already has the old append, so the cell which
+    # creates it runs again too.
+    sources = ["lst = [ ]", "lst.append(1)", "print(lst)"]
+    assert plan_rerun(make_nb(["lst = [ ]", "lst.append(2)", "print(lst)"]),
+                      executed(sources)) == ({0, 1, 2}, { })
+    # ... and if nothing creates it, everything runs.
+    assert plan_rerun(make_nb(["lst.append(2)", "print(lst)"]),
+                      executed(["lst.append(1)", "print(lst)"])) is None
+    # Readers of what a re-run cell reads run again too.
+    dirty, _ = plan_rerun(make_nb(["a = [1, 2]", "x = a[0] + 1", "y = a[1]"]),
+                          executed(["a = [1, 2]", "x = a[0]", "y = a[1]"]))
+    assert dirty == {1, 2}
+
+def test_plan_incomplete():
+    previous = executed(SOURCES)
+    previous.cells[2].outputs = [nbformat.v4.new_output('error', ename='E', evalue='',
+                                                        traceback=[ ])]
+    dirty, reuse = plan_rerun(make_nb(SOURCES), previous)
+    assert dirty == {2, 3}
+
+
+RUN_SOURCES = ["x = 41",
+               "open('ran.txt', 'a').write('b')",
+               "y = 1",
+               "print(x + y)",
+               ]
+ARGS = ['--checkpoint-cells', '1', '--checkpoint-state', '--save', 'nb.ipynb']
+
+def test_rerun(tdir):
+    write_nb('nb.ipynb', RUN_SOURCES)
+    nbscript(ARGS)
+    write_nb('nb.ipynb', RUN_SOURCES[:2] + ["y = 2"] + RUN_SOURCES[3:])
+    nbscript(['--rerun', 'nb.out.ipynb'] + ARGS)
+    # The second cell didn't run again, the last one did.
+    assert open('ran.txt').read() == 'b'
+    assert outputs_text('nb.out.ipynb')[3] == '43\n'
+    meta = nbformat.read('nb.out.ipynb', as_version=4).metadata['nbscript']
+    assert meta['state_cells'] == 4
+    # And again, from that output.
+    write_nb('nb.ipynb', ["x = 1"] + RUN_SOURCES[1:2] + ["y = 2"] + RUN_SOURCES[3:])
+    nbscript(['--rerun', 'nb.out.ipynb'] + ARGS)
+    assert open('ran.txt').read() == 'b'
+    assert outputs_text('nb.out.ipynb')[3] == '3\n'
+
+def test_rerun_stale(tdir):
+    write_nb('nb.ipynb', RUN_SOURCES[:3] + ["x = x + y\nprint(x)"])
+    nbscript(ARGS)
+    write_nb('nb.ipynb', RUN_SOURCES[:3] + ["x += 1\nprint(x)"])
+    nbscript(['--rerun', 'nb.out.ipynb'] + ARGS)
+    # The saved x is 42, x = 41 had to run again first.
+    assert open('ran.txt').read() == 'b'
+    assert outputs_text('nb.out.ipynb')[3] == '42\n'
+
+def test_rerun_mutation(tdir):
+    write_nb('nb.ipynb', ["lst = [ ]", "lst.append(1)", "print(lst)"])
+    nbscript(ARGS)
+    write_nb('nb.ipynb', ["lst = [ ]", "lst.append(2)", "print(lst)"])
+    nbscript(['--rerun', 'nb.out.ipynb'] + ARGS)
+    assert outputs_text('nb.out.ipynb')[2] == '[2]\n'
+
+def test_rerun_unsafe(tdir):
+    write_nb('nb.ipynb', RUN_SOURCES)
+    nbscript(ARGS)
+    write_nb('nb.ipynb', RUN_SOURCES[:3] + ["%%capture\nprint(x + y)"])
+    nbscript(['--rerun', 'nb.out.ipynb'] + ARGS)
+    # Cell magics can't be analyzed: everything ran again.
+    assert open('ran.txt').read() == 'bb'
+
+def test_rerun_missing(tdir):
+    write_nb('nb.ipynb', RUN_SOURCES)
+    nbscript(['--rerun', 'nb.out.ipynb', '--save', 'nb.ipynb'])
+    assert outputs_text('nb.out.ipynb')[3] == '42\n'
+    assert not os.path.exists('nb.out.ipynb.state')
@@ -0,0 +1,50 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import os
+
+import nbformat
+import pytest
+
+from .nbscript import nbscript
+from .testutil import tdir
+
+pytest.importorskip('dill')
+
+
+def write_nb(fname, sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    nbformat.write(nb, fname)
+
+SOURCES = ["x = 41",
+           "open('ran.txt', 'a').write('b')",
+           "print(x + 1)",
+           ]
+
+def outputs_text(fname):
+    nb = nbformat.read(fname, as_version=4)
+    return [''.join(out.get('text', '') for out in cell.outputs) for cell in nb.cells]
+
+def test_resume(tdir):
+    write_nb('nb.ipynb', SOURCES)
+    nbscript(['--checkpoint-cells', '1', '--checkpoint-state', '--save', 'nb.ipynb'])
+    assert os.path.exists('nb.out.ipynb.state')
+    meta = nbformat.read('nb.out.ipynb', as_version=4).metadata['nbscript']
+    assert meta['state_cells'] == 3
+    # Add a cell, the first three are taken from the previous run.
+    write_nb('nb.ipynb', SOURCES + ["print(x * 2)"])
+    nbscript(['--resume', 'nb.out.ipynb', '--save', 'nb.ipynb'])
+    assert open('ran.txt').read() == 'b'
+    assert outputs_text('nb.out.ipynb')[2:] == ['42\n', '82\n']
+
+def test_resume_changed(tdir):
+    write_nb('nb.ipynb', SOURCES)
+    nbscript(['--checkpoint-cells', '1', '--checkpoint-state', '--save', 'nb.ipynb'])
+    write_nb('nb.ipynb', ["x = 1"] + SOURCES[1:])
+    nbscript(['--resume', 'nb.out.ipynb', '--save', 'nb.ipynb'])
+    assert open('ran.txt').read() == 'bb'
+    assert outputs_text('nb.out.ipynb')[2] == '2\n'
+
+def test_resume_missing(tdir):
+    write_nb('nb.ipynb', SOURCES)
+    nbscript(['--resume', 'nb.out.ipynb', '--save', 'nb.ipynb'])
+    assert outputs_text('nb.out.ipynb')[2] == '42\n'
@@ -0,0 +1,68 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import base64
+import json
+import os
+
+import nbformat
+from nbformat.v4 import new_code_cell, new_markdown_cell, new_notebook, new_output
+import pytest
+
+from . import scan
+from .snotebook import sbatch_directives
+from .testutil import tdir_slurm
+
+
+SOURCE = '#SBATCH --mem=1G\n#SBATCH -c 2 --job-name="a b"\nx = "\\\\"\nprint(x)'
+
+def write(fname, nb, **kw):
+    with open(fname, 'w') as f:
+        json.dump(nb, f, **kw)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 2**16])
+def test_scan(tdir_slurm, chunk_size):
+    nb = new_notebook(cells=[
+        new_markdown_cell('# Title "\\ ä'),
+        new_code_cell(SOURCE, outputs=[new_output('stream', text='a\\"b\\\\"c\n' * 3)],
+                      execution_count=12),
+        new_code_cell('#SBATCH --not-this-one'),
+        ])
+    nb.metadata['x'] = [{'a': [1, 2.5e3, None, True]}, '"]}']
+    nbformat.write(nb, 'test.ipynb')
+    assert scan.first_code_cell_source('test.ipynb', chunk_size=chunk_size) == SOURCE
+    # metadata before cells, source as a string, other whitespace
+    write('test2.ipynb', dict((k, nb[k]) for k in sorted(nb, reverse=True)),
+          separators=(',', ':'))
+    assert scan.first_code_cell_source('test2.ipynb', chunk_size=chunk_size) == SOURCE
+    assert scan.first_code_cell_source('slurm.ipynb', chunk_size=chunk_size) == \
+        nbformat.read('slurm.ipynb', as_version=4).cells[0].source
+
+
+def test_scan_no_code(tdir_slurm):
+    nbformat.write(new_notebook(cells=[new_markdown_cell('x')]), 'md.ipynb')
+    assert scan.first_code_cell_source('md.ipynb') is None
+    assert sbatch_directives('md.ipynb') == [ ]
+
+
+def test_sbatch_directives(tdir_slurm):
+    nbformat.write(new_notebook(cells=[new_code_cell(SOURCE)]), 'test.ipynb')
+    assert sbatch_directives('test.ipynb') == ['--mem=1G', '-c', '2', '--job-name=a b']
+    # Not parseable by the scanner: falls back to nbformat.
+    with open('test.ipynb') as f:
+        text = f.read()
+    with open('v3.ipynb', 'w') as f:
+        f.write(nbformat.writes(nbformat.convert(nbformat.reads(text, 4), 3), 3))
+    assert sbatch_directives('v3.ipynb') == ['--mem=1G', '-c', '2', '--job-name=a b']
+
+
+def test_scan_big(tdir_slurm):
+    """Notebooks with large outputs, also before the first code cell's
+    source (timings: `python -m nbscript.benchmark --only scan`)"""
+    image = base64.b64encode(os.urandom(3 * 2**20)).decode()
+    big = new_output('display_data', data={'image/png': image, 'text/plain': 'x'})
+    for name, first_outputs in [('small-first.ipynb', [ ]),
+                                ('big-first.ipynb', [big] * 3)]:
+        cells = [new_code_cell(SOURCE, outputs=first_outputs)]
+        cells += [new_code_cell('plot()', outputs=[big]) for _ in range(5)]
+        nbformat.write(new_notebook(cells=cells), name)
+        assert scan.first_code_cell_source(name) == SOURCE
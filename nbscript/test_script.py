@@ -0,0 +1,104 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import os
+import sys
+
+import nbformat
+import pytest
+
+from . import script
+from .nbscript import nbscript
+from .testutil import tdir
+
+
+def write_nb(fname, *sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(source) for source in sources]
+    nbformat.write(nb, fname)
+
+
+def test_fast(tdir, capfd):
+    assert nbscript(['--fast', '--cache-dir=cache', 'one.ipynb', 'A', 'B']) == 0
+    out = capfd.readouterr().out
+    assert '0123456789' in out
+    assert 'Yes running nbscript' in out
+    assert 'argv: one.ipynb A B' in out
+    assert len(os.listdir('cache/compiled')) == 1
+    assert not os.path.exists('one.out.ipynb')
+
+
+def test_fast_params(tdir, capfd):
+    with open('p.json', 'w') as f:
+        f.write('{"n": 7}')
+    write_nb('params.ipynb', 'import nbscript\nprint("n =", nbscript.params["n"])')
+    assert nbscript(['--fast', '--cache-dir=cache', '--params', 'p.json', 'params.ipynb']) == 0
+    assert 'n = 7' in capfd.readouterr().out
+    import nbscript as nbscript_package
+    assert nbscript_package.params is None
+
+
+def test_compile_cached(tdir, capfd):
+    assert nbscript(['--compile', '--cache-dir=cache', 'one.ipynb']) == 0
+    fname = capfd.readouterr().out.strip()
+    mtime = os.stat(fname).st_mtime_ns
+    assert nbscript(['--compile', '--cache-dir=cache', 'one.ipynb']) == 0
+    assert capfd.readouterr().out.strip() == fname
+    assert os.stat(fname).st_mtime_ns == mtime
+    # A changed notebook is compiled again.
+    write_nb('one.ipynb', 'print(1)')
+    assert nbscript(['--compile', '--cache-dir=cache', 'one.ipynb']) == 0
+    assert capfd.readouterr().out.strip() != fname
+
+
+def test_translate(tdir, capfd):
+    write_nb('magic.ipynb',
+             '%matplotlib inline\n%env NBSCRIPT_TEST=ab c\nx = 1',
+             '%time y = x + 1\n!echo shell $NBSCRIPT_TEST',
+             '%%bash\necho bash',
+             'if y:\n    %time z = 3\nz * (2 +\n  2)',
+             'y;',
+             "'ä', 1  # comment\n# another")
+    assert nbscript(['--fast', '--cache-dir=cache', 'magic.ipynb']) == 0
+    out = capfd.readouterr().out
+    assert out.split('\n') == ['shell ab c', 'bash', '12', "('ä', 1)", '']
+
+
+def test_shell_expand(tdir, capfd):
+    """Like IPython, !cmd expands variables, and strings aren't changed"""
+    write_nb('shell.ipynb',
+             "name = 'a b'\nn = 2\n!echo hello {name} $n '$n' {n+1}\n"
+             # Not a variable: the command is left to the shell.
+             "!echo {n} $NBSCRIPT_UNSET-x",
+             'def f(n):\n    !echo in f $n\nf(5)',
+             's = """\n!echo no\n%cd /\n"""\nprint(s.split())')
+    assert nbscript(['--fast', '--cache-dir=cache', 'shell.ipynb']) == 0
+    out = capfd.readouterr().out
+    assert out.split('\n') == ['hello a b 2 $n 3', '{n} -x', 'in f 5', "['!echo', 'no', '%cd', '/']", '']
+
+
+@pytest.mark.parametrize('source', ['%timeit x', 'x = !ls', '%%capture\nx', '%cd $d',
+                                    '%env X={x}'])
+def test_unsupported(tdir, source):
+    write_nb('bad.ipynb', source)
+    with pytest.raises(script.CompileError):
+        nbscript(['--fast', '--cache-dir=cache', 'bad.ipynb'])
+
+
+def test_import_next_to_notebook(tdir, capfd):
+    os.mkdir('proj')
+    with open('proj/nbscript_test_helper.py', 'w') as f:
+        f.write('VALUE = 7\n')
+    write_nb('proj/nb.ipynb', 'import nbscript_test_helper\nprint(nbscript_test_helper.VALUE)')
+    path = list(sys.path)
+    try:
+        assert nbscript(['--fast', '--cache-dir=cache', 'proj/nb.ipynb']) == 0
+    finally:
+        sys.modules.pop('nbscript_test_helper', None)
+    assert capfd.readouterr().out == '7\n'
+    assert sys.path == path
+
+
+def test_exit_status(tdir):
+    write_nb('fail.ipynb', 'raise ValueError("x")')
+    assert nbscript(['--fast', '--cache-dir=cache', 'fail.ipynb']) == 1
+    write_nb('exit.ipynb', 'import sys; sys.exit(3)')
+    assert nbscript(['--fast', '--cache-dir=cache', 'exit.ipynb']) == 3
@@ -1,8 +1,12 @@
 # pylint: disable=unused-argument,redefined-outer-name
 import logging
+import os
+import shutil
+
+import pytest
 
 from . import snotebook
-from .testutil import tdir_slurm, assert_sublist
+from .testutil import tdir, tdir_slurm, assert_out, assert_sublist
 
 from .nbscript import LOG as nbscript_LOG
 nbscript_LOG.setLevel(logging.DEBUG)
@@ -44,3 +48,73 @@ def test_batch_timestamp(tdir_slurm, monkeypatch):
         assert '--mem=1234M' in cmd_submit
     monkeypatch.setattr(snotebook, "execute_sbatch", sbatch)
     snotebook.snotebook(['---', '--timestamp', 'slurm.ipynb'])
+
+def test_array(tdir_slurm, monkeypatch):
+    """snotebook --array params.jsonl slurm.ipynb should do:
+
+    one sbatch --array=0-2%2 job
+    results in slurm.out.N.ipynb
+    stdout in  slurm.out.N.ipynb.log (%a is the task ID)
+    """
+    with open('params.jsonl', 'w') as f:
+        f.write('["A"]\n["B"]\n\n["C"]\n')
+    def sbatch(cmd_submit, stdin, env, cmd_nbscript):
+        assert '--array=0-2%2' in cmd_submit
+        assert '--output=slurm.out.%a.ipynb.log' in cmd_submit
+        assert '--mem=1234M' in cmd_submit
+        assert_sublist(cmd_nbscript, ['--sweep', 'params.jsonl'])
+        assert b'nbscript --sweep-index "$SLURM_ARRAY_TASK_ID" ' in stdin
+        return 0
+    monkeypatch.setattr(snotebook, "execute_sbatch", sbatch)
+    assert snotebook.snotebook(['--array', 'params.jsonl', '--array-limit', '2',
+                                'slurm.ipynb']) == 0
+
+def test_auto_resume(tdir_slurm, monkeypatch):
+    def sbatch(cmd_submit, stdin, env, cmd_nbscript):
+        assert '--requeue' in cmd_submit
+        assert '--open-mode=append' in cmd_submit
+        assert_sublist(cmd_nbscript, ['--resume', 'slurm.out.ipynb'])
+        assert '--checkpoint-state' in cmd_nbscript
+        assert b'scontrol requeue' in stdin
+        assert b'-lt 3 ]' in stdin
+        return 0
+    monkeypatch.setattr(snotebook, "execute_sbatch", sbatch)
+    assert snotebook.snotebook(['--auto-resume', '3', 'slurm.ipynb']) == 0
+
+def test_auto_resume_other_format(tdir_slurm, monkeypatch):
+    def sbatch(cmd_submit, stdin, env, cmd_nbscript):
+        assert_sublist(cmd_nbscript, ['--resume', 'slurm.checkpoint.ipynb'])
+        return 0
+    monkeypatch.setattr(snotebook, "execute_sbatch", sbatch)
+    assert snotebook.snotebook(['--auto-resume', '3', '---', '--to=html', 'slurm.ipynb']) == 0
+
+def test_pack(tdir_slurm, monkeypatch):
+    """snotebook --pack slurm.ipynb other.ipynb --per-node 1 should do:
+
+    one job on two nodes, each notebook as a job step
+    results in slurm.out.ipynb and other.out.ipynb, with their own logs
+    """
+    shutil.copy('slurm.ipynb', 'other.ipynb')
+    def sbatch(cmd_submit, stdin, env, cmd_nbscript):
+        assert '--nodes=2' in cmd_submit
+        assert '--ntasks-per-node=1' in cmd_submit
+        assert '--mem=1234M' in cmd_submit
+        assert b'srun "$step_flag" ' in stdin
+        assert b'step_flag=--exclusive' in stdin
+        assert b'nbscript --save slurm.ipynb > slurm.out.ipynb.log 2>&1 &' in stdin
+        assert b'nbscript --save other.ipynb > other.out.ipynb.log 2>&1 &' in stdin
+        return 0
+    monkeypatch.setattr(snotebook, "execute_sbatch", sbatch)
+    assert snotebook.snotebook(['--pack', 'slurm.ipynb', 'other.ipynb',
+                                '--per-node', '1']) == 0
+    with pytest.raises(ValueError):
+        snotebook.snotebook(['--pack', 'slurm.ipynb', 'other.ipynb',
+                             '---', '--output=same.ipynb'])
+
+def test_pack_raw(tdir):
+    shutil.copy('one.ipynb', 'two.ipynb')
+    assert snotebook.snotebook(['--raw', '--pack', 'one.ipynb', 'two.ipynb',
+                                '--per-node', '1']) == 0
+    assert_out('one.out.ipynb')
+    assert_out('two.out.ipynb')
+    assert os.path.exists('two.out.ipynb.log')
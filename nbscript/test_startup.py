@@ -0,0 +1,60 @@
+"""Startup time regression tests.
+
+`import nbscript` is done in every kernel nbscript runs (to read
+`nbscript.argv`) and the snotebook command line only parses arguments,
+so neither should import the Jupyter stack.  The import time, as
+measured by `python -X importtime` for the nbscript modules and what
+they import, must also stay within a budget.
+"""
+import re
+import subprocess
+import sys
+
+import pytest
+
+# Modules which must only be imported when actually executing.
+HEAVY_MODULES = ['nbformat', 'nbconvert', 'nbclient', 'jupyter_client', 'zmq',
+                 'tornado', 'jinja2', 'sqlite3']
+
+# Seconds, generous compared to the usual ~0.02 s so that slow test
+# machines don't fail.
+IMPORT_BUDGET = 0.25
+
+
+def import_times(args):
+    """Run python -X importtime.
+
+    Returns (all modules imported, {module: cumulative seconds}) with
+    the times of the top-level imports from the first nbscript one on.
+    Interpreter startup (`site` and what it imports) comes before that
+    and isn't nbscript's, so it doesn't count.
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    modules = set()
+    times = { }
+    started = False
+    for line in p.stderr.decode().splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)', line)
+        if not m:
+            continue
+        modules.add(m.group(3))
+        if m.group(3).split('.')[0] == 'nbscript':
+            started = True
+        if started and not m.group(2):
+            times[m.group(3)] = int(m.group(1)) / 1e6
+    return modules, times
+
+
+@pytest.mark.parametrize('args', [
+    ['-c', 'import nbscript'],
+    ['-m', 'nbscript.snotebook', '--help'],
+    ])
+def test_startup(args):
+    modules, times = import_times(args)
+    heavy = [mod for mod in HEAVY_MODULES if mod in modules]
+    assert not heavy, "%s imports %s"%(' '.join(args), heavy)
+    assert times, "nbscript not imported"
+    total = sum(times.values())
+    assert total < IMPORT_BUDGET, "imports took %.3fs: %s"%(
+        total, sorted(times.items(), key=lambda x: -x[1])[:5])
@@ -0,0 +1,75 @@
+# pylint: disable=unused-argument,redefined-outer-name
+import json
+import os
+
+import nbformat
+import pytest
+
+from . import state
+from .nbscript import nbscript
+from .testutil import tdir
+
+pytest.importorskip('dill')
+
+
+def write_nb(fname, sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(src) for src in sources]
+    nbformat.write(nb, fname)
+
+
+def test_save_load(tdir):
+    import os.path as osp
+    def double(x):
+        return 2 * x
+    namespace = {'a': [1, 2], 'double': double, 'osp': osp, '_hidden': 1,
+                 'In': [ ], 'gen': (i for i in range(3))}
+    index = state.save(namespace, 'x.vars')
+    assert sorted(index['variables']) == ['a', 'double', 'osp']
+    assert 'gen' in index['failed']
+    assert not os.path.exists('x.vars/gen.pkl')
+    loaded = state.load_state('x.vars')
+    assert loaded['a'] == [1, 2]
+    assert loaded['double'](2) == 4
+    assert loaded['osp'] is osp
+    namespace = { }
+    assert state.load_state('x', namespace=namespace, names=['a']) == {'a': [1, 2]}
+    assert namespace == {'a': [1, 2]}
+
+def test_numpy_mmap(tdir):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.arange(1000.)
+    index = state.save({'array': array, 'objects': numpy.array([None, 1])}, 'x.vars')
+    assert index['variables']['array']['kind'] == 'npy'
+    assert index['variables']['objects']['kind'] == 'dill'
+    loaded = state.load_state('x.vars')
+    assert isinstance(loaded['array'], numpy.memmap)
+    assert (loaded['array'] == array).all()
+
+def test_save_state(tdir):
+    write_nb('nb.ipynb', ["import nbscript, os",
+                          "x = 42",
+                          "out = nbscript.output_filename()"])
+    nbscript(['--save-state', '--save', 'nb.ipynb'])
+    index = json.load(open('nb.out.ipynb.vars/index.json'))
+    assert index['variables']['os'] == {'kind': 'module', 'module': 'os'}
+    loaded = state.load_state('nb.out.ipynb')
+    assert loaded['x'] == 42
+    assert loaded['out'] == os.path.abspath('nb.out.ipynb')
+    with pytest.raises(ValueError):
+        nbscript(['--save-state', 'nb.ipynb'])
+
+def test_save_state_subdir(tdir):
+    """The kernel runs in the notebook's directory, output_filename() works there"""
+    os.mkdir('sub')
+    write_nb('sub/nb.ipynb', ["import nbscript",
+                              "x = nbscript.load_state(nbscript.output_filename())['x']"])
+    write_nb('sub/first.ipynb', ["x = 42"])
+    nbscript(['--save-state', '--output', 'sub/nb.out.ipynb', 'sub/first.ipynb'])
+    nbscript(['--save-state', '--output', 'sub/nb.out.ipynb', 'sub/nb.ipynb'])
+    assert state.load_state('sub/nb.out.ipynb')['x'] == 42
+
+def test_save_state_empty(tdir):
+    write_nb('nb.ipynb', [ ])
+    nbscript(['--save-state', '--save', 'nb.ipynb'])
+    assert state.load_state('nb.out.ipynb') == { }
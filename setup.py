@@ -26,6 +26,7 @@ setuptools.setup(
         'console_scripts': [
             'nbscript=nbscript.nbscript:nbscript',
             'snotebook=nbscript.snotebook:snotebook',
+            'nbscript-daemon=nbscript.daemon:nbscript_daemon',
         ],
     },
     classifiers=[